@@ -1,6 +1,90 @@
+import configparser
+import importlib.util
+import os
+from threading import Lock
+
 from pymongo import MongoClient, version
 
 
+# connection settings and their defaults, each can be set in the [mongodb] section of the
+# config file or with the environment variable MONGO_<NAME>, e.g. MONGO_HOST
+DEFAULT_SETTINGS = {
+    "database": "very_large3",
+    "host": "tdt4225-44.idi.ntnu.no",
+    "user": "magnus",
+    "password": "magnus",
+    # connections per server in the pool of the shared client
+    "max_pool_size": "100",
+    # wire compression, in order of preference. Compressors whose package is not installed
+    # (zstandard for zstd, python-snappy for snappy) are skipped
+    "compressors": "zstd,snappy,zlib",
+    "connect_timeout_ms": "20000",
+    "server_selection_timeout_ms": "30000",
+    # no timeout on reads by default, some queries run for minutes
+    "socket_timeout_ms": "",
+    "read_preference": "primary",
+    # write concern, w is a number of nodes or 'majority'
+    "w": "1",
+    "journal": "",
+    "wtimeout_ms": "",
+}
+# the config file is DB_CONFIG, or db.ini in the working directory if it exists
+DEFAULT_CONFIG_FILE = "db.ini"
+COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+
+# the clients shared by all connectors with the same settings, with the number of open connectors
+_clients = {}
+_clients_lock = Lock()
+
+
+def load_settings(config_file=None, **overrides):
+    """
+    Connection settings from, in increasing priority: the defaults, the config file,
+    MONGO_* environment variables and the overrides that are not None
+    Return
+    ------
+    dict of str: str
+    """
+    settings = dict(DEFAULT_SETTINGS)
+    config_file = config_file or os.environ.get("DB_CONFIG") or DEFAULT_CONFIG_FILE
+    if os.path.exists(config_file):
+        config = configparser.ConfigParser()
+        config.read(config_file)
+        if config.has_section("mongodb"):
+            settings.update({name: value for name, value in config.items("mongodb") if name in DEFAULT_SETTINGS})
+    for name in DEFAULT_SETTINGS:
+        if "MONGO_" + name.upper() in os.environ:
+            settings[name] = os.environ["MONGO_" + name.upper()]
+    settings.update({name: str(value) for name, value in overrides.items() if value != None})
+    return settings
+
+
+def client_options(settings):
+    """
+    Keyword arguments of MongoClient for the settings
+    """
+    options = {
+        "maxPoolSize": int(settings["max_pool_size"]),
+        "connectTimeoutMS": int(settings["connect_timeout_ms"]),
+        "serverSelectionTimeoutMS": int(settings["server_selection_timeout_ms"]),
+        "readPreference": settings["read_preference"],
+        "w": int(settings["w"]) if settings["w"].isdigit() else settings["w"],
+        # connect on the first operation, not when the client is made
+        "connect": False,
+    }
+    compressors = [name.strip() for name in settings["compressors"].split(",")
+                   if name.strip() in COMPRESSOR_MODULES and importlib.util.find_spec(COMPRESSOR_MODULES[name.strip()])]
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+    if settings["socket_timeout_ms"]:
+        options["socketTimeoutMS"] = int(settings["socket_timeout_ms"])
+    if settings["journal"]:
+        options["journal"] = settings["journal"].lower() in ("1", "true", "yes")
+    if settings["wtimeout_ms"]:
+        options["wTimeoutMS"] = int(settings["wtimeout_ms"])
+    return options
+
+
 class DbConnector:
     """
     Connects to the MongoDB server on the Ubuntu virtual machine.
@@ -10,28 +94,64 @@ class DbConnector:
     HOST = "tdt4225-00.idi.ntnu.no" // Your server IP address/domain name
     USER = "testuser" // This is the user you created and added privileges for
     PASSWORD = "test123" // The password you set for said user
+    USER = "" connects without authentication, e.g. to a local mongod
+
+    Arguments left None are read with load_settings, from a db.ini file like
+        [mongodb]
+        host = tdt4225-44.idi.ntnu.no
+        user = magnus
+        password = magnus
+        max_pool_size = 50
+        compressors = zstd,zlib
+    or from MONGO_* environment variables. All connectors with the same settings in a
+    process share one pooled client, which connects on its first operation.
     """
 
     def __init__(self,
-                 DATABASE='very_large3',
-                 HOST="tdt4225-44.idi.ntnu.no",
-                 USER="magnus",
-                 PASSWORD="magnus"):
-        uri = "mongodb://%s:%s@%s/%s" % (USER, PASSWORD, HOST, DATABASE)
+                 DATABASE=None,
+                 HOST=None,
+                 USER=None,
+                 PASSWORD=None,
+                 config_file=None):
+        # set by _acquire_client, None while no shared client is held
+        self.client_key = None
+        self.settings = load_settings(config_file, database=DATABASE, host=HOST, user=USER, password=PASSWORD)
+        if self.settings["user"] == "":
+            uri = "mongodb://%s/%s" % (self.settings["host"], self.settings["database"])
+        else:
+            uri = "mongodb://%s:%s@%s/%s" % (self.settings["user"], self.settings["password"],
+                                             self.settings["host"], self.settings["database"])
         # Connect to the databases
         try:
-            self.client = MongoClient(uri)
-            self.db = self.client[DATABASE]
+            self.client = self._acquire_client(uri, client_options(self.settings))
+            self.db = self.client[self.settings["database"]]
+            # the client connects on its first operation, so a bad host or login only fails then
+            print("Using the database:", self.db.name)
+            print("-----------------------------------------------\n")
         except Exception as e:
             print("ERROR: Failed to connect to db:", e)
 
-        # get database information
-        print("You are connected to the database:", self.db.name)
-        print("-----------------------------------------------\n")
+    def _acquire_client(self, uri, options):
+        client_key = (uri, tuple(sorted(options.items())))
+        with _clients_lock:
+            if client_key not in _clients:
+                _clients[client_key] = [MongoClient(uri, **options), 0]
+            _clients[client_key][1] += 1
+            self.client_key = client_key
+            return _clients[client_key][0]
 
     def close_connection(self):
         # close the cursor
-        # close the DB connection
-        self.client.close()
+        # close the DB connection, once no other connector in the process uses the shared client
+        if self.client_key == None:
+            return
+        with _clients_lock:
+            entry = _clients.get(self.client_key)
+            if entry != None and entry[0] is self.client:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del _clients[self.client_key]
+                    self.client.close()
+            self.client_key = None
         print("\n-----------------------------------------------")
         print("Connection to %s-db is closed" % self.db.name)
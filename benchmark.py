@@ -0,0 +1,305 @@
+"""
+Benchmark of the eleven queries of main.Program at several dataset scale factors,
+see utils.queryCatalog.
+
+For every scale factor the dataset is scaled (see scale_dataset), loaded into its own
+database on a local mongod and indexed, and every query is then run repeatedly.
+The results are written as JSON, so the numbers of two versions can be compared:
+
+    python benchmark.py --scales 0.25 1 4 --repeat 10 --output results.json
+    python benchmark.py --scales 0.25 1 4 --reference results.json --output new.json
+
+Per query the report holds
+- latency percentiles (p50/p95/p99) over the timed runs
+- documents and index keys examined, from the execution stats the profiler records
+  for every command the query sends
+- the peak of the Python memory allocated by the client while running the query
+- a hash of the result, whether it equals the result in the reference report, and
+  for the queries with a second engine, whether both engines agree within REL_TOLERANCE
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import shutil
+import subprocess
+import tracemalloc
+from datetime import datetime
+from time import perf_counter
+
+import numpy as np
+
+from DbConnector import DbConnector
+from bucketedCrud import BucketedCrud
+from compactCrud import CompactCrud
+from partitionedCrud import PartitionedCrud
+from crud import Crud
+from utils.queryCatalog import QUERIES
+
+
+LAYOUTS = {"plain": Crud, "bucketed": BucketedCrud, "compact": CompactCrud, "partitioned": PartitionedCrud}
+
+# a second engine for the same answer, the summaries are checked against the trackpoints
+CROSS_CHECKS = {
+    7: lambda crud: sum(distance for [distance] in crud.get_total_distance(
+        group_by=(), user="112", transportation_mode="walk", year=2008, from_summaries=False)),
+    8: lambda crud: crud.get_n_users_with_most_elevation_gained(20, from_summaries=False),
+    9: lambda crud: crud.get_users_with_invalid_activities(from_summaries=False),
+}
+
+# floats are compared with this many decimals
+DECIMALS = 6
+# relative tolerance on the numbers of the cross checks, whose engines sum floats in other orders
+REL_TOLERANCE = 1e-6
+
+
+def scale_dataset(source, target, scale):
+    """
+    Make a dataset of scale times the users of the dataset at source. Every whole copy
+    links to all user dirs of the source, copy i > 0 under the user id "<id>_<i>", and
+    the fraction left links to that share of the users. Nothing is copied, the user
+    dirs are symbolic links.
+    Parameters
+    ----------
+    source: str
+        dir with Data and labeled_ids.txt
+    target: str
+        dir to create, replaced if it exists
+    scale: float
+    Return
+    ------
+    int: number of users in the scaled dataset
+    """
+    data = os.path.join(source, "Data")
+    users = sorted(entry.name for entry in os.scandir(data) if entry.is_dir())
+    with open(os.path.join(source, "labeled_ids.txt")) as f:
+        labeled = set(line.strip() for line in f if line.strip())
+
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.makedirs(os.path.join(target, "Data"))
+    n_users = max(1, round(len(users) * scale))
+    scaled_labeled = []
+    for i in range(n_users):
+        copy, user = divmod(i, len(users))
+        user_id = users[user] if copy == 0 else "%s_%d" % (users[user], copy)
+        os.symlink(os.path.abspath(os.path.join(data, users[user])), os.path.join(target, "Data", user_id))
+        if users[user] in labeled:
+            scaled_labeled.append(user_id)
+    with open(os.path.join(target, "labeled_ids.txt"), "w") as f:
+        f.write("".join(user_id + "\n" for user_id in scaled_labeled))
+    return n_users
+
+
+def load(crud, workers):
+    """
+    Load the dataset of crud into an empty database and build the indexes
+    Return
+    ------
+    float: seconds spent
+    """
+    start = perf_counter()
+    crud.drop_tables()
+    crud.create_collections()
+    crud.insert_users()
+    crud.insert_dataset(workers=workers, max_in_flight=4)
+    crud.create_indexes()
+    return perf_counter() - start
+
+
+def normalize(result):
+    """
+    The result as plain JSON types, with floats rounded to DECIMALS
+    """
+    if isinstance(result, float):
+        return round(result, DECIMALS)
+    if isinstance(result, (list, tuple)):
+        return [normalize(value) for value in result]
+    if isinstance(result, dict):
+        return {str(key): normalize(value) for key, value in result.items()}
+    if isinstance(result, (str, int, bool)) or result == None:
+        return result
+    return str(result)
+
+
+def result_hash(result):
+    return hashlib.sha1(json.dumps(normalize(result), sort_keys=True).encode()).hexdigest()
+
+
+def results_agree(result, other, rel_tol=REL_TOLERANCE):
+    """
+    Whether two results are the same, with numbers compared with a relative tolerance.
+    Rows are compared in the order of their other columns, as rows with nearly equal
+    numbers can come in either order
+    """
+    if isinstance(result, bool) or isinstance(other, bool):
+        return result == other
+    if isinstance(result, (int, float)) and isinstance(other, (int, float)):
+        return math.isclose(result, other, rel_tol=rel_tol, abs_tol=rel_tol)
+    if isinstance(result, (list, tuple)) and isinstance(other, (list, tuple)):
+        if len(result) != len(other):
+            return False
+        if all(isinstance(row, (list, tuple)) for row in list(result) + list(other)):
+            result, other = sorted(result, key=_row_order), sorted(other, key=_row_order)
+        return all(results_agree(value, other_value, rel_tol) for value, other_value in zip(result, other))
+    return normalize(result) == normalize(other)
+
+
+def _row_order(row):
+    return json.dumps([value for value in normalize(row) if not isinstance(value, (int, float))])
+
+
+def percentiles(latencies):
+    """
+    Return
+    ------
+    dict of str: float: latency statistics in milliseconds
+    """
+    latencies = np.array(latencies) * 1000
+    return {
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+        "p99": float(np.percentile(latencies, 99)),
+        "mean": float(latencies.mean()),
+        "min": float(latencies.min()),
+        "max": float(latencies.max()),
+    }
+
+
+def profile(crud, query):
+    """
+    Run query once with the profiler of the database on and the Python allocations traced
+    Return
+    ------
+    (object, dict): the result, and the documents and keys examined and the peak memory
+    """
+    db = crud.db
+    db.command("profile", 0)
+    db.system.profile.drop()
+    db.command("profile", 2)
+    tracemalloc.start()
+    try:
+        result = query(crud)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        db.command("profile", 0)
+    docs_examined = 0
+    keys_examined = 0
+    for operation in db.system.profile.find({"ns": {"$ne": db.name + ".system.profile"}}):
+        docs_examined += operation.get("docsExamined", 0)
+        keys_examined += operation.get("keysExamined", 0)
+    return result, {"docs_examined": docs_examined, "keys_examined": keys_examined, "peak_memory_bytes": peak}
+
+
+def run_query(crud, number, repeat, reference):
+    """
+    Benchmark one query
+    Parameters
+    ----------
+    reference: dict
+        the report of this query in the reference run, None if there is none
+    Return
+    ------
+    dict: the report of the query
+    """
+    query = QUERIES[number]
+    result, stats = profile(crud, query.run)
+    latencies = []
+    for _ in range(repeat):
+        start = perf_counter()
+        query.run(crud)
+        latencies.append(perf_counter() - start)
+
+    report = dict({"name": query.name, "latency_ms": percentiles(latencies)}, **stats)
+    report["result_hash"] = result_hash(result)
+    report["matches_reference"] = None if reference == None else report["result_hash"] == reference["result_hash"]
+    report["engines_agree"] = None
+    if number in CROSS_CHECKS:
+        report["engines_agree"] = results_agree(CROSS_CHECKS[number](crud), result)
+    return report
+
+
+def run_scale(args, scale, reference):
+    """
+    Scale, load and benchmark the dataset at one scale factor
+    Return
+    ------
+    dict: the report of the scale factor
+    """
+    dataset_path = os.path.join(args.workdir, "x%s" % scale)
+    n_users = scale_dataset(args.dataset, dataset_path, scale)
+    connection = DbConnector(DATABASE="%s_x%s" % (args.database, str(scale).replace(".", "_")),
+                             HOST=args.host, USER=args.user, PASSWORD=args.password)
+    crud = LAYOUTS[args.layout](connection=connection, dataset_path=dataset_path)
+    try:
+        load_s = None if args.skip_load else load(crud, args.workers)
+        [[_, n_activities, n_trackpoints]] = crud.get_number_of_rows()
+        report = {"scale": scale, "users": n_users, "activities": n_activities, "trackpoints": n_trackpoints,
+                  "load_s": load_s, "queries": {}}
+        for number in args.queries:
+            print("Scale %s, query %d..." % (scale, number))
+            query_reference = None if reference == None else reference["queries"].get(str(number))
+            report["queries"][str(number)] = run_query(crud, number, args.repeat, query_reference)
+        return report
+    finally:
+        connection.close_connection()
+
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the queries at several dataset scale factors")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1.0],
+                        help="scale factors of the number of users (default: 1)")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per query (default: 5)")
+    parser.add_argument("--queries", type=int, nargs="+", default=sorted(QUERIES), choices=sorted(QUERIES),
+                        help="queries to run (default: all)")
+    parser.add_argument("--layout", choices=sorted(LAYOUTS), default="plain", help="trackpoint layout")
+    parser.add_argument("--dataset", default="./dataset", help="dataset to scale (default: ./dataset)")
+    parser.add_argument("--workdir", default="./benchmark_data", help="where the scaled datasets are made")
+    parser.add_argument("--host", default="localhost:27017", help="local mongod (default: localhost:27017)")
+    parser.add_argument("--user", default="", help="empty for no authentication (default)")
+    parser.add_argument("--password", default=None)
+    parser.add_argument("--database", default="benchmark", help="prefix of the databases, one per scale")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="parser processes while loading")
+    parser.add_argument("--skip-load", action="store_true", help="benchmark the databases of an earlier run")
+    parser.add_argument("--reference", default=None, help="report of an earlier run to check the results against")
+    parser.add_argument("--output", default="benchmark.json", help="where to write the report")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    references = {}
+    if args.reference != None:
+        with open(args.reference) as f:
+            references = {scale["scale"]: scale for scale in json.load(f)["scales"]}
+
+    report = {"version": git_version(), "created": datetime.now().isoformat(timespec="seconds"),
+              "layout": args.layout, "repeat": args.repeat, "scales": []}
+    for scale in args.scales:
+        report["scales"].append(run_scale(args, scale, references.get(scale)))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for scale in report["scales"]:
+        print("Scale %s: %d users, %d activities, %d trackpoints" % (
+            scale["scale"], scale["users"], scale["activities"], scale["trackpoints"]))
+        for number, query in scale["queries"].items():
+            checks = [check for check in ("matches_reference", "engines_agree") if query[check] == False]
+            print("  %2s %-48s p50 %9.1f ms  p99 %9.1f ms  %12d docs  %s" % (
+                number, query["name"], query["latency_ms"]["p50"], query["latency_ms"]["p99"],
+                query["docs_examined"], "WRONG: " + ", ".join(checks) if checks else "ok"))
+    print("Report written to " + args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+from crud import Crud
+from utils.buckets import BUCKET_COLLECTION, DATE_DAYS_EPOCH, DEFAULT_BUCKET_SIZE, iter_activity_points, make_buckets
+from utils.chunks import DEFAULT_CHUNK_SIZE
+from utils.distance import haversine_km
+from utils.fileUtils import batch_documents, iter_trackpoints
+from utils.geoQueries import LOCATION_FIELD, radius_filter
+from utils.indexes import BUCKETED_INDEX_SPECS
+from utils.instrumentation import profiled_query
+from utils.queryCache import cached_query
+from datetime import timedelta
+from itertools import groupby
+import numpy as np
+
+
+class BucketedCrud(Crud):
+    """
+    Crud for the bucketed trackpoint layout, where the trackpoints of an activity are
+    stored as packed arrays in the trackpoint_bucket collection, at most BUCKET_SIZE
+    points per document, instead of as one document per trackpoint.
+    The queries and summaries that scan trackpoints read the buckets, the others are unchanged.
+    """
+    BUCKET_SIZE = DEFAULT_BUCKET_SIZE
+    INDEX_SPECS = BUCKETED_INDEX_SPECS
+    TRACKPOINT_COLLECTION = BUCKET_COLLECTION
+
+
+    def create_collections(self):
+        self.dbService.create_collection("user")
+        self.dbService.create_collection("activity")
+        self.dbService.create_collection(BUCKET_COLLECTION)
+
+
+    def insert_trackpoints(self, trackpoints=None, workers=1, batch_size=10000, batch_bytes=None):
+        if (trackpoints == None):
+            activities = groupby(iter_trackpoints(self._data_path(), self.ACTIVITY_ID_MAP, workers=workers),
+                                 key=lambda trackpoint: trackpoint["activity_id"])
+            self.dbService.insert_batches(
+                self._trackpoint_batches((list(points) for _, points in activities), batch_size, batch_bytes))
+            return
+        self.dbService.insert_trackpoint_buckets(trackpoints, bucket_size=self.BUCKET_SIZE)
+
+
+    def _trackpoint_batches(self, trackpoints, batch_size, batch_bytes):
+        buckets = (bucket for activity_trackpoints in trackpoints
+                   for bucket in make_buckets(activity_trackpoints, bucket_size=self.BUCKET_SIZE))
+        # batch_size counts trackpoints, so a batch holds about as many points as in the plain layout
+        for batch in batch_documents(buckets, batch_size=max(1, batch_size // self.BUCKET_SIZE), batch_bytes=batch_bytes):
+            yield BUCKET_COLLECTION, batch
+
+
+    def drop_tables(self):
+        try:
+            self.dbService.drop_collection(BUCKET_COLLECTION)
+        except Exception as e:
+            print("Could not delete table '%s'" % BUCKET_COLLECTION)
+        super().drop_tables()
+
+
+    def _iter_activity_points(self, query, fields):
+        """
+        Stream the points of the activities matching query, one activity at a time
+        Parameters
+        ----------
+        query: dict
+            filter on the bucket documents
+        fields: [str]
+            the point arrays to fetch
+        Return
+        ------
+        generator of (dict, dict of str: list): see utils.buckets.iter_activity_points
+        """
+        projection = dict({"_id": 0, "activity_id": 1, "user_id": 1}, **{field: 1 for field in fields})
+        buckets = self.db[BUCKET_COLLECTION].find(query, projection).sort([("activity_id", 1), ("seq", 1)])
+        return iter_activity_points(buckets)
+
+
+    @profiled_query
+    @cached_query("user", "activity", "trackpoint")
+    def get_number_of_rows(self):
+        n_trackpoints = 0
+        for total in self.db[BUCKET_COLLECTION].aggregate([{'$group': {'_id': None, 'n': {'$sum': '$n'}}}]):
+            n_trackpoints = total['n']
+        return [[self.db.user.count(), self.db.activity.count(), n_trackpoints]]
+
+
+    def _iter_chunks(self, query, fields, dtypes, with_user_ids=False, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Stream the points of the activities matching query as arrays, like utils.chunks.chunk_fields.
+        Whole activities are gathered until a chunk holds at least chunk_size points.
+        Parameters
+        ----------
+        query: dict
+            filter on the bucket documents
+        fields: [str]
+            the point arrays to fetch
+        dtypes: [numpy dtype]
+            dtype of the array of each field
+        with_user_ids: bool
+            add the user id of every point after the activity ids
+        Return
+        ------
+        generator of tuple of numpy.ndarray: the activity ids, the user ids with with_user_ids,
+        and the arrays of fields
+        """
+        def chunk(activity_ids, user_ids, columns):
+            keys = (np.array(activity_ids),) + ((np.array(user_ids),) if with_user_ids else ())
+            return keys + tuple(np.array(column, dtype=dtype) for column, dtype in zip(columns, dtypes))
+
+        activity_ids, user_ids, columns = [], [], [[] for _ in fields]
+        for activity, points in self._iter_activity_points(query, fields):
+            n_points = len(points[fields[0]])
+            activity_ids.extend([activity["activity_id"]] * n_points)
+            if with_user_ids:
+                user_ids.extend([activity["user_id"]] * n_points)
+            for column, field in zip(columns, fields):
+                column.extend(points[field])
+            if len(activity_ids) >= chunk_size:
+                yield chunk(activity_ids, user_ids, columns)
+                activity_ids, user_ids, columns = [], [], [[] for _ in fields]
+        if activity_ids:
+            yield chunk(activity_ids, user_ids, columns)
+
+
+    def _iter_point_chunks(self, activity_ids=None):
+        query = {} if activity_ids == None else {'activity_id': {'$in': activity_ids}}
+        return self._iter_chunks(query, ["latitude", "longitude"], [None, None])
+
+
+    def _iter_altitude_chunks(self):
+        return self._iter_chunks({}, ["altitude"], [np.int64], with_user_ids=True)
+
+
+    def _iter_time_chunks(self):
+        return self._iter_chunks({}, ["date_time"], ["datetime64[ms]"], with_user_ids=True)
+
+
+    def _iter_activity_columns(self):
+        for activity, points in self._iter_activity_points({}, ["latitude", "longitude", "altitude", "date_time"]):
+            yield activity["activity_id"], points
+
+
+    @profiled_query
+    @cached_query("trackpoint")
+    def _find_located(self, geo_filter, returns, limit):
+        """
+        Run a geospatial filter on the trackpoints in the buckets. The 2dsphere index on the
+        location array of the buckets finds the buckets with a matching point, which are then
+        unwound to their points on the server and matched with the same filter.
+        See Crud._find_located
+        """
+        near = geo_filter[LOCATION_FIELD].get('$near')
+        if near != None:
+            # $near can only be the first stage, find the points within the distance and sort them here
+            longitude, latitude = near['$geometry']['coordinates']
+            geo_filter = radius_filter(latitude, longitude, near['$maxDistance'])
+        pipeline = [
+            {'$match': geo_filter},
+            {'$project': {'_id': 0, 'activity_id': 1, 'user_id': 1, 'point': {'$zip': {
+                'inputs': ['$latitude', '$longitude', '$altitude', '$date_time']}}}},
+            {'$unwind': '$point'},
+            {'$project': {'activity_id': 1, 'user_id': 1,
+                          'latitude': {'$arrayElemAt': ['$point', 0]},
+                          'longitude': {'$arrayElemAt': ['$point', 1]},
+                          'altitude': {'$arrayElemAt': ['$point', 2]},
+                          'date_time': {'$arrayElemAt': ['$point', 3]}}},
+            # points out of range are not in the location array, and can not be matched
+            {'$match': {'latitude': {'$gte': -90, '$lte': 90}, 'longitude': {'$gte': -180, '$lte': 180}}},
+            {'$addFields': {LOCATION_FIELD: {'type': 'Point', 'coordinates': ['$longitude', '$latitude']}}},
+            {'$match': geo_filter},
+        ]
+        if returns == "users":
+            return [user['_id'] for user in self.db[BUCKET_COLLECTION].aggregate(
+                pipeline + [{'$group': {'_id': '$user_id'}}])]
+        if returns == "activities":
+            return [activity['_id'] for activity in self.db[BUCKET_COLLECTION].aggregate(
+                pipeline + [{'$group': {'_id': '$activity_id'}}])]
+        if returns == "points":
+            if limit and near == None:
+                pipeline.append({'$limit': limit})
+            points = list(self.db[BUCKET_COLLECTION].aggregate(pipeline))
+            for point in points:
+                point['date_days'] = (point['date_time'] - DATE_DAYS_EPOCH) / timedelta(days=1)
+            if near != None:
+                points.sort(key=lambda point: haversine_km(latitude, longitude, point['latitude'], point['longitude']))
+            return points[:limit] if limit else points
+        raise ValueError("returns must be 'users', 'activities' or 'points', not '%s'" % returns)
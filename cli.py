@@ -0,0 +1,233 @@
+"""
+Non-interactive entry point, for scripted loads and report runs:
+
+    python cli.py load --drop --workers 8
+    python cli.py load --bulk --drop
+    python cli.py cache --workers 8
+    python cli.py index
+    python cli.py --layout partitioned period 2008 --drop-only
+    python cli.py query all --format json --output report.json
+    python cli.py query 1 3 get_users_with_invalid_activities --format csv --output reports/
+
+The queries run at the same time on a thread pool over the one client of the Crud
+object, so a report of all queries takes about as long as the slowest of them.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime
+from time import perf_counter
+
+from pymongo import WriteConcern
+
+from DbConnector import DbConnector
+from bucketedCrud import BucketedCrud
+from compactCrud import CompactCrud
+from crud import Crud
+from partitionedCrud import PartitionedCrud
+from utils.queryCatalog import QUERIES, find_query
+
+
+LAYOUTS = {"plain": Crud, "bucketed": BucketedCrud, "compact": CompactCrud, "partitioned": PartitionedCrud}
+
+
+def load(crud, args):
+    start = perf_counter()
+    if args.bulk:
+        crud.bulk_load(reload=args.drop, workers=args.workers, batch_size=args.batch_size,
+                       max_in_flight=args.max_in_flight, use_cache=not args.no_cache,
+                       write_concern=WriteConcern(w=args.w, j=args.journal))
+        print("Loaded in %.1fs" % (perf_counter() - start))
+        return
+    if args.drop:
+        crud.drop_tables()
+        crud.create_collections()
+    crud.insert_users()
+    crud.insert_dataset(workers=args.workers, batch_size=args.batch_size, max_in_flight=args.max_in_flight,
+                        use_cache=not args.no_cache)
+    if not args.no_index:
+        crud.create_indexes()
+    print("Loaded in %.1fs" % (perf_counter() - start))
+
+
+def cache(crud, args):
+    start = perf_counter()
+    dataset_cache = crud.build_cache(workers=args.workers)
+    print("Cached %d activities in %s in %.1fs" % (len(dataset_cache), dataset_cache.cache_dir, perf_counter() - start))
+
+
+def index(crud, args):
+    created = crud.create_indexes()
+    print("Created %d indexes" % len(created))
+
+
+def period(crud, args):
+    if not isinstance(crud, PartitionedCrud):
+        raise SystemExit("period needs --layout partitioned")
+    start = perf_counter()
+    try:
+        if args.drop_only:
+            crud.drop_period(args.year, args.month)
+        else:
+            crud.reload_period(args.year, args.month, workers=args.workers, batch_size=args.batch_size,
+                               max_in_flight=args.max_in_flight)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    print("Done in %.1fs" % (perf_counter() - start))
+
+
+def run_query(crud, query):
+    """
+    Run one query and time it
+    Return
+    ------
+    dict: the report of the query, with its rows or its error
+    """
+    start = perf_counter()
+    report = {"number": query.number, "name": query.name, "headers": query.headers}
+    try:
+        report["rows"] = query.rows(query.run(crud))
+        report["error"] = None
+    except Exception as e:
+        report["rows"] = None
+        report["error"] = "%s: %s" % (type(e).__name__, e)
+    report["seconds"] = perf_counter() - start
+    return report
+
+
+def run_queries(crud, queries, workers):
+    """
+    Run the queries on a pool of workers threads
+    Return
+    ------
+    dict: the report of the run, with the reports of the queries in the given order
+    """
+    start = perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reports = list(executor.map(lambda query: run_query(crud, query), queries))
+    return {"created": datetime.now().isoformat(timespec="seconds"), "seconds": perf_counter() - start,
+            "queries": reports}
+
+
+def write_json(report, output, stdout):
+    text = json.dumps(report, indent=2, default=str)
+    if output == "-":
+        print(text, file=stdout)
+        return
+    with open(output, "w") as f:
+        f.write(text + "\n")
+
+
+def write_csv(report, output):
+    """
+    Write <number>_<name>.csv with the rows of every query and timings.csv to the dir output
+    """
+    os.makedirs(output, exist_ok=True)
+    for query in report["queries"]:
+        if query["rows"] == None:
+            continue
+        with open(os.path.join(output, "%d_%s.csv" % (query["number"], query["name"])), "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(query["headers"])
+            writer.writerows(query["rows"])
+    with open(os.path.join(output, "timings.csv"), "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["number", "name", "seconds", "rows", "error"])
+        for query in report["queries"]:
+            writer.writerow([query["number"], query["name"], round(query["seconds"], 6),
+                             None if query["rows"] == None else len(query["rows"]), query["error"]])
+        writer.writerow(["", "total", round(report["seconds"], 6), "", ""])
+
+
+def query(crud, args):
+    keys = [str(number) for number in sorted(QUERIES)] if args.queries == ["all"] else args.queries
+    try:
+        queries = [find_query(key) for key in keys]
+    except ValueError as e:
+        raise SystemExit(str(e))
+    crud.check_indexes()
+    report = run_queries(crud, queries, workers=args.threads or len(queries))
+    if args.format == "csv":
+        if args.output == "-":
+            raise SystemExit("--format csv needs --output DIR")
+        write_csv(report, args.output)
+    else:
+        write_json(report, args.output, args.stdout)
+
+    for query_report in report["queries"]:
+        print("%2d %-48s %8.3fs  %s" % (query_report["number"], query_report["name"], query_report["seconds"],
+                                       query_report["error"] or "%d rows" % len(query_report["rows"])))
+    print("Total %.3fs" % report["seconds"])
+    if any(query_report["error"] for query_report in report["queries"]):
+        sys.exit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load the dataset, build indexes and run queries")
+    parser.add_argument("--layout", choices=sorted(LAYOUTS), default="plain", help="trackpoint layout")
+    parser.add_argument("--dataset", default="./dataset", help="dir with Data and labeled_ids.txt")
+    parser.add_argument("--config", default=None, help="connection settings file, see DbConnector")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    load_parser = commands.add_parser("load", help="insert the users, activities and trackpoints of the dataset")
+    load_parser.add_argument("--drop", action="store_true", help="drop and create the collections first")
+    load_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="parser processes")
+    load_parser.add_argument("--batch-size", type=int, default=10000, help="documents per insert")
+    load_parser.add_argument("--max-in-flight", type=int, default=4, help="concurrent inserts")
+    load_parser.add_argument("--no-index", action="store_true", help="do not build the indexes after loading")
+    load_parser.add_argument("--bulk", action="store_true",
+                             help="bulk-load mode: indexes dropped and rebuilt, unordered writes with a relaxed "
+                                  "write concern, counts validated, see Crud.bulk_load")
+    load_parser.add_argument("--w", type=lambda w: int(w) if w.isdigit() else w, default=1,
+                             help="write concern of the bulk load (default: 1)")
+    load_parser.add_argument("--journal", action="store_true", help="wait on the journal for every bulk write")
+    load_parser.add_argument("--no-cache", action="store_true",
+                             help="read the trajectory files even if the dataset cache is fresh")
+    load_parser.set_defaults(run=load)
+
+    cache_parser = commands.add_parser("cache", help="parse the dataset into the binary cache that load reads")
+    cache_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="parser processes")
+    cache_parser.set_defaults(run=cache)
+
+    index_parser = commands.add_parser("index", help="build the missing indexes")
+    index_parser.set_defaults(run=index)
+
+    period_parser = commands.add_parser("period", help="drop and reload the activities of one period "
+                                                        "of the partitioned layout")
+    period_parser.add_argument("year", type=int)
+    period_parser.add_argument("--month", type=int, default=None, help="month, when partitioned by month")
+    period_parser.add_argument("--drop-only", action="store_true", help="drop the period without reloading it")
+    period_parser.add_argument("--workers", type=int, default=os.cpu_count(), help="parser processes")
+    period_parser.add_argument("--batch-size", type=int, default=10000, help="documents per insert")
+    period_parser.add_argument("--max-in-flight", type=int, default=4, help="concurrent inserts")
+    period_parser.set_defaults(run=period)
+
+    query_parser = commands.add_parser("query", help="run queries and write their results")
+    query_parser.add_argument("queries", nargs="+",
+                              help="query numbers (1-%d) or names, or 'all'" % len(QUERIES))
+    query_parser.add_argument("--format", choices=["json", "csv"], default="json")
+    query_parser.add_argument("--output", default="-", help="file for json, dir for csv (default: stdout)")
+    query_parser.add_argument("--threads", type=int, default=None,
+                              help="queries run at the same time (default: all of them)")
+    query_parser.set_defaults(run=query)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # progress goes to stderr, so results written to stdout can be piped
+    args.stdout = sys.stdout
+    with redirect_stdout(sys.stderr):
+        crud = LAYOUTS[args.layout](connection=DbConnector(config_file=args.config), dataset_path=args.dataset)
+        try:
+            args.run(crud, args)
+        finally:
+            crud.connection.close_connection()
+
+
+if __name__ == "__main__":
+    main()
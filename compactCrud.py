@@ -0,0 +1,133 @@
+from crud import Crud
+from utils.distance import DEFAULT_CHUNK_SIZE, chunk_points
+from utils.elevation import chunk_altitudes
+from utils.fileUtils import batch_documents, iter_trackpoints
+from utils.gaps import chunk_times
+from utils.indexes import COMPACT_INDEX_SPECS
+from utils.instrumentation import profiled_query
+from utils.queryCache import cached_query
+from utils.trackpointCodec import COMPACT_COLLECTION, decode, encode, encode_filter
+from itertools import chain, groupby
+
+
+class CompactCrud(Crud):
+    """
+    Crud for the compact trackpoint layout, where every trackpoint is a small document in
+    the trackpoint_compact collection with short keys, the time in epoch seconds, an int32
+    altitude and no user_id or date_days, see utils.trackpointCodec. The user of a
+    trackpoint is looked up through its activity.
+    Everything read from the collection is decoded to the trackpoints of objects.py, so
+    the queries and their results are the same as with the plain layout.
+    """
+    INDEX_SPECS = COMPACT_INDEX_SPECS
+    TRACKPOINT_COLLECTION = COMPACT_COLLECTION
+    # WiredTiger block compressor of the collection, None for the server default (snappy).
+    # zstd needs MongoDB 4.2 or later
+    BLOCK_COMPRESSOR = "zstd"
+
+
+    def create_collections(self):
+        self.dbService.create_collection("user")
+        self.dbService.create_collection("activity")
+        if self.BLOCK_COMPRESSOR == None:
+            self.dbService.create_collection(COMPACT_COLLECTION)
+        else:
+            self.dbService.create_collection(COMPACT_COLLECTION, storageEngine={
+                "wiredTiger": {"configString": "block_compressor=%s" % self.BLOCK_COMPRESSOR}})
+
+
+    def insert_trackpoints(self, trackpoints=None, workers=1, batch_size=10000, batch_bytes=None):
+        if (trackpoints == None):
+            trackpoints = iter_trackpoints(self._data_path(), self.ACTIVITY_ID_MAP, workers=workers)
+            self.dbService.insert_batches(self._trackpoint_batches([trackpoints], batch_size, batch_bytes))
+            return
+        self.dbService.insert_compact_trackpoints(trackpoints)
+
+
+    def _trackpoint_batches(self, trackpoints, batch_size, batch_bytes):
+        documents = (encode(trackpoint) for trackpoint in chain.from_iterable(trackpoints))
+        for batch in batch_documents(documents, batch_size=batch_size, batch_bytes=batch_bytes):
+            yield COMPACT_COLLECTION, batch
+
+
+    def drop_tables(self):
+        try:
+            self.dbService.drop_collection(COMPACT_COLLECTION)
+        except Exception as e:
+            print("Could not delete table '%s'" % COMPACT_COLLECTION)
+        super().drop_tables()
+
+
+    def _activity_users(self, activity_ids=None):
+        """
+        Return
+        ------
+        dict of int: str: the user id of every activity, or of the given ones
+        """
+        query = {} if activity_ids == None else {'_id': {'$in': list(activity_ids)}}
+        return {activity['_id']: activity['user_id'] for activity in self.db.activity.find(query, {'user_id': 1})}
+
+
+    def _iter_trackpoints(self, query, fields, user_ids=None):
+        """
+        Stream decoded trackpoints in (activity_id, date_time) order
+        Parameters
+        ----------
+        query: dict
+            filter on the compact documents
+        fields: [str]
+            the compact keys to fetch besides the activity id
+        user_ids: dict of int: str
+            user id of every activity, None to leave out user_id
+        Return
+        ------
+        generator of trackpoint dicts with the fields that were fetched
+        """
+        projection = dict({'_id': 0, 'a': 1}, **{field: 1 for field in fields})
+        documents = self.db[COMPACT_COLLECTION].find(query, projection).sort(
+            [('a', 1), ('t', 1)]).batch_size(DEFAULT_CHUNK_SIZE)
+        return (decode(document, user_ids) for document in documents)
+
+
+    @profiled_query
+    @cached_query("user", "activity", "trackpoint")
+    def get_number_of_rows(self):
+        return [[self.db.user.count(), self.db.activity.count(), self.db[COMPACT_COLLECTION].count()]]
+
+
+    def _iter_point_chunks(self, activity_ids=None):
+        query = {} if activity_ids == None else {'a': {'$in': activity_ids}}
+        return chunk_points(self._iter_trackpoints(query, ['l', 'p']), chunk_size=DEFAULT_CHUNK_SIZE)
+
+
+    def _iter_altitude_chunks(self):
+        return chunk_altitudes(self._iter_trackpoints({}, ['z'], self._activity_users()), chunk_size=DEFAULT_CHUNK_SIZE)
+
+
+    def _iter_time_chunks(self):
+        return chunk_times(self._iter_trackpoints({}, ['t'], self._activity_users()), chunk_size=DEFAULT_CHUNK_SIZE)
+
+
+    def _iter_activity_columns(self):
+        trackpoints = self._iter_trackpoints({}, ['l', 'p', 'z', 't'])
+        for activity_id, points in groupby(trackpoints, key=lambda trackpoint: trackpoint['activity_id']):
+            points = list(points)
+            yield activity_id, {field: [point[field] for point in points]
+                                for field in ('latitude', 'longitude', 'altitude', 'date_time')}
+
+
+    @profiled_query
+    @cached_query("activity", "trackpoint")
+    def _find_located(self, geo_filter, returns, limit):
+        # the 2dsphere index on the [longitude, latitude] pair serves the same geo filters
+        query = encode_filter(geo_filter)
+        if returns == "users":
+            activity_ids = self.db[COMPACT_COLLECTION].distinct("a", query)
+            return sorted(set(self._activity_users(activity_ids).values()))
+        if returns == "activities":
+            return self.db[COMPACT_COLLECTION].distinct("a", query)
+        if returns == "points":
+            documents = list(self.db[COMPACT_COLLECTION].find(query, {"_id": 0}, limit=limit or 0))
+            user_ids = self._activity_users(set(document["a"] for document in documents))
+            return [decode(document, user_ids) for document in documents]
+        raise ValueError("returns must be 'users', 'activities' or 'points', not '%s'" % returns)
@@ -1,25 +1,95 @@
 from DbConnector import DbConnector
 from utils.dbService import dbService
-from utils.fileUtils import read_activities, read_trackpoints, read_users
+from utils.distance import DEFAULT_CHUNK_SIZE, activity_distances, chunk_points
+from utils.elevation import chunk_altitudes, top_n, user_altitude_gains
+from utils.gaps import DEFAULT_MAX_GAP_MINUTES, activity_gaps, chunk_times, count_per_user
+from utils.geoQueries import box_filter, near_filter, polygon_filter, radius_filter
+from utils.labelIndex import NO_LABEL
+from utils.indexes import ACTIVITY_LOOKUP_INDEXES, INDEX_SPECS, create_indexes, mismatched_indexes, verify_indexes
+from utils.instrumentation import profiled_query
+from utils.queryCache import cached_query
+from utils.rollups import ROLLUP_COLLECTION
+from utils.summary import summarize_trackpoints
+from utils.fileUtils import (DEFAULT_LABEL_POLICY, batch_documents, build_cache, iter_activities_parallel,
+                             iter_trackpoints, iter_trajectory_file_infos, iter_user_trajectory_files, read_activities,
+                             read_users, set_activity_id)
 from tabulate import tabulate
-from haversine import haversine
-import re
+import os
+from datetime import datetime
+from functools import partial
+from itertools import chain, groupby
+from pymongo import UpdateOne, WriteConcern
 
 
 
 class Crud:
     ACTIVITY_ID = 0
     ACTIVITY_ID_MAP = {}
-
-
-    def __init__(self, deleteTables=False):
-        self.connection = DbConnector()
+    # how trajectories are matched against labels, see LabelIndex.POLICIES
+    LABEL_POLICY = DEFAULT_LABEL_POLICY
+    # secondary indexes the queries rely on, see utils.indexes
+    INDEX_SPECS = INDEX_SPECS
+    # the collection holding the trackpoints, which the queries depend on
+    TRACKPOINT_COLLECTION = "trackpoint"
+
+
+    def __init__(self, deleteTables=False, query_cache=None, connection=None, dataset_path="./dataset",
+                 profiler=None, check_indexes=False):
+        """
+        Parameters
+        ----------
+        deleteTables: bool
+            drop and create the collections
+        query_cache: utils.queryCache.QueryCache
+            cache for the query results, None to always run the queries
+        connection: DbConnector
+            connection to use, None to connect to the default database
+        dataset_path: str
+            directory with the Data directory and labeled_ids.txt of the dataset
+        profiler: utils.instrumentation.QueryProfiler
+            measures every query, None to not measure
+        check_indexes: bool
+            warn about missing indexes right away, see check_indexes. This is the first
+            operation on the connection, which otherwise connects on the first query
+        """
+        self.connection = connection if connection != None else DbConnector()
+        self.dataset_path = dataset_path
         self.client = self.connection.client
         self.db = self.connection.db
         self.dbService = dbService(connection=self.connection)
+        self.query_cache = query_cache
+        self.profiler = profiler
         if deleteTables:
             self.drop_tables()
             self.create_collections()
+        elif check_indexes:
+            self.check_indexes()
+
+
+    def _data_path(self):
+        return os.path.join(self.dataset_path, "Data")
+
+
+    def create_indexes(self):
+        """
+        Create the missing indexes in INDEX_SPECS. Run after loading, building indexes
+        over loaded data is faster than maintaining them during the load.
+        """
+        return create_indexes(self.db, self.INDEX_SPECS)
+
+
+    def check_indexes(self):
+        """
+        Warn about indexes in INDEX_SPECS that do not exist, or differ from their specification
+        """
+        missing = verify_indexes(self.db, self.INDEX_SPECS)
+        for collection_name in missing:
+            print("WARNING: Missing indexes on '%s': %s" % (collection_name, ", ".join(missing[collection_name])))
+        mismatched = mismatched_indexes(self.db, self.INDEX_SPECS)
+        for collection_name in mismatched:
+            print("WARNING: Indexes on '%s' differ from their specification, create_indexes rebuilds them: %s" % (
+                collection_name, ", ".join(mismatched[collection_name])))
+        return missing
 
 
     def create_collections(self):
@@ -30,22 +100,245 @@ class Crud:
 
     def insert_users(self, users=None):
         if (users == None):
-            users = read_users("./dataset/Data", "./dataset/labeled_ids.txt")
-        self.dbService.insert_users(users)
-
-
-    def insert_activities(self, activities=None):
+            users = read_users(self._data_path(), os.path.join(self.dataset_path, "labeled_ids.txt"))
+        # only insert new users, so the dataset can be loaded incrementally
+        existing = set(self.db.user.distinct("_id"))
+        users = [user for user in users if user["_id"] not in existing]
+        if users:
+            self.dbService.insert_users(users)
+        return len(users)
+
+
+    def insert_activities(self, activities=None, workers=1):
+        """
+        Insert activities. When reading from the dataset with workers > 1 the users are
+        parsed in a process pool of that size and inserted as each user finishes.
+        The files are not recorded in the ingestion manifest, use insert_dataset for
+        resumable and incremental loads. Read from the dataset, the files are only scanned for
+        the times of the activities, which then have no summary, see recompute_activity_summaries.
+        """
+        if (activities == None and workers > 1):
+            for user_id, user_activities, self.ACTIVITY_ID in iter_activities_parallel(
+                    self._data_path(), activity_id_map=self.ACTIVITY_ID_MAP, activity_id=self.ACTIVITY_ID, workers=workers,
+                    label_policy=self.LABEL_POLICY):
+                self.dbService.insert_activities({user_id: user_activities})
+            return
         if (activities == None):
-            [activities, self.ACTIVITY_ID_MAP, self.ACTIVITY_ID] = read_activities("./dataset/Data", activity_id_map=self.ACTIVITY_ID_MAP, activity_id=self.ACTIVITY_ID)
+            [activities, self.ACTIVITY_ID_MAP, self.ACTIVITY_ID] = read_activities(self._data_path(), activity_id_map=self.ACTIVITY_ID_MAP, activity_id=self.ACTIVITY_ID, label_policy=self.LABEL_POLICY)
         self.dbService.insert_activities(activities)
 
 
-    def insert_trackpoints(self, trackpoints=None):
+    def insert_trackpoints(self, trackpoints=None, workers=1, batch_size=10000, batch_bytes=None):
+        """
+        Insert trackpoints. When reading from the dataset the trackpoints are streamed from
+        the files into fixed-size batches, so memory use does not grow with the dataset.
+        With workers > 1 the users are parsed in a process pool of that size.
+        Like insert_activities this bypasses the ingestion manifest, see insert_dataset.
+        """
         if (trackpoints == None):
-            trackpoints = read_trackpoints("./dataset/Data", self.ACTIVITY_ID_MAP)
+            trackpoints = iter_trackpoints(self._data_path(), self.ACTIVITY_ID_MAP, workers=workers)
+            self.dbService.insert_trackpoint_batches(
+                batch_documents(trackpoints, batch_size=batch_size, batch_bytes=batch_bytes))
+            return
         self.dbService.insert_trackpoints(trackpoints)
 
 
+    def insert_dataset(self, workers=1, batch_size=10000, batch_bytes=None, max_in_flight=None, use_cache=True):
+        """
+        Insert activities and trackpoints from the dataset, reading every trajectory file once.
+        With max_in_flight set, the batches are written by the asyncio backend with that many
+        unordered inserts in flight, so parsing overlaps the round trips to the server.
+
+        Every file is recorded in the ingestion manifest with its size, mtime and activity id.
+        Files already loaded and unchanged are skipped, so this only ingests new or changed
+        trajectories, and after a crash it continues where the previous load stopped.
+
+        With use_cache the files are read from the cache written by build_cache, as long
+        as it is newer than the dataset.
+        """
+        manifest = self.dbService.fetch_manifest()
+        # a pending file was being loaded when the previous load stopped, remove what made it in
+        self.dbService.delete_activities([entry["activity_id"] for entry in manifest.values()
+                                          if entry["status"] == "pending" and entry["activity_id"] != None])
+        skip = {file_id: (entry["size"], entry["mtime"]) for file_id, entry in manifest.items() if entry["status"] == "done"}
+        self.ACTIVITY_ID = max([self.ACTIVITY_ID, self.dbService.get_max_activity_id() + 1] +
+                               [entry["activity_id"] + 1 for entry in manifest.values() if entry["activity_id"] != None])
+
+        batches = self._dataset_batches(manifest, skip, workers=workers, batch_size=batch_size, batch_bytes=batch_bytes,
+                                        use_cache=use_cache)
+        if max_in_flight != None:
+            return self.dbService.insert_batches_async(batches, max_in_flight=max_in_flight)
+        return self.dbService.insert_batches(batches)
+
+
+    def build_cache(self, workers=1):
+        """
+        Parse the dataset into the binary cache next to it, which insert_dataset then
+        reads instead of the trajectory files, see utils.datasetCache
+        """
+        return build_cache(self._data_path(), workers=workers, label_policy=self.LABEL_POLICY)
+
+
+    def bulk_load(self, reload=True, workers=1, batch_size=10000, max_in_flight=4, write_concern=None,
+                  use_cache=True):
+        """
+        Fastest safe way to load the dataset. With reload all collections are dropped and
+        loaded again, otherwise only new or changed files are loaded, and the secondary
+        indexes are dropped if there are any. The indexes the old documents of those files
+        are deleted with are kept, see ACTIVITY_LOOKUP_INDEXES. Documents are inserted
+        unordered with write_concern, by default acknowledged by the primary without
+        waiting on the journal, and the journal is flushed at the end. The missing indexes
+        are then built over the loaded data, and the counts are validated.
+        Return
+        ------
+        dict of str: int: number of inserted documents per collection
+        """
+        start = datetime.now()
+        if reload:
+            self.drop_tables()
+            self.create_collections()
+        elif self._files_to_load():
+            self.drop_secondary_indexes(keep=ACTIVITY_LOOKUP_INDEXES)
+        else:
+            print("No new, changed or pending files, the indexes are kept")
+        with self.dbService.bulk_writes(write_concern or WriteConcern(w=1, j=False)):
+            inserted = dict(user=self.insert_users())
+            inserted.update(self.insert_dataset(workers=workers, batch_size=batch_size, max_in_flight=max_in_flight,
+                                                use_cache=use_cache))
+        self.dbService.flush_journal()
+        self.create_indexes()
+        self.validate_counts(inserted if reload else None)
+        print("Bulk load done in %ss" % round((datetime.now() - start).total_seconds(), 1))
+        return inserted
+
+
+    def _files_to_load(self):
+        """
+        Whether insert_dataset has files to load: files that are new, changed since they were
+        loaded, or pending after a load that stopped. Only the file sizes and mtimes are read.
+        """
+        manifest = self.dbService.fetch_manifest()
+        if any(entry["status"] == "pending" for entry in manifest.values()):
+            return True
+        for file_info in iter_trajectory_file_infos(self._data_path()):
+            entry = manifest.get(file_info["_id"])
+            if entry == None or (entry["size"], entry["mtime"]) != (file_info["size"], file_info["mtime"]):
+                return True
+        return False
+
+
+    def drop_secondary_indexes(self, keep=()):
+        """
+        Drop the indexes in INDEX_SPECS, so a load does not maintain them
+        Parameters
+        ----------
+        keep: [str]
+            names of indexes to keep
+        """
+        for collection_name, specs in self.INDEX_SPECS.items():
+            existing = self.db[collection_name].index_information()
+            for spec in specs:
+                if spec["name"] in existing and spec["name"] not in keep:
+                    self.db[collection_name].drop_index(spec["name"])
+                    print("Dropped index %s.%s" % (collection_name, spec["name"]))
+
+
+    def validate_counts(self, inserted=None):
+        """
+        Check that the activity summaries count every trackpoint and the rollups every
+        activity, and with inserted, that the collections hold exactly what was inserted
+        Parameters
+        ----------
+        inserted: dict of str: int
+            number of inserted documents per collection of a load into empty collections
+        """
+        [[n_users, n_activities, n_trackpoints]] = self.get_number_of_rows()
+        errors = []
+        if inserted != None:
+            counts = dict({"user": n_users, "activity": n_activities}, **self._trackpoint_document_counts())
+            for collection_name, count in counts.items():
+                if inserted.get(collection_name, 0) != count:
+                    errors.append("%d documents inserted into %s, but it holds %d" % (
+                        inserted.get(collection_name, 0), collection_name, count))
+        summarized = sum(total['n'] for total in self.db.activity.aggregate(
+            [{'$group': {'_id': None, 'n': {'$sum': '$summary.n_trackpoints'}}}]))
+        if summarized != n_trackpoints:
+            errors.append("The activity summaries count %d trackpoints, but there are %d" % (summarized, n_trackpoints))
+        rolled_up = sum(user['count'] for user in self._rollups("user"))
+        if rolled_up != n_activities:
+            errors.append("The rollups count %d activities, but there are %d" % (rolled_up, n_activities))
+        if errors:
+            raise RuntimeError("Load validation failed: " + "; ".join(errors))
+        print("Validated %d users, %d activities and %d trackpoints" % (n_users, n_activities, n_trackpoints))
+
+
+    def _trackpoint_document_counts(self):
+        """
+        Return
+        ------
+        dict of str: int: number of documents in each collection holding trackpoints
+        """
+        return {self.TRACKPOINT_COLLECTION: self.db[self.TRACKPOINT_COLLECTION].count_documents({})}
+
+
+    def _dataset_batches(self, manifest, skip, workers, batch_size, batch_bytes, use_cache=True):
+        """
+        Batches to insert for the files that are not skipped, one user at a time. The user's
+        files are marked pending in the manifest before its batches, and done after them.
+        A changed file keeps its activity id, and its old documents are replaced. The manifest
+        writes and deletes are checkpoints, so they only run once every earlier write is done.
+        The activities are inserted with rolled_up False and added to the rollups in the same
+        checkpoint that marks their files done, so a load that stops in between leaves pending
+        activities the rollups do not count.
+        """
+        for user_id, trajectories in iter_user_trajectory_files(
+                self._data_path(), workers=workers, label_policy=self.LABEL_POLICY, skip=skip, use_cache=use_cache):
+            entries = []
+            stale_activity_ids = []
+            activities = []
+            trackpoints = []
+            for file_info, activity, activity_trackpoints in trajectories:
+                activity_id = manifest.get(file_info["_id"], {}).get("activity_id")
+                if activity_id != None:
+                    stale_activity_ids.append(activity_id)
+                if activity != None:
+                    if activity_id == None:
+                        activity_id = self.ACTIVITY_ID
+                        self.ACTIVITY_ID += 1
+                    set_activity_id(activity, activity_trackpoints, activity_id)
+                    activity["rolled_up"] = False
+                    activities.append(activity)
+                    trackpoints.append(activity_trackpoints)
+                else:
+                    activity_id = None
+                entries.append(dict(file_info, activity_id=activity_id, status="pending"))
+            if not entries:
+                continue
+
+            # checkpoints, so they run in order with the writes of the earlier users in async mode
+            yield None, partial(self.dbService.upsert_manifest_entries, entries)
+            yield None, partial(self.dbService.delete_activities, stale_activity_ids)
+            if activities:
+                yield "activity", activities
+            yield from self._trackpoint_batches(trackpoints, batch_size=batch_size, batch_bytes=batch_bytes)
+            yield None, partial(self.dbService.mark_manifest_done, [entry["_id"] for entry in entries], activities)
+
+
+    def _trackpoint_batches(self, trackpoints, batch_size, batch_bytes):
+        """
+        Batches to insert for the trackpoints of some activities
+        Parameters
+        ----------
+        trackpoints: list of list of trackpoint dicts
+            the trackpoints of each activity
+        Return
+        ------
+        generator of (str, list of dict): collection name and documents
+        """
+        for batch in batch_documents(chain.from_iterable(trackpoints), batch_size=batch_size, batch_bytes=batch_bytes):
+            yield "trackpoint", batch
+
+
     def drop_tables(self):
         try:
             self.dbService.drop_collection("trackpoint")
@@ -59,12 +352,22 @@ class Crud:
             self.dbService.drop_collection("user")
         except Exception as e:
             print("Could not delete table 'user'")
+        try:
+            self.dbService.drop_collection(ROLLUP_COLLECTION)
+        except Exception as e:
+            print("Could not delete table '%s'" % ROLLUP_COLLECTION)
+        try:
+            self.dbService.drop_collection(self.dbService.MANIFEST_COLLECTION)
+        except Exception as e:
+            print("Could not delete table '%s'" % self.dbService.MANIFEST_COLLECTION)
 
 
     def fetch_users(self):
         self.dbService.fetch_documents("user")
 
 
+    @profiled_query
+    @cached_query("user", "activity", "trackpoint")
     def get_number_of_rows(self):
         results = []
         results.append(self.db.user.count())
@@ -73,223 +376,363 @@ class Crud:
         return [results]
 
 
+    @profiled_query
+    @cached_query("user", ROLLUP_COLLECTION)
     def get_average_no_of_activities(self):
         n_users = self.db.user.count()
-        n_users_with_activities = len(self.db.activity.distinct("user_id"))
-        n_activities = self.db.activity.count()
+        n_users_with_activities = 0
+        n_activities = 0
+        for user in self._rollups("user"):
+            n_users_with_activities += 1
+            n_activities += user['count']
         return [round((n_activities /  n_users), 2), round((n_activities / n_users_with_activities), 2)]
 
 
+    @profiled_query
+    @cached_query(ROLLUP_COLLECTION)
     def most_active_users_limit_n(self, n):
-        top_n_users = self.db.activity.aggregate([{'$sortByCount': '$user_id'}, {'$limit': n}])
-        return [[line['_id'], line['count']] for line in top_n_users]
+        top_n_users = self._rollups("user").sort([('count', -1), ('user_id', 1)]).limit(n)
+        return [[line['user_id'], line['count']] for line in top_n_users]
 
 
+    @profiled_query
+    @cached_query("activity")
     def find_users_on_transportation_mode(self, transportationMode):
         users_with_taxi = self.db.activity.find(
         {'transportation_mode': 'taxi'}, {'user_id': 1}).distinct("user_id")
         return [[user] for user in users_with_taxi]
 
 
+    @profiled_query
+    @cached_query(ROLLUP_COLLECTION)
     def get_all_transportation_modes_and_their_count(self):
-        transports = self.db.activity.aggregate([{'$match': {'transportation_mode': {'$not': {'$eq': '-'}}}}, {'$sortByCount': '$transportation_mode'}]) 
-        return [[line['_id'], line['count']] for line in transports]
+        transports = self._rollups("mode", {'transportation_mode': {'$ne': NO_LABEL}}).sort(
+            [('count', -1), ('transportation_mode', 1)])
+        return [[line['transportation_mode'], line['count']] for line in transports]
 
 
+    @profiled_query
+    @cached_query(ROLLUP_COLLECTION)
     def get_year_with_most_activities(self):
-        most_activities = self.db.activity.aggregate(
-            [
-                {'$group': 
-                    { '_id' : 
-                        {'year': 
-                            {'$substr': 
-                                ['$start_date_time', 0, 4]
-                            }
-                        }, 
-                    'count': 
-                        {'$sum': 1}
-                    }
-                }, 
-                {'$sort': 
-                    {'count': -1}
-                }, 
-                {'$limit': 1}
-            ]
-        )
-        for year in most_activities:
-            return [year['_id']['year'], str(year['count'])]
-        
+        for year in self._rollups("year").sort([('count', -1), ('year', 1)]).limit(1):
+            return [str(year['year']), str(year['count'])]
 
 
+    @profiled_query
+    @cached_query(ROLLUP_COLLECTION)
     def get_year_with_most_hours(self):
-        most_hours = self.db.activity.aggregate(
-            [
-                {'$group': 
-                    {'_id': 
-                        {'year': 
-                            {'$substr': 
-                                ['$start_date_time', 0, 4]
-                            }
-                        }, 
-                    'count': 
-                        {'$sum':
-                            {'$dateDiff': 
-                                {
-                                    'startDate': '$start_date_time', 
-                                    'endDate': '$end_date_time', 
-                                    'unit': 'hour'
-                                }
-                            }
-                        }
-                    }
-                }, 
-                {'$sort': 
-                    {'count': -1}
-                }, 
-                {'$limit': 1}
-            ]
-        )
-        for year in most_hours:
-            return [year['_id']['year'], str(year['count'])]
+        # hours counted as $dateDiff with unit 'hour' counts them, see utils.rollups
+        for year in self._rollups("year").sort([('hours', -1), ('year', 1)]).limit(1):
+            return [str(year['year']), str(year['hours'])]
+
+
+    def _rollups(self, grain, query=None):
+        """
+        Rollup documents of a grain that count at least one activity
+        Return
+        ------
+        pymongo.cursor.Cursor
+        """
+        return self.db[ROLLUP_COLLECTION].find(dict({'grain': grain, 'count': {'$gt': 0}}, **(query or {})))
+
+
+    def rebuild_rollups(self):
+        """
+        Compute the rollups again from the activities, e.g. for data loaded before
+        rollups were maintained at ingest. Every activity is counted afterwards, so the
+        rolled_up flags of pending activities are removed too
+        """
+        self.dbService.drop_collection(ROLLUP_COLLECTION)
+        activities = self.db.activity.find(
+            {}, {'_id': 0, 'user_id': 1, 'transportation_mode': 1, 'start_date_time': 1, 'end_date_time': 1})
+        self.dbService.update_rollups(activities)
+        self.db.activity.update_many({'rolled_up': False}, {'$unset': {'rolled_up': ''}})
+        # dropping the collection dropped its indexes
+        create_indexes(self.db, {ROLLUP_COLLECTION: self.INDEX_SPECS[ROLLUP_COLLECTION]})
+        print("Rebuilt the rollups of %d activities" % self.db.activity.count_documents({}))
 
 
     def get_distance_walked_in_year_by_user(self, year, user):
-        # get all walking activities by user in year
-        activities = list(self.db.activity.aggregate(
-            [
-                {'$project':
-                    {
-                        '_id': 1,
-                        'transportation_mode': 1,
-                        'user_id': 1,
-                        'year': {'$year': '$start_date_time'},
-                }
-                },
-                {'$match':
-                    {
-                        'transportation_mode': 'walk',
-                        'user_id': user,
-                        'year': year
-                }
-                },
-            ]
-        ))
-
-        trackpoints = self.db.trackpoint.find(
-            {'date_time': re.compile('^(2008)(.*)'), 'activity_id': {'$in': activities}}, {'lat': 1, 'lon': 1, 'activity_id': 1})
-
-        distance = 0
-        for i in range(trackpoints.count() - 1):
-            # Check if the trackpoints is in the same activity
-            print(i)
-            print(trackpoints[i])
-            if (trackpoints[i]['activity_id'] == trackpoints[i + 1]['activity_id']):
-                print("jfh")
-                # Haversine calculate distance between latitude longitude pairs
-                from_tuple = (trackpoints[i]['latitude'], trackpoints[i]['longitude'])
-                to_tuple = (trackpoints[i+i]['latitude'],
-                            trackpoints[i+1]['longitude'])
-                dist = haversine(from_tuple, to_tuple)
-                distance += dist
-        return distance
+        distances = self.get_total_distance(group_by=(), user=user, transportation_mode='walk', year=year)
+        return distances[0][0] if distances else 0
+
+
+    @profiled_query
+    @cached_query("activity", "trackpoint")
+    def get_total_distance(self, group_by=("user_id",), user=None, transportation_mode=None, year=None,
+                           from_summaries=True):
+        """
+        Total distance in km travelled in the activities matching the filters, grouped by any
+        combination of user_id, transportation_mode and year.
+        By default this sums the distances in the activity summaries on the server. Otherwise,
+        or when some matching activities have no summary, the trackpoints of all matching activities are streamed once in (activity_id, date_time)
+        order, and the haversine distances are computed with numpy over large chunks of points.
+        Parameters
+        ----------
+        group_by: tuple of str
+            any of "user_id", "transportation_mode" and "year", () for one total
+        user, transportation_mode, year:
+            only count activities of this user, mode and start year, None for all
+        from_summaries: bool
+            use the activity summaries instead of the trackpoints
+        Return
+        ------
+        list of [*group_by values, float]: sorted on the group values
+        """
+        for field in group_by:
+            if field not in ("user_id", "transportation_mode", "year"):
+                raise ValueError("Can not group distances by '%s'" % field)
+        query = self._activity_query(user=user, transportation_mode=transportation_mode, year=year)
+        if from_summaries and not self._summaries_missing(query):
+            group_fields = {'user_id': '$user_id', 'transportation_mode': '$transportation_mode',
+                            'year': {'$year': '$start_date_time'}}
+            distances = self.db.activity.aggregate([
+                {'$match': query},
+                {'$group': {
+                    '_id': {field: group_fields[field] for field in group_by},
+                    'distance': {'$sum': '$summary.distance_km'}
+                }}
+            ])
+            return sorted([distance['_id'][field] for field in group_by] + [distance['distance']] for distance in distances)
+
+        activity_groups = {}
+        for activity in self.db.activity.find(query, {'_id': 1, 'user_id': 1, 'transportation_mode': 1, 'start_date_time': 1}):
+            activity['year'] = activity['start_date_time'].year
+            activity_groups[activity['_id']] = tuple(activity[field] for field in group_by)
+
+        # only filter the trackpoints when the activities are filtered
+        activity_ids = list(activity_groups) if query else None
+        distances = {}
+        for activity_id, distance in activity_distances(self._iter_point_chunks(activity_ids)).items():
+            group = activity_groups.get(activity_id)
+            if group != None:
+                distances[group] = distances.get(group, 0.0) + distance
+        return [list(group) + [distances[group]] for group in sorted(distances)]
+
+
+    def _summaries_missing(self, query=None):
+        """
+        Whether some activities matching query have no summary, e.g. when they were loaded
+        before summaries were stored at ingest. The queries then read the trackpoints.
+        """
+        if self.db.activity.find_one(dict(query or {}, summary={'$exists': False}), {'_id': 1}) == None:
+            return False
+        print("WARNING: Some activities have no summary, the trackpoints are read instead. "
+              "Run recompute_activity_summaries to store the summaries")
+        return True
+
+
+    def _activity_query(self, user=None, transportation_mode=None, year=None):
+        query = {}
+        if user != None:
+            query['user_id'] = user
+        if year != None:
+            query['start_date_time'] = {'$gte': datetime(year, 1, 1), '$lt': datetime(year + 1, 1, 1)}
+        if transportation_mode != None:
+            query['transportation_mode'] = transportation_mode
+        return query
+
+
+    def _iter_point_chunks(self, activity_ids=None):
+        """
+        Stream the positions of the trackpoints of some activities in (activity_id, date_time) order
+        Parameters
+        ----------
+        activity_ids: [int]
+            the activities to read, None for all
+        Return
+        ------
+        generator of arrays, see utils.distance.chunk_points
+        """
+        query = {} if activity_ids == None else {'activity_id': {'$in': activity_ids}}
+        trackpoints = self._find_trackpoints(query, {'_id': 0, 'activity_id': 1, 'latitude': 1, 'longitude': 1})
+        return chunk_points(trackpoints, chunk_size=DEFAULT_CHUNK_SIZE)
 
         
-    def get_n_users_with_most_elevation_gained(self, n):
-        users_altitudes = self.db.trackpoint.aggregate([
-                {'$match': {'altitude': {'$gt': -777}}},
-                {'$lookup': {'localField': 'activity_id',
-                            'from': 'activity',
-                            'foreignField': '_id',
-                            'as': 'activityInfo'
-                            }},
-                {'$unwind': '$activityInfo'},
-                {'$project': {'_id': 0,
-                            'altitude': 1,
-                            'activityInfo.user_id': 1
-                            }},
-            ], allowDiskUse=True)
-
-        total_altitude_user = {}
-
-        for user_altitude in users_altitudes:
-
-            user = user_altitude['activityInfo']['user_id']
-            altitude = user_altitude['altitude']
-
-            if user in total_altitude_user.keys():
-                comp_altitude = total_altitude_user[user][1]
-                if altitude > comp_altitude:
-                    old_total = total_altitude_user[user][0]
-                    new_total = old_total + (altitude-comp_altitude)
-                    total_altitude_user[user][0] = new_total
-                total_altitude_user[user][1] = altitude
-
-            else:
-                total_altitude_user[user] = [0, altitude]
-
-        sorted_user_total_altitude = {k: v for k, v in sorted(
-            total_altitude_user.items(), key=lambda item: item[1][0])}
-        top_20 = sorted_user_total_altitude[:20]
-        return [[user, total_altitude_user[user][0]] for user in top_20]
-
-     
-    def get_users_with_invalid_activities(self):
-        invalid_activities_per_user = {}
-
-        trackpoints_for_activity = self.db.trackpoint.aggregate([
-            {'$group': {
-                '_id': '$activity_id',
-                'datetimes': {'$push': '$date_days'}}
-            }], allowDiskUse=True)
-
-        current_trackpoint = None
-        last_trackpoint = None
-        try: 
-            iterations = 0
-            while iterations < self.db.trackpoint.count():
-                if last_trackpoint == None:
-                    current_trackpoint = trackpoints_for_activity.next()
-                    last_trackpoint = current_trackpoint
-                else:
-                    current_time = current_trackpoint['date_days']
-                    current_activity = current_trackpoint['activity_id']
-                    last_time = last_trackpoint['date_days']
-                    last_activity = last_trackpoint['activity_id']
-
-                    if current_activity == last_activity and current_time - last_time >= 5 * 60:
-                        try:
-                            invalid_activities_per_user[current_trackpoint['user_id']] += 1
-                        except KeyError:
-                            invalid_activities_per_user[current_trackpoint['user_id']] = 1
-                last_trackpoint = current_trackpoint
-                current_trackpoint = trackpoints_for_activity.next()
-                iterations += 1
-        except StopIteration as e:
-            pass
-        return invalid_activities_per_user
-            
-
+    def _find_trackpoints(self, query, projection):
+        """
+        Stream the trackpoints matching query in (activity_id, date_time) order
+        Return
+        ------
+        iterable of trackpoint dicts with the fields in projection
+        """
+        return self.db.trackpoint.find(query, projection).sort(
+            [('activity_id', 1), ('date_time', 1)]).batch_size(DEFAULT_CHUNK_SIZE)
+
+
+    @profiled_query
+    @cached_query("activity", "trackpoint")
+    def get_n_users_with_most_elevation_gained(self, n, from_summaries=True):
+        """
+        The n users with the largest total altitude gain in feet over all their activities.
+        By default this sums the gains in the activity summaries on the server. Otherwise, or
+        when some activities have no summary, the trackpoints are streamed once in (activity_id, date_time) order, climbs are summed per
+        user with numpy over large chunks, and the top n are picked with a heap.
+        Return
+        ------
+        list of [str, int]: user id and altitude gain, largest first
+        """
+        if not from_summaries or self._summaries_missing():
+            return top_n(user_altitude_gains(self._iter_altitude_chunks()), n)
+        users_altitudes = self.db.activity.aggregate([
+            {'$group': {'_id': '$user_id', 'altitude_gain': {'$sum': '$summary.altitude_gain'}}},
+            # users with the same gain on user id, like top_n, so both engines pick the same users
+            {'$sort': {'altitude_gain': -1, '_id': 1}},
+            {'$limit': n}
+        ])
+        return [[user_altitude['_id'], user_altitude['altitude_gain']] for user_altitude in users_altitudes]
+
+
+    def _iter_altitude_chunks(self):
+        """
+        Stream the altitudes of all trackpoints in (activity_id, date_time) order
+        Return
+        ------
+        generator of arrays, see utils.elevation.chunk_altitudes
+        """
+        trackpoints = self._find_trackpoints({}, {'_id': 0, 'activity_id': 1, 'user_id': 1, 'altitude': 1})
+        return chunk_altitudes(trackpoints, chunk_size=DEFAULT_CHUNK_SIZE)
+
+
+    @profiled_query
+    @cached_query("activity", "trackpoint")
+    def get_users_with_invalid_activities(self, max_gap_minutes=DEFAULT_MAX_GAP_MINUTES, from_summaries=True):
+        """
+        Number of invalid activities per user, i.e. activities with two consecutive trackpoints
+        at least max_gap_minutes apart. By default this reads the largest gap in the activity
+        summaries, otherwise, or when some activities have no summary, the trackpoints are
+        scanned with get_activity_gaps.
+        Return
+        ------
+        list of [str, int]: user id and number of invalid activities, sorted on user id
+        """
+        if not from_summaries or self._summaries_missing():
+            return count_per_user(self.get_activity_gaps(max_gap_minutes))
+        invalid_activities_per_user = self.db.activity.aggregate([
+            {'$match': {'summary.max_gap_s': {'$gte': max_gap_minutes * 60}}},
+            {'$group': {'_id': '$user_id', 'count': {'$sum': 1}}},
+            {'$sort': {'_id': 1}}
+        ])
+        return [[user['_id'], user['count']] for user in invalid_activities_per_user]
+
+
+    @profiled_query
+    @cached_query("trackpoint")
+    def get_activity_gaps(self, max_gap_minutes=DEFAULT_MAX_GAP_MINUTES):
+        """
+        Every gap of at least max_gap_minutes between consecutive trackpoints of an activity.
+        The trackpoints are streamed once in (activity_id, date_time) order and the gaps
+        are found with numpy over large chunks of points.
+        Return
+        ------
+        dict of int: dict: the gaps per invalid activity, see utils.gaps.activity_gaps
+        """
+        return activity_gaps(self._iter_time_chunks(), max_gap_minutes)
+
+
+    def _iter_time_chunks(self):
+        """
+        Stream the times of all trackpoints in (activity_id, date_time) order
+        Return
+        ------
+        generator of arrays, see utils.gaps.chunk_times
+        """
+        trackpoints = self._find_trackpoints({}, {'_id': 0, 'activity_id': 1, 'user_id': 1, 'date_time': 1})
+        return chunk_times(trackpoints, chunk_size=DEFAULT_CHUNK_SIZE)
+
+
+    def recompute_activity_summaries(self, batch_size=1000):
+        """
+        Compute the summary of every activity again from its trackpoints,
+        e.g. for data loaded before summaries were stored at ingest
+        Return
+        ------
+        int: number of updated activities
+        """
+        updates = []
+        n_updated = 0
+        for activity_id, columns in self._iter_activity_columns():
+            updates.append(UpdateOne({'_id': activity_id}, {'$set': {'summary': summarize_trackpoints(
+                columns['latitude'], columns['longitude'], columns['altitude'], columns['date_time'])}}))
+            if len(updates) >= batch_size:
+                n_updated += self.db.activity.bulk_write(updates, ordered=False).modified_count
+                updates = []
+        if updates:
+            n_updated += self.db.activity.bulk_write(updates, ordered=False).modified_count
+        self.dbService.bump_write_versions(["activity"])
+        print(f"Recomputed the summary of {n_updated} activities")
+        return n_updated
+
+
+    def _iter_activity_columns(self):
+        """
+        Stream the trackpoints of every activity in time order, one activity at a time
+        Return
+        ------
+        generator of (int, dict of str: list): activity id and its latitude, longitude, altitude and date_time
+        """
+        trackpoints = self._find_trackpoints({}, {'_id': 0, 'activity_id': 1, 'latitude': 1, 'longitude': 1, 'altitude': 1, 'date_time': 1})
+        for activity_id, points in groupby(trackpoints, key=lambda trackpoint: trackpoint['activity_id']):
+            points = list(points)
+            yield activity_id, {field: [point[field] for point in points]
+                                for field in ('latitude', 'longitude', 'altitude', 'date_time')}
+
+
+    @profiled_query
+    @cached_query("trackpoint")
     def get_users_with_activities_in_forbidden_city(self):
-        # query = 'SELECT DISTINCT activity_id FROM trackpoint WHERE lat LIKE "39.916%" AND lon LIKE "116.397%"'
-        trackpoints_for_act = self.db.trackpoint.aggregate([
-            {'$project': {
-                'activity_id': 1,
-                'latitude': {'$round': ['$latitude', 3]},
-                'longitude': {'$round': ['$longitude', 3]},
-                'user_id': 1,
-            }},
-            {'$match': {
-                'latitude': 39.916,
-                'longitude': 116.397}
-            },
-            {'$group': {
-                '_id': '$user_id',
-            }
-            }
-        ], allowDiskUse=True)
-        return [trackpoint['_id'] for trackpoint in trackpoints_for_act]
-
-
+        # latitude and longitude rounded to 3 decimals equal 39.916 and 116.397
+        return [[user] for user in sorted(self.find_in_box(39.9155, 116.3965, 39.9165, 116.3975, returns="users"))]
+
+
+    def find_near(self, latitude, longitude, radius_m, returns="users", limit=None):
+        """
+        Find what has been within radius_m meters of a coordinate.
+        With returns="points" the trackpoints come nearest first.
+        """
+        if returns == "points":
+            return self._find_located(near_filter(latitude, longitude, radius_m), returns, limit)
+        return self._find_located(radius_filter(latitude, longitude, radius_m), returns, limit)
+
+
+    def find_in_box(self, min_latitude, min_longitude, max_latitude, max_longitude, returns="users", limit=None):
+        """
+        Find what has been inside a latitude/longitude bounding box
+        """
+        return self._find_located(box_filter(min_latitude, min_longitude, max_latitude, max_longitude), returns, limit)
+
+
+    def find_in_polygon(self, coordinates, returns="users", limit=None):
+        """
+        Find what has been inside a polygon given as a list of (latitude, longitude) corners
+        """
+        return self._find_located(polygon_filter(coordinates), returns, limit)
+
+
+    @profiled_query
+    @cached_query("trackpoint")
+    def _find_located(self, geo_filter, returns, limit):
+        """
+        Run a geospatial filter on the trackpoints, served by the 2dsphere index on location
+        Parameters
+        ----------
+        returns: str
+            "users" or "activities" for the distinct user or activity ids,
+            "points" for the trackpoints themselves
+        limit: int
+            max number of trackpoints, only used with returns="points"
+        """
+        if returns == "users":
+            return self.db.trackpoint.distinct("user_id", geo_filter)
+        if returns == "activities":
+            return self.db.trackpoint.distinct("activity_id", geo_filter)
+        if returns == "points":
+            return list(self.db.trackpoint.find(geo_filter, {"_id": 0}, limit=limit or 0))
+        raise ValueError("returns must be 'users', 'activities' or 'points', not '%s'" % returns)
+
+
+    @profiled_query
+    @cached_query("activity")
     def get_most_frequent_transportation_mode_per_user(self):
         most_frequent= self.db.activity.aggregate([
             {'$group': {
@@ -304,7 +747,7 @@ class Crud:
             }},
             {'$sort': {'_id': 1}}
         ], allowDiskUse=True)
-        return [[frequent['_d'], frequent['transportation_mode']] for frequent in most_frequent]
+        return [[frequent['_id'], frequent['transportation_mode']] for frequent in most_frequent]
 
 
     # def _find_highest_activity_id(self):
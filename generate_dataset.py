@@ -0,0 +1,242 @@
+"""
+Deterministic generator of synthetic Geolife datasets, for load testing and capacity planning.
+
+Writes a dataset in the layout and formats utils.fileUtils reads:
+
+    <output>/Data/<user>/Trajectory/<YYYYMMDDHHMMSS>.plt
+    <output>/Data/<user>/labels.txt      (labeled users only)
+    <output>/labeled_ids.txt
+
+Every user is generated from its own random stream seeded with (seed, user number), so the
+same arguments give the same files whatever the number of worker processes:
+
+    python generate_dataset.py --output ./synthetic --users 18200 --workers 16
+"""
+import argparse
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from utils.buckets import DATE_DAYS_EPOCH
+from utils.labelIndex import LABEL_DATE_FORMAT_STRING
+from utils.summary import MISSING_ALTITUDE
+
+
+PLT_HEADER = "Geolife trajectory\nWGS 84\nAltitude is in Feet\nReserved 3\n0,2,255,My Track,0,0,2,8421376\n0\n"
+LABELS_HEADER = "Start Time\tEnd Time\tTransportation Mode\n"
+TRANSPORTATION_MODES = ["airplane", "bike", "boat", "bus", "car", "run", "subway", "taxi", "train", "walk"]
+# typical speed in m/s of every transportation mode, unlabeled trajectories move at walking speed
+SPEEDS = {"airplane": 200, "bike": 5, "boat": 8, "bus": 10, "car": 15, "run": 3, "subway": 15, "taxi": 12,
+          "train": 25, "walk": 1.4}
+KM_PER_DEGREE = 111.32
+
+
+class DatasetSpec:
+    """
+    Shape of a synthetic dataset
+    """
+
+    def __init__(self, users=182, trajectories=(10, 200), points=(50, 2500), labeled_users=0.4,
+                 label_coverage=0.6, center=(39.9, 116.4), spread_km=30, start=datetime(2007, 4, 1),
+                 days=1500, missing_altitude=0.05, gap_probability=0.0005, seed=0):
+        """
+        Parameters
+        ----------
+        users: int
+        trajectories: (int, int)
+            min and max number of trajectories per user
+        points: (int, int)
+            min and max number of trackpoints per trajectory. Trajectories of more
+            than 2500 points are rejected when loading
+        labeled_users: float
+            share of the users with a labels.txt
+        label_coverage: float
+            share of the trajectories of a labeled user that have a label
+        center: (float, float)
+            latitude and longitude the trajectories start around
+        spread_km: float
+            trajectories start at most this far from center, in both directions
+        start: datetime
+            time of the first trajectories
+        days: int
+            the trajectories of a user are spread over this many days
+        missing_altitude: float
+            share of the trackpoints with altitude -777
+        gap_probability: float
+            chance that the next trackpoint comes more than 5 minutes later
+        seed: int
+        """
+        self.users = users
+        self.trajectories = trajectories
+        self.points = points
+        self.labeled_users = labeled_users
+        self.label_coverage = label_coverage
+        self.center = center
+        self.spread_km = spread_km
+        self.start = start
+        self.days = days
+        self.missing_altitude = missing_altitude
+        self.gap_probability = gap_probability
+        self.seed = seed
+
+    def user_id(self, user):
+        return str(user).zfill(max(3, len(str(self.users - 1))))
+
+
+def generate_dataset(output, spec, workers=1):
+    """
+    Write the dataset described by spec to output, which is replaced if it exists
+    Return
+    ------
+    (int, int): number of trajectories and trackpoints written
+    """
+    if os.path.exists(output):
+        shutil.rmtree(output)
+    os.makedirs(os.path.join(output, "Data"))
+
+    n_trajectories = 0
+    n_trackpoints = 0
+    labeled = []
+    tasks = [(output, spec, user) for user in range(spec.users)]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_generate_user_task, tasks, chunksize=max(1, len(tasks) // (workers * 8))))
+    else:
+        results = [_generate_user_task(task) for task in tasks]
+    for user_id, has_labels, user_trajectories, user_trackpoints in results:
+        n_trajectories += user_trajectories
+        n_trackpoints += user_trackpoints
+        if has_labels:
+            labeled.append(user_id)
+    with open(os.path.join(output, "labeled_ids.txt"), "w") as f:
+        f.write("".join(user_id + "\n" for user_id in labeled))
+    return n_trajectories, n_trackpoints
+
+
+def _generate_user_task(task):
+    return generate_user(*task)
+
+
+def generate_user(output, spec, user):
+    """
+    Write the trajectories and labels of one user
+    Return
+    ------
+    (str, bool, int, int): user id, whether the user has labels, and the number of trajectories and trackpoints
+    """
+    rng = np.random.default_rng([spec.seed, user])
+    user_id = spec.user_id(user)
+    trajectory_dir = os.path.join(output, "Data", user_id, "Trajectory")
+    os.makedirs(trajectory_dir)
+
+    has_labels = rng.random() < spec.labeled_users
+    n_trajectories = int(rng.integers(spec.trajectories[0], spec.trajectories[1] + 1))
+    # the start of every trajectory in whole seconds, at least a second apart so the file names differ
+    offsets = np.sort(rng.choice(spec.days * 86400, size=n_trajectories, replace=False))
+    starts = np.datetime64(spec.start, "s") + offsets.astype("timedelta64[s]")
+
+    labels = []
+    n_trackpoints = 0
+    end = None
+    for start in starts:
+        # trajectories of a user do not overlap
+        if end != None and start <= end:
+            start = end + np.timedelta64(60, "s")
+        labeled = has_labels and rng.random() < spec.label_coverage
+        mode = TRANSPORTATION_MODES[int(rng.integers(len(TRANSPORTATION_MODES)))] if labeled else None
+        lines, end = _trajectory_lines(rng, spec, start, SPEEDS[mode or "walk"])
+        name = str(start).replace("-", "").replace("T", "").replace(":", "") + ".plt"
+        with open(os.path.join(trajectory_dir, name), "w") as f:
+            f.write(PLT_HEADER)
+            f.writelines(lines)
+        n_trackpoints += len(lines)
+        if labeled:
+            labels.append((start, end, mode))
+
+    if has_labels:
+        with open(os.path.join(output, "Data", user_id, "labels.txt"), "w") as f:
+            f.write(LABELS_HEADER)
+            for label_start, label_end, mode in labels:
+                f.write("%s\t%s\t%s\n" % (_label_time(label_start), _label_time(label_end), mode))
+    return user_id, has_labels, n_trajectories, n_trackpoints
+
+
+def _trajectory_lines(rng, spec, start, speed):
+    """
+    Lines of a random walk starting at start, moving at about speed m/s
+    Return
+    ------
+    ([str], numpy.datetime64): the PLT lines and the time of the last trackpoint
+    """
+    n = int(rng.integers(spec.points[0], spec.points[1] + 1))
+    steps = rng.choice([1, 2, 5], size=n - 1, p=[0.6, 0.3, 0.1])
+    gaps = rng.random(n - 1) < spec.gap_probability
+    steps[gaps] = rng.integers(301, 3600, size=int(gaps.sum()))
+    seconds = np.concatenate(([0], np.cumsum(steps)))
+    times = start + seconds.astype("timedelta64[s]")
+
+    spread = spec.spread_km / KM_PER_DEGREE
+    latitude = spec.center[0] + rng.uniform(-spread, spread)
+    longitude = spec.center[1] + rng.uniform(-spread, spread)
+    # one heading per trajectory with some noise, the steps are in degrees
+    heading = rng.uniform(0, 2 * np.pi) + np.cumsum(rng.normal(0, 0.2, size=n))
+    distances = np.concatenate(([0], np.minimum(steps, 5) * speed * rng.uniform(0.5, 1.5, size=n - 1))) / 1000
+    latitudes = latitude + np.cumsum(distances * np.cos(heading)) / KM_PER_DEGREE
+    longitudes = longitude + np.cumsum(distances * np.sin(heading)) / (KM_PER_DEGREE * np.cos(np.radians(latitude)))
+    altitudes = np.maximum(0, rng.integers(0, 500) + np.cumsum(rng.integers(-3, 4, size=n))).astype(np.int64)
+    altitudes[rng.random(n) < spec.missing_altitude] = MISSING_ALTITUDE
+
+    date_days = (times - np.datetime64(DATE_DAYS_EPOCH, "s")) / np.timedelta64(86400, "s")
+    time_strings = np.datetime_as_string(times, unit="s")
+    lines = ["%.6f,%.6f,0,%d,%.10f,%s,%s\n" % (lat, lon, alt, days, time_string[:10], time_string[11:])
+             for lat, lon, alt, days, time_string in zip(
+                 latitudes.tolist(), longitudes.tolist(), altitudes.tolist(), date_days.tolist(), time_strings)]
+    return lines, times[-1]
+
+
+def _label_time(time):
+    return time.astype(datetime).strftime(LABEL_DATE_FORMAT_STRING)
+
+
+def parse_args():
+    defaults = DatasetSpec()
+    parser = argparse.ArgumentParser(description="Write a deterministic synthetic Geolife dataset")
+    parser.add_argument("--output", default="./synthetic", help="dataset dir, replaced if it exists")
+    parser.add_argument("--users", type=int, default=defaults.users)
+    parser.add_argument("--trajectories", type=int, nargs=2, default=defaults.trajectories, metavar=("MIN", "MAX"),
+                        help="trajectories per user")
+    parser.add_argument("--points", type=int, nargs=2, default=defaults.points, metavar=("MIN", "MAX"),
+                        help="trackpoints per trajectory")
+    parser.add_argument("--labeled-users", type=float, default=defaults.labeled_users,
+                        help="share of the users with labels")
+    parser.add_argument("--label-coverage", type=float, default=defaults.label_coverage,
+                        help="share of the trajectories of a labeled user with a label")
+    parser.add_argument("--center", type=float, nargs=2, default=defaults.center, metavar=("LAT", "LON"))
+    parser.add_argument("--spread-km", type=float, default=defaults.spread_km,
+                        help="max distance of the trajectory starts from the center")
+    parser.add_argument("--start", type=datetime.fromisoformat, default=defaults.start,
+                        help="time of the first trajectories, YYYY-MM-DD")
+    parser.add_argument("--days", type=int, default=defaults.days, help="days the trajectories are spread over")
+    parser.add_argument("--missing-altitude", type=float, default=defaults.missing_altitude)
+    parser.add_argument("--gap-probability", type=float, default=defaults.gap_probability)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="writer processes")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    spec = DatasetSpec(users=args.users, trajectories=tuple(args.trajectories), points=tuple(args.points),
+                       labeled_users=args.labeled_users, label_coverage=args.label_coverage,
+                       center=tuple(args.center), spread_km=args.spread_km, start=args.start, days=args.days,
+                       missing_altitude=args.missing_altitude, gap_probability=args.gap_probability, seed=args.seed)
+    print("Writing %d users to %s..." % (spec.users, args.output))
+    n_trajectories, n_trackpoints = generate_dataset(args.output, spec, workers=args.workers)
+    print("Wrote %d trajectories with %d trackpoints" % (n_trajectories, n_trackpoints))
+
+
+if __name__ == "__main__":
+    main()
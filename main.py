@@ -3,6 +3,8 @@ from DbConnector import DbConnector
 from tabulate import tabulate
 
 from utils.fileUtils import read_activities, read_trackpoints, read_users
+from utils.instrumentation import QueryProfiler
+from utils.queryCache import QueryCache
 
 from crud import Crud
 
@@ -19,6 +21,8 @@ Please select one of these options:
     3 - Run queries
     4 - Describe tables
     5 - Fetch data from tables
+    6 - Recompute activity summaries
+    7 - Rebuild activity rollups
     """
 
     QUERIES_STRING = """
@@ -61,7 +65,8 @@ Choose which transportation mode you want to find users for:
                 print("Deleting tables...")
             else:
                 print("Not deleting tables")
-            self.database = Crud(delete_tables)
+            self.database = Crud(delete_tables, query_cache=QueryCache(), profiler=QueryProfiler(),
+                                 check_indexes=True)
         except Exception as e:
             print("ERROR: Failed to use database:", e)
 
@@ -70,12 +75,13 @@ Choose which transportation mode you want to find users for:
         self.database.create_collections()
 
     def insert_data_from_dataset(self):
+        workers = os.cpu_count()
         self.database.insert_users()
         print("read users")
-        self.database.insert_activities()
-        print("read activities")
-        self.database.insert_trackpoints()
-        print("read trackpoints")
+        self.database.insert_dataset(workers=workers, max_in_flight=4)
+        print("read activities and trackpoints")
+        self.database.create_indexes()
+        print("created indexes")
 
     def run_queries(self):
         choice = input(self.QUERIES_STRING)
@@ -134,6 +140,9 @@ Choose which transportation mode you want to find users for:
             data = self.database.get_most_frequent_transportation_mode_per_user()
             print(tabulate(data, headers=["user_id", "transportation_mode"]))
 
+        report = self.database.profiler.report()
+        if report:
+            print("\n" + report)
         print("\n-------------------------------------")
 
     def main(self):
@@ -150,6 +159,10 @@ Choose which transportation mode you want to find users for:
                     self.insert_data_from_dataset()
                 elif choice == "3":
                     self.run_queries()
+                elif choice == "6":
+                    self.database.recompute_activity_summaries()
+                elif choice == "7":
+                    self.database.rebuild_rollups()
                 # elif choice == "4":
                     # self.database.fetch_users()
                     # print("")
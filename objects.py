@@ -12,7 +12,17 @@
         user_id: string
         transportation_mode: string
         start_date_time: Date
-        stop_date_time: Date
+        end_date_time: Date
+        summary: {
+            n_trackpoints: integer
+            distance_km: float
+            altitude_gain: integer
+            altitude_loss: integer
+            duration_s: integer
+            max_gap_s: integer
+            bbox: {min_latitude: float, min_longitude: float, max_latitude: float, max_longitude: float}
+        }
+        rolled_up: false  <-- only until the rollups count it, see Crud.insert_dataset
     }
 '''
 
@@ -26,7 +36,64 @@
         altitude: integer
         date_days: float
         date_time: Date
+        location: {type: "Point", coordinates: [longitude, latitude]}  <-- left out when out of range
     }
 '''
 
 
+
+'''
+    TrackpointBucket {  <-- bucketed layout, see bucketedCrud.py
+        _id: ObjectId
+        activity_id: integer
+        user_id: string
+        seq: integer
+        n: integer
+        start_date_time: Date
+        end_date_time: Date
+        latitude: [float]
+        longitude: [float]
+        altitude: [integer]
+        date_time: [Date]
+        location: [{type: "Point", coordinates: [longitude, latitude]}]  <-- points in range only
+    }
+'''
+
+
+
+'''
+    CompactTrackpoint {  <-- compact layout, see compactCrud.py and utils/trackpointCodec.py
+        _id: ObjectId
+        a: integer  <-- activity_id
+        t: integer  <-- date_time in seconds since 1970-01-01
+        z: integer  <-- altitude, int32
+        l: [float, float]  <-- [longitude, latitude], a legacy point for the 2dsphere index
+        p: [float, float]  <-- instead of l when the coordinates are out of range
+    }
+    user_id is read from the activity, date_days and location are derived when decoding
+'''
+
+
+
+'''
+    Partitioned layout, see partitionedCrud.py and utils/partitions.py:
+    trackpoint_<YYYY> or trackpoint_<YYYY>_<MM> {  <-- one collection per year or month
+        same fields as Trajectory, for the activities starting in the period
+    }
+'''
+
+
+
+'''
+    ActivityRollup {  <-- maintained at ingest, see utils/rollups.py
+        _id: string  <-- e.g. "day|010|walk|2008-10-23"
+        grain: "user" | "mode" | "year" | "day"
+        user_id: string  <-- user and day grains
+        transportation_mode: string  <-- mode and day grains
+        year: integer  <-- year grain
+        day: string  <-- day grain, YYYY-MM-DD of the start
+        count: integer
+        hours: integer  <-- hour boundaries crossed, as $dateDiff counts them
+        duration_s: float
+    }
+'''
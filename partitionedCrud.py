@@ -0,0 +1,164 @@
+from crud import Crud
+from utils.distance import DEFAULT_CHUNK_SIZE, haversine_km
+from utils.fileUtils import batch_documents, iter_trackpoints
+from utils.geoQueries import LOCATION_FIELD
+from utils.indexes import partitioned_index_specs
+from utils.instrumentation import profiled_query
+from utils.partitions import PARTITIONED_COLLECTION, partition_name, partition_range, route
+from utils.queryCache import cached_query
+from datetime import datetime
+from itertools import chain, groupby
+
+
+class PartitionedCrud(Crud):
+    """
+    Crud for the partitioned trackpoint layout, where the trackpoints are split over one
+    collection per PERIOD, e.g. trackpoint_2008 by year or trackpoint_2008_10 by month.
+    All trackpoints of an activity are in the partition of the period it starts in, see
+    utils.partitions, and each partition is indexed like the trackpoint collection.
+    Reads of the trackpoints of some activities only scan the partitions those activities
+    start in, other reads go through the partitions one after the other in time order.
+    A period is dropped by dropping its collection, see drop_period and reload_period.
+    """
+    # "year" or "month"
+    PERIOD = "year"
+    TRACKPOINT_COLLECTION = PARTITIONED_COLLECTION
+
+
+    @property
+    def INDEX_SPECS(self):
+        return partitioned_index_specs(self.dbService.partitions())
+
+
+    def create_collections(self):
+        # the partitions are created with their indexes when trackpoints are first routed to them
+        self.dbService.create_collection("user")
+        self.dbService.create_collection("activity")
+
+
+    def insert_trackpoints(self, trackpoints=None, workers=1, batch_size=10000, batch_bytes=None):
+        if (trackpoints == None):
+            users = groupby(iter_trackpoints(self._data_path(), self.ACTIVITY_ID_MAP, workers=workers),
+                            key=lambda trackpoint: trackpoint["user_id"])
+            self.dbService.insert_batches(
+                batch for _, user_trackpoints in users
+                for batch in self._trackpoint_batches(
+                    [list(points) for _, points in groupby(user_trackpoints, key=lambda trackpoint: trackpoint["activity_id"])],
+                    batch_size, batch_bytes))
+            return
+        self.dbService.insert_partitioned_trackpoints(trackpoints, period=self.PERIOD)
+
+
+    def _trackpoint_batches(self, trackpoints, batch_size, batch_bytes):
+        partitions = route(trackpoints, period=self.PERIOD)
+        # before yielding their batches, so no write creates a partition without indexes
+        self.dbService.create_partitions(partitions)
+        for collection_name in sorted(partitions):
+            for batch in batch_documents(partitions[collection_name], batch_size=batch_size, batch_bytes=batch_bytes):
+                yield collection_name, batch
+
+
+    def drop_tables(self):
+        for collection_name in self.dbService.partitions():
+            try:
+                self.dbService.drop_collection(collection_name)
+            except Exception as e:
+                print("Could not delete table '%s'" % collection_name)
+        super().drop_tables()
+
+
+    def drop_period(self, year, month=None):
+        """
+        Drop the activities starting in a year, or a month with PERIOD "month", with their
+        trackpoints and rollups. The trackpoints go with their collection, and the files of
+        the activities are removed from the ingestion manifest so the next load reads them again.
+        Parameters
+        ----------
+        year: int
+        month: int
+            required with PERIOD "month", and not allowed with PERIOD "year"
+        Return
+        ------
+        int: number of dropped activities
+        """
+        if self.PERIOD == "month" and month == None:
+            raise ValueError("The partitions are by month, give the month to drop")
+        if self.PERIOD == "year" and month != None:
+            raise ValueError("The partitions are by year, a month can not be dropped on its own")
+        collection_name = partition_name(datetime(year, month or 1, 1), self.PERIOD)
+        start, end = partition_range(collection_name)
+        activity_ids = self.db.activity.distinct("_id", {"start_date_time": {"$gte": start, "$lt": end}})
+        self.dbService.drop_collection(collection_name)
+        self.dbService.delete_activities(activity_ids)
+        self.dbService.delete_manifest_entries(activity_ids)
+        print("Dropped %s with %d activities" % (collection_name, len(activity_ids)))
+        return len(activity_ids)
+
+
+    def reload_period(self, year, month=None, workers=1, batch_size=10000, max_in_flight=None):
+        """
+        Drop a period with drop_period and load it again from the dataset. Files of
+        other periods that are loaded and unchanged are skipped.
+        Return
+        ------
+        dict of str: int: number of inserted documents per collection
+        """
+        self.drop_period(year, month)
+        inserted = self.insert_dataset(workers=workers, batch_size=batch_size, max_in_flight=max_in_flight)
+        self.create_indexes()
+        return inserted
+
+
+    def _trackpoint_document_counts(self):
+        return {collection_name: self.db[collection_name].count_documents({})
+                for collection_name in self.dbService.partitions()}
+
+
+    def _query_partitions(self, query):
+        """
+        The partitions that can hold trackpoints matching query. With an activity_id $in
+        filter only the partitions of the periods the activities start in are kept.
+        """
+        partitions = self.dbService.partitions()
+        activity_filter = query.get('activity_id')
+        if isinstance(activity_filter, dict) and '$in' in activity_filter:
+            starts = self.db.activity.find({'_id': {'$in': list(activity_filter['$in'])}}, {'start_date_time': 1})
+            names = set(partition_name(activity['start_date_time'], self.PERIOD) for activity in starts)
+            partitions = [collection_name for collection_name in partitions if collection_name in names]
+        return partitions
+
+
+    def _find_trackpoints(self, query, projection):
+        # every activity is in one partition, so the trackpoints of an activity stay together
+        return chain.from_iterable(
+            self.db[collection_name].find(query, projection).sort(
+                [('activity_id', 1), ('date_time', 1)]).batch_size(DEFAULT_CHUNK_SIZE)
+            for collection_name in self._query_partitions(query))
+
+
+    @profiled_query
+    @cached_query("user", "activity", "trackpoint")
+    def get_number_of_rows(self):
+        return [[self.db.user.count(), self.db.activity.count(), sum(self._trackpoint_document_counts().values())]]
+
+
+    @profiled_query
+    @cached_query("trackpoint")
+    def _find_located(self, geo_filter, returns, limit):
+        partitions = self.dbService.partitions()
+        if returns == "users":
+            return sorted(set(chain.from_iterable(
+                self.db[collection_name].distinct("user_id", geo_filter) for collection_name in partitions)))
+        if returns == "activities":
+            return sorted(set(chain.from_iterable(
+                self.db[collection_name].distinct("activity_id", geo_filter) for collection_name in partitions)))
+        if returns == "points":
+            points = list(chain.from_iterable(
+                self.db[collection_name].find(geo_filter, {"_id": 0}, limit=limit or 0) for collection_name in partitions))
+            near = geo_filter[LOCATION_FIELD].get('$near')
+            if near != None:
+                # every partition returns its points nearest first, merge them on the distance
+                longitude, latitude = near['$geometry']['coordinates']
+                points.sort(key=lambda point: haversine_km(latitude, longitude, point['latitude'], point['longitude']))
+            return points[:limit] if limit else points
+        raise ValueError("returns must be 'users', 'activities' or 'points', not '%s'" % returns)
@@ -0,0 +1,88 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from utils.progress import InsertProgress
+
+
+class AsyncInserter:
+    """
+    Asyncio ingestion backend on top of pymongo.
+    Each insert_many runs unordered on a thread pool (pymongo releases the GIL while it
+    waits on the server), and up to max_in_flight of them are kept running at once.
+    The next batch is produced on a separate thread while the writes are in flight, and
+    no new batch is produced while all slots are taken, which bounds memory use.
+    A batch with collection name None is a checkpoint: a callable that is run once all
+    earlier batches have been written.
+    """
+
+    def __init__(self, db, max_in_flight=4, report_interval=5):
+        self.db = db
+        self.max_in_flight = max_in_flight
+        self.report_interval = report_interval
+
+    def run(self, batches):
+        """
+        Insert all batches and wait for the writes to finish
+        Parameters
+        ----------
+        batches: iterable of (str, list of dict)
+            collection name and the documents to insert into it, or (None, callable) for a checkpoint
+        Return
+        ------
+        dict of str: int: number of inserted documents per collection
+        """
+        return asyncio.run(self._run(iter(batches)))
+
+    async def _run(self, batches):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        progress = InsertProgress(self.report_interval)
+        writes = set()
+        failures = []
+
+        with ThreadPoolExecutor(max_workers=1) as producer, \
+                ThreadPoolExecutor(max_workers=self.max_in_flight) as writers:
+            try:
+                while True:
+                    # backpressure: wait for a free slot before producing the next batch
+                    await slots.acquire()
+                    batch = await loop.run_in_executor(producer, next, batches, None)
+                    if batch == None:
+                        slots.release()
+                        break
+                    # stop producing as soon as a write has failed, instead of at the end of the load
+                    if failures:
+                        raise failures[0]
+                    collection_name, documents = batch
+                    if collection_name == None:
+                        slots.release()
+                        await asyncio.gather(*writes)
+                        if failures:
+                            raise failures[0]
+                        await loop.run_in_executor(producer, documents)
+                        continue
+                    write = loop.create_task(
+                        self._write(loop, writers, slots, progress, failures, collection_name, documents))
+                    writes.add(write)
+                    write.add_done_callback(writes.discard)
+                await asyncio.gather(*writes)
+                if failures:
+                    raise failures[0]
+            except BaseException:
+                for write in writes:
+                    write.cancel()
+                await asyncio.gather(*writes, return_exceptions=True)
+                raise
+        return progress.done()
+
+    async def _write(self, loop, writers, slots, progress, failures, collection_name, documents):
+        try:
+            insert = partial(self.db[collection_name].insert_many, documents, ordered=False)
+            await loop.run_in_executor(writers, insert)
+            progress.add(collection_name, len(documents))
+        except Exception as e:
+            # kept for _run to raise, so the failure surfaces in the caller
+            failures.append(e)
+        finally:
+            slots.release()
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+from utils.geoQueries import LOCATION_FIELD, geo_point, location_field, valid_coordinates
+
+
+BUCKET_COLLECTION = "trackpoint_bucket"
+# every activity has at most 2500 trackpoints, so by default each activity is one bucket
+DEFAULT_BUCKET_SIZE = 2500
+# day 0 of the date_days column in the PLT files
+DATE_DAYS_EPOCH = datetime(1899, 12, 30)
+
+
+def make_buckets(trackpoints, bucket_size=DEFAULT_BUCKET_SIZE):
+    """
+    Pack the trackpoints of one activity into bucket documents
+    Parameters
+    ----------
+    trackpoints: list of trackpoint dicts
+        the trackpoints of one activity, in time order
+    bucket_size: int
+        max number of trackpoints per bucket
+    Return
+    ------
+    list of dict of {
+        activity_id: integer
+        user_id: string
+        seq: integer
+        n: integer
+        start_date_time: Date
+        end_date_time: Date
+        latitude: [float]
+        longitude: [float]
+        altitude: [integer]
+        date_time: [Date]
+        location: [GeoJSON point]  <-- the points with coordinates in range, for the 2dsphere index
+    }
+    """
+    buckets = []
+    for seq, start in enumerate(range(0, len(trackpoints), bucket_size)):
+        points = trackpoints[start:start + bucket_size]
+        locations = [geo_point(point["latitude"], point["longitude"]) for point in points
+                     if valid_coordinates(point["latitude"], point["longitude"])]
+        bucket = {
+            "activity_id": points[0]["activity_id"],
+            "user_id": points[0]["user_id"],
+            "seq": seq,
+            "n": len(points),
+            "start_date_time": points[0]["date_time"],
+            "end_date_time": points[-1]["date_time"],
+            "latitude": [point["latitude"] for point in points],
+            "longitude": [point["longitude"] for point in points],
+            "altitude": [point["altitude"] for point in points],
+            "date_time": [point["date_time"] for point in points]
+        }
+        if locations:
+            bucket[LOCATION_FIELD] = locations
+        buckets.append(bucket)
+    return buckets
+
+
+def unpack_bucket(bucket):
+    """
+    Turn a bucket document back into trackpoint documents as described in objects.py.
+    date_days is not stored in buckets, it is derived from date_time.
+    Return
+    ------
+    list of trackpoint dicts
+    """
+    return [{
+        "activity_id": bucket["activity_id"],
+        "user_id": bucket["user_id"],
+        "latitude": latitude,
+        "longitude": longitude,
+        "altitude": altitude,
+        "date_days": (date_time - DATE_DAYS_EPOCH) / timedelta(days=1),
+        "date_time": date_time,
+        **location_field(latitude, longitude)
+    } for latitude, longitude, altitude, date_time in zip(
+        bucket["latitude"], bucket["longitude"], bucket["altitude"], bucket["date_time"])]
+
+
+def iter_activity_points(buckets):
+    """
+    Merge the buckets of each activity, so every activity is seen once with all its points
+    Parameters
+    ----------
+    buckets: iterable of bucket dicts
+        sorted on (activity_id, seq)
+    Return
+    ------
+    generator of (dict, dict of str: list):
+        the first bucket of the activity, and its points as lists per field
+    """
+    current = None
+    points = None
+    for bucket in buckets:
+        if current == None or bucket["activity_id"] != current["activity_id"]:
+            if current != None:
+                yield current, points
+            current = bucket
+            points = {field: [] for field in ("latitude", "longitude", "altitude", "date_time") if field in bucket}
+        for field in points:
+            points[field].extend(bucket[field])
+    if current != None:
+        yield current, points
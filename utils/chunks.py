@@ -0,0 +1,34 @@
+import numpy as np
+
+
+# number of trackpoints converted to arrays at a time
+DEFAULT_CHUNK_SIZE = 100000
+
+
+def chunk_fields(points, fields, dtypes=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Turn a stream of trackpoint documents into one array per field, chunk_size points at a time
+    Parameters
+    ----------
+    points: iterable of dict
+        trackpoints with all the fields
+    fields: [str]
+        the fields to read
+    dtypes: [numpy dtype]
+        dtype of the array of each field, None or a None entry lets numpy choose
+    chunk_size: int
+        max number of points per chunk
+    Return
+    ------
+    generator of tuple of numpy.ndarray: the arrays of a chunk, in the order of fields
+    """
+    dtypes = dtypes or [None] * len(fields)
+    columns = [[] for _ in fields]
+    for point in points:
+        for column, field in zip(columns, fields):
+            column.append(point[field])
+        if len(columns[0]) >= chunk_size:
+            yield tuple(np.array(column, dtype=dtype) for column, dtype in zip(columns, dtypes))
+            columns = [[] for _ in fields]
+    if columns[0]:
+        yield tuple(np.array(column, dtype=dtype) for column, dtype in zip(columns, dtypes))
@@ -0,0 +1,260 @@
+from datetime import datetime, timedelta
+import json
+import os
+import shutil
+
+import numpy as np
+
+from utils.geoQueries import location_field
+
+
+CACHE_DIR_NAME = "cache"
+META_FILENAME = "meta.json"
+# version of the cache format, a cache of another version is stale and built again.
+# 2: activity summaries and the file info of every trajectory file
+CACHE_VERSION = 2
+UNIX_EPOCH = datetime(1970, 1, 1)
+# one raw little-endian file per column, memory-mapped when the cache is loaded
+COLUMNS = {
+    "latitude": "<f8",
+    "longitude": "<f8",
+    "altitude": "<i4",
+    "date_days": "<f8",
+    "date_time": "<i8",  # seconds since 1970-01-01
+    "activity_id": "<i8",  # index into the cached activities
+}
+
+
+def default_cache_dir(filepath):
+    """
+    The cache of ./dataset/Data lives in ./dataset/cache
+    """
+    return os.path.join(os.path.dirname(os.path.normpath(filepath)), CACHE_DIR_NAME)
+
+
+def newest_source_mtime(filepath, labeled_filepath):
+    """
+    Return
+    ------
+    float: the newest mtime of the files the dataset is parsed from
+    """
+    newest = os.stat(labeled_filepath).st_mtime if os.path.exists(labeled_filepath) else 0
+    for userDir in os.scandir(filepath):
+        if not userDir.is_dir():
+            continue
+        for entry in os.scandir(userDir.path):
+            newest = max(newest, entry.stat().st_mtime)
+            if entry.is_dir():
+                for trajectory in os.scandir(entry.path):
+                    newest = max(newest, trajectory.stat().st_mtime)
+    return newest
+
+
+def write_cache(cache_dir, user_trajectories, label_policy):
+    """
+    Write parsed trajectories to the cache. The cache is written next to cache_dir
+    and moved in place when it is complete, so a failed write leaves no partial cache.
+    Parameters
+    ----------
+    cache_dir: str
+        directory to write the cache to
+    user_trajectories: iterable of (str, list of (dict, dict, list of dict))
+        as yielded by fileUtils.iter_user_trajectory_files
+    label_policy: str
+        the label policy the activities were read with
+    Return
+    ------
+    DatasetCache: the written cache
+    """
+    tmp_dir = cache_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    files = {column: open(os.path.join(tmp_dir, column + ".bin"), "wb") for column in COLUMNS}
+    users = []
+    activities = []
+    trajectory_files = []
+    offsets = [0]
+    try:
+        for user_id, trajectories in user_trajectories:
+            users.append(user_id)
+            columns = {column: [] for column in COLUMNS}
+            for file_info, activity, trackpoints in trajectories:
+                if activity == None:
+                    # rejected files are kept too, so they are recorded in the ingestion manifest
+                    trajectory_files.append({"file": file_info, "activity": None})
+                    continue
+                index = len(activities)
+                trajectory_files.append({"file": file_info, "activity": index})
+                activities.append({
+                    "user_id": activity["user_id"],
+                    "trajectory": os.path.basename(file_info["_id"])[:-4],
+                    "transportation_mode": activity["transportation_mode"],
+                    "start_date_time": activity["start_date_time"].isoformat(),
+                    "end_date_time": activity["end_date_time"].isoformat(),
+                    "summary": activity["summary"]
+                })
+                offsets.append(offsets[-1] + len(trackpoints))
+                for trackpoint in trackpoints:
+                    columns["latitude"].append(trackpoint["latitude"])
+                    columns["longitude"].append(trackpoint["longitude"])
+                    columns["altitude"].append(trackpoint["altitude"])
+                    columns["date_days"].append(trackpoint["date_days"])
+                    columns["date_time"].append((trackpoint["date_time"] - UNIX_EPOCH) // timedelta(seconds=1))
+                    columns["activity_id"].append(index)
+            for column in COLUMNS:
+                np.asarray(columns[column], dtype=COLUMNS[column]).tofile(files[column])
+    finally:
+        for f in files.values():
+            f.close()
+
+    np.asarray(offsets, dtype="<i8").tofile(os.path.join(tmp_dir, "offsets.bin"))
+    with open(os.path.join(tmp_dir, META_FILENAME), "w") as f:
+        json.dump({"version": CACHE_VERSION, "label_policy": label_policy, "columns": COLUMNS, "users": users,
+                   "activities": activities, "files": trajectory_files}, f)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+    return DatasetCache(cache_dir)
+
+
+def open_fresh_cache(filepath, labeled_filepath, label_policy):
+    """
+    Open the cache of the dataset at filepath, if there is one of CACHE_VERSION that is
+    newer than all the source files and was read with the same label policy
+    (any policy when label_policy is None)
+    Return
+    ------
+    DatasetCache: the cache, or None if it is missing or stale
+    """
+    cache_dir = default_cache_dir(filepath)
+    meta_filepath = os.path.join(cache_dir, META_FILENAME)
+    if not os.path.exists(meta_filepath):
+        return None
+    if os.stat(meta_filepath).st_mtime <= newest_source_mtime(filepath, labeled_filepath):
+        return None
+    with open(meta_filepath, "r") as f:
+        if json.load(f).get("version") != CACHE_VERSION:
+            print("The dataset cache in %s has an old format, build it again" % cache_dir)
+            return None
+    cache = DatasetCache(cache_dir)
+    if label_policy != None and cache.label_policy != label_policy:
+        return None
+    return cache
+
+
+class DatasetCache:
+    """
+    Columnar binary cache of the parsed dataset.
+    Every trackpoint column is a memory-mapped numpy array, so loading the cache reads
+    nothing up front and slicing it copies nothing. The trackpoints of activity i are
+    the rows offsets[i]:offsets[i + 1] of every column.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, META_FILENAME), "r") as f:
+            meta = json.load(f)
+        self.label_policy = meta["label_policy"]
+        self.users = meta["users"]
+        self.activities = meta["activities"]
+        self.files = meta["files"]
+        self.offsets = self._map("offsets", "<i8")
+        self.columns = {column: self._map(column, dtype) for column, dtype in meta["columns"].items()}
+
+    def _map(self, name, dtype):
+        filepath = os.path.join(self.cache_dir, name + ".bin")
+        # numpy can not map an empty file
+        if os.stat(filepath).st_size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(filepath, dtype=dtype, mode="r")
+
+    def __len__(self):
+        return len(self.activities)
+
+    def activity_columns(self, index):
+        """
+        Return
+        ------
+        dict of str: numpy.ndarray: zero-copy views of the columns of one activity
+        """
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return {column: values[start:end] for column, values in self.columns.items()}
+
+    def read_activities(self, activity_id_map, activity_id=0):
+        """
+        Same result as fileUtils.read_activities, but with the activity summaries, which the cache holds
+        """
+        activities = {user_id: [] for user_id in self.users}
+        for index, cached in enumerate(self.activities):
+            activities[cached["user_id"]].append({
+                "_id": activity_id + index,
+                "user_id": cached["user_id"],
+                "transportation_mode": cached["transportation_mode"],
+                "start_date_time": datetime.fromisoformat(cached["start_date_time"]),
+                "end_date_time": datetime.fromisoformat(cached["end_date_time"]),
+                "summary": cached["summary"]
+            })
+            activity_id_map[cached["trajectory"]] = activity_id + index
+        return activities, activity_id_map, activity_id + len(self.activities)
+
+    def read_trackpoints(self, activity_id_map):
+        """
+        Same result as fileUtils.read_trackpoints
+        """
+        trackpoints = {user_id: {} for user_id in self.users if user_id.isdigit()}
+        for index, cached in enumerate(self.activities):
+            if cached["user_id"] in trackpoints and cached["trajectory"] in activity_id_map:
+                trackpoints[cached["user_id"]][cached["trajectory"]] = self.trackpoints(
+                    index, activity_id=activity_id_map[cached["trajectory"]])
+        return trackpoints
+
+    def iter_user_trajectory_files(self, skip=None):
+        """
+        Same result as fileUtils.iter_user_trajectory_files
+        """
+        if skip == None:
+            skip = {}
+        user_files = {user_id: [] for user_id in self.users}
+        for trajectory_file in self.files:
+            user_files[trajectory_file["file"]["user_id"]].append(trajectory_file)
+        for user_id in self.users:
+            trajectories = []
+            for trajectory_file in user_files[user_id]:
+                file_info = dict(trajectory_file["file"])
+                if skip.get(file_info["_id"]) == (file_info["size"], file_info["mtime"]):
+                    continue
+                index = trajectory_file["activity"]
+                if index == None:
+                    trajectories.append((file_info, None, None))
+                    continue
+                cached = self.activities[index]
+                activity = {
+                    "_id": None,
+                    "user_id": cached["user_id"],
+                    "transportation_mode": cached["transportation_mode"],
+                    "start_date_time": datetime.fromisoformat(cached["start_date_time"]),
+                    "end_date_time": datetime.fromisoformat(cached["end_date_time"]),
+                    "summary": cached["summary"]
+                }
+                trajectories.append((file_info, activity, self.trackpoints(index, activity_id=None)))
+            yield user_id, trajectories
+
+    def trackpoints(self, index, activity_id):
+        """
+        Return
+        ------
+        list of trackpoint dicts: the trackpoints of one activity as documents
+        """
+        columns = self.activity_columns(index)
+        user_id = self.activities[index]["user_id"]
+        return [{
+            "activity_id": activity_id,
+            "user_id": user_id,
+            "latitude": latitude,
+            "longitude": longitude,
+            "altitude": altitude,
+            "date_days": date_days,
+            "date_time": UNIX_EPOCH + timedelta(seconds=date_time),
+            **location_field(latitude, longitude)
+        } for latitude, longitude, altitude, date_days, date_time in zip(
+            columns["latitude"].tolist(), columns["longitude"].tolist(), columns["altitude"].tolist(),
+            columns["date_days"].tolist(), columns["date_time"].tolist())]
@@ -1,39 +1,375 @@
+from contextlib import contextmanager
+
+from bson import ObjectId
+from pymongo import ReplaceOne, UpdateOne, WriteConcern
+
+from utils.asyncIngest import AsyncInserter
+from utils.buckets import BUCKET_COLLECTION, DEFAULT_BUCKET_SIZE, make_buckets
+from utils.indexes import TRACKPOINT_INDEXES, create_indexes
+from utils.partitions import PARTITIONED_COLLECTION, is_partition, route, sorted_partitions
+from utils.progress import InsertProgress
+from utils.queryCache import VERSION_COLLECTION
+from utils.rollups import ROLLUP_COLLECTION, rollup_updates
+from utils.trackpointCodec import COMPACT_COLLECTION, encode
+
+
 class dbService:
+    # seconds between throughput reports while streaming batches
+    REPORT_INTERVAL = 5
+    # records which trajectory files have been loaded, see Crud.insert_dataset
+    MANIFEST_COLLECTION = "ingest_manifest"
+
     def __init__(self, connection):
         self.connection = connection
         self.client = connection.client
         self.db = connection.db
+        # documents are inserted through write_db, which bulk_writes points at a relaxed write concern
+        self.write_db = self.db
+        self.ordered = True
+        # whether indexes are built after the load instead of on new partitions, see bulk_writes
+        self.defer_indexes = False
+        # the partitions create_partitions knows to exist, None until it first lists them
+        self.known_partitions = None
+
+
+    @contextmanager
+    def bulk_writes(self, write_concern=WriteConcern(w=1, j=False)):
+        """
+        Insert documents unordered and with write_concern while in the context, for bulk loads.
+        Unordered inserts keep going past a failed document, and do not wait on each other.
+        New partitions are created without indexes, the bulk load builds them at the end.
+        """
+        self.write_db = self.client.get_database(self.db.name, write_concern=write_concern)
+        self.ordered = False
+        self.defer_indexes = True
+        try:
+            yield
+        finally:
+            self.write_db = self.db
+            self.ordered = True
+            self.defer_indexes = False
+
 
+    def flush_journal(self):
+        """
+        Make a journaled write, which is acknowledged once the journal holding it and every
+        earlier write is on disk, so writes made with j=False are durable afterwards
+        """
+        self.db.get_collection(VERSION_COLLECTION, write_concern=WriteConcern(w=1, j=True)).update_one(
+            {"_id": "journal"}, {"$set": {"version": ObjectId()}}, upsert=True)
 
-    def create_collection(self, collection_name):
-        collection = self.db.create_collection(collection_name)
+
+    def create_collection(self, collection_name, **options):
+        collection = self.db.create_collection(collection_name, **options)
         print('Created collection: ', collection)
 
 
     def insert_users(self, users):
-        self.db.user.insert_many(users)
+        self.write_db.user.insert_many(users, ordered=self.ordered)
+        self.bump_write_versions(["user"])
 
 
     def insert_activities(self, activities):
         for user_activities in activities:
             # try:
-            if (len(activities[user_activities]) > 0):
-                self.db.activity.insert_many(activities[user_activities])
+            self.insert_activity_batch(activities[user_activities])
             # except TypeError as e:
             #     print('TypeError: ' + e)
+
+
+    def insert_activity_batch(self, activities):
+        if (len(activities) > 0):
+            self.write_db.activity.insert_many(activities, ordered=self.ordered)
+            self.update_rollups(activities)
+            self.bump_write_versions(["activity"])
                         
             
     def insert_trackpoints(self, trackpoints):
+        self.insert_trackpoints_stream(trackpoints.items())
+
+
+    def insert_trackpoints_stream(self, user_trackpoints):
+        """
+        Insert trackpoints as they are produced, one user at a time
+        Parameters
+        ----------
+        user_trackpoints: iterable of (str, dict of str: list of trackpoint dicts)
+            user_id and the user's trackpoints keyed by activity
+        """
         no_users = 0
         no_trackpoints = 0
-        for user in trackpoints:
-            for activity in trackpoints[user]:
-                self.db.trackpoint.insert_many(trackpoints[user][activity])
-                no_trackpoints += len(trackpoints[user][activity])
+        for user, activities in user_trackpoints:
+            for activity in activities:
+                self.write_db.trackpoint.insert_many(activities[activity], ordered=self.ordered)
+                no_trackpoints += len(activities[activity])
+            self.bump_write_versions(["trackpoint"])
             no_users += 1
             print(str(no_users) + " inserted")
             print(str(no_trackpoints) +  " trackpoints inserted")
     
+    def insert_trackpoint_buckets(self, trackpoints, bucket_size=DEFAULT_BUCKET_SIZE):
+        """
+        Insert trackpoints in the bucketed layout, with the points of each activity
+        packed into arrays of at most bucket_size points per document. See utils.buckets.
+        Parameters
+        ----------
+        trackpoints: dict of str: dict of str: list of trackpoint dicts
+            trackpoints per activity per user, as returned by read_trackpoints
+        """
+        no_buckets = 0
+        for user in trackpoints:
+            buckets = []
+            for activity in trackpoints[user]:
+                buckets.extend(make_buckets(trackpoints[user][activity], bucket_size=bucket_size))
+            if (len(buckets) > 0):
+                self.write_db[BUCKET_COLLECTION].insert_many(buckets, ordered=self.ordered)
+                self.bump_write_versions([BUCKET_COLLECTION])
+            no_buckets += len(buckets)
+        print(str(no_buckets) + " trackpoint buckets inserted")
+
+
+    def insert_compact_trackpoints(self, trackpoints):
+        """
+        Insert trackpoints in the compact layout, see utils.trackpointCodec
+        Parameters
+        ----------
+        trackpoints: dict of str: dict of str: list of trackpoint dicts
+            trackpoints per activity per user, as returned by read_trackpoints
+        """
+        no_trackpoints = 0
+        for user in trackpoints:
+            for activity in trackpoints[user]:
+                documents = [encode(trackpoint) for trackpoint in trackpoints[user][activity]]
+                self.write_db[COMPACT_COLLECTION].insert_many(documents, ordered=self.ordered)
+                no_trackpoints += len(documents)
+            self.bump_write_versions([COMPACT_COLLECTION])
+        print(str(no_trackpoints) + " compact trackpoints inserted")
+
+
+    def insert_partitioned_trackpoints(self, trackpoints, period="year"):
+        """
+        Insert trackpoints in the partitioned layout, routing the trackpoints of each
+        activity to the collection of the period it starts in, see utils.partitions
+        Parameters
+        ----------
+        trackpoints: dict of str: dict of str: list of trackpoint dicts
+            trackpoints per activity per user, as returned by read_trackpoints
+        """
+        no_trackpoints = 0
+        for user in trackpoints:
+            partitions = route(trackpoints[user].values(), period=period)
+            self.create_partitions(partitions)
+            for collection_name in partitions:
+                self.write_db[collection_name].insert_many(partitions[collection_name], ordered=self.ordered)
+                no_trackpoints += len(partitions[collection_name])
+            self.bump_write_versions(list(partitions))
+        print(str(no_trackpoints) + " trackpoints inserted into partitions")
+
+
+    def partitions(self):
+        """
+        Return
+        ------
+        [str]: the trackpoint partitions, in time order
+        """
+        return sorted_partitions(self.db.list_collection_names())
+
+
+    def create_partitions(self, collection_names):
+        """
+        Create the partitions that do not exist yet with the indexes of the trackpoint
+        collection, before their first insert would create them without any. In bulk_writes
+        the indexes are left to the bulk load, and the partitions are created by their inserts.
+        The partitions are listed once, later calls only check the ones they have not seen
+        """
+        if self.known_partitions == None:
+            self.known_partitions = set(self.partitions())
+        new_partitions = [collection_name for collection_name in collection_names
+                          if collection_name not in self.known_partitions]
+        if new_partitions and not self.defer_indexes:
+            create_indexes(self.db, {collection_name: TRACKPOINT_INDEXES for collection_name in new_partitions})
+        self.known_partitions.update(new_partitions)
+
+
+    def insert_trackpoint_batches(self, batches):
+        """
+        Insert trackpoints batch by batch, reporting throughput as it goes
+        Parameters
+        ----------
+        batches: iterable of list of trackpoint dicts
+        Return
+        ------
+        int: number of inserted trackpoints
+        """
+        return self.insert_batches(("trackpoint", batch) for batch in batches).get("trackpoint", 0)
+
+
+    def insert_batches(self, batches):
+        """
+        Insert batches of documents one at a time, reporting throughput as it goes
+        Parameters
+        ----------
+        batches: iterable of (str, list of dict)
+            collection name and the documents to insert into it, or (None, callable)
+            for a checkpoint that is run once all earlier batches are written
+        Return
+        ------
+        dict of str: int: number of inserted documents per collection
+        """
+        progress = InsertProgress(self.REPORT_INTERVAL)
+        written = []
+        try:
+            for collection_name, batch in self._track_writes(batches, written):
+                if collection_name == None:
+                    batch()
+                    continue
+                self.write_db[collection_name].insert_many(batch, ordered=self.ordered)
+                progress.add(collection_name, len(batch))
+        finally:
+            self.bump_write_versions(written)
+        return progress.done()
+
+
+    def insert_batches_async(self, batches, max_in_flight=4):
+        """
+        Insert batches of documents with up to max_in_flight unordered writes running
+        at once, while the next batches are produced. See utils.asyncIngest.
+        Parameters
+        ----------
+        batches: iterable of (str, list of dict)
+            collection name and the documents to insert into it, or (None, callable)
+            for a checkpoint that is run once all earlier batches are written
+        max_in_flight: int
+            number of concurrent insert_many calls
+        Return
+        ------
+        dict of str: int: number of inserted documents per collection
+        """
+        written = []
+        try:
+            return AsyncInserter(self.write_db, max_in_flight=max_in_flight,
+                                 report_interval=self.REPORT_INTERVAL).run(self._track_writes(batches, written))
+        finally:
+            # run returns once every write is done, so nothing lands after this bump
+            self.bump_write_versions(written)
+
+
+    def update_rollups(self, activities, sign=1):
+        """
+        Add activities to the rollups, or remove them with sign=-1, see utils.rollups
+        """
+        updates = rollup_updates(activities, sign=sign)
+        if (len(updates) > 0):
+            self.write_db[ROLLUP_COLLECTION].bulk_write(updates, ordered=False)
+            self.bump_write_versions([ROLLUP_COLLECTION])
+
+
+    def _track_writes(self, batches, written):
+        """
+        Pass batches through, bumping the write version of each collection before its
+        first batch and adding it to written. The caller bumps written again once all
+        writes are done, so no query result read during the load stays cached after it
+        """
+        for collection_name, batch in batches:
+            if collection_name != None and collection_name not in written:
+                written.append(collection_name)
+                self.bump_write_versions([collection_name])
+            yield collection_name, batch
+
+
+    def bump_write_versions(self, collection_names):
+        """
+        Give the collections a new write version, which invalidates the cached
+        query results that read them, see utils.queryCache
+        """
+        # a write to any partition changes the partitioned trackpoints
+        if any(is_partition(name) for name in collection_names):
+            collection_names = list(collection_names) + [PARTITIONED_COLLECTION]
+        if (len(collection_names) > 0):
+            self.db[VERSION_COLLECTION].bulk_write(
+                [UpdateOne({"_id": name}, {"$set": {"version": ObjectId()}}, upsert=True) for name in collection_names],
+                ordered=False)
+
+
+    def get_write_versions(self, collection_names):
+        """
+        Return
+        ------
+        dict of str: ObjectId: the write version of each collection that has one
+        """
+        return {entry["_id"]: entry["version"]
+                for entry in self.db[VERSION_COLLECTION].find({"_id": {"$in": list(collection_names)}})}
+
+
+    def fetch_manifest(self):
+        """
+        Return
+        ------
+        dict of str: dict: the ingestion manifest entries keyed on file id
+        """
+        return {entry["_id"]: entry for entry in self.db[self.MANIFEST_COLLECTION].find({})}
+
+
+    def upsert_manifest_entries(self, entries):
+        if (len(entries) > 0):
+            self.db[self.MANIFEST_COLLECTION].bulk_write(
+                [ReplaceOne({"_id": entry["_id"]}, entry, upsert=True) for entry in entries], ordered=False)
+
+
+    def mark_manifest_done(self, file_ids, activities=None):
+        """
+        Add the activities of loaded files to the rollups, then mark the files done.
+        The activities were inserted with rolled_up False, which is removed once the
+        rollups count them, so delete_activities only subtracts counted activities
+        """
+        if (activities != None and len(activities) > 0):
+            self.update_rollups(activities)
+            self.db.activity.update_many({"_id": {"$in": [activity["_id"] for activity in activities]}},
+                                         {"$unset": {"rolled_up": ""}})
+            self.bump_write_versions(["activity"])
+        if (len(file_ids) > 0):
+            self.db[self.MANIFEST_COLLECTION].update_many({"_id": {"$in": file_ids}}, {"$set": {"status": "done"}})
+
+
+    def delete_activities(self, activity_ids):
+        """
+        Delete activities and their trackpoints, and remove them from the rollups.
+        Activities with rolled_up False were never added to the rollups, so they are not subtracted
+        """
+        if (len(activity_ids) > 0):
+            self.db.trackpoint.delete_many({"activity_id": {"$in": activity_ids}})
+            self.db[BUCKET_COLLECTION].delete_many({"activity_id": {"$in": activity_ids}})
+            self.db[COMPACT_COLLECTION].delete_many({"a": {"$in": activity_ids}})
+            partitions = self.partitions()
+            for collection_name in partitions:
+                self.db[collection_name].delete_many({"activity_id": {"$in": activity_ids}})
+            activities = list(self.db.activity.find(
+                {"_id": {"$in": activity_ids}},
+                {"user_id": 1, "transportation_mode": 1, "start_date_time": 1, "end_date_time": 1, "rolled_up": 1}))
+            self.db.activity.delete_many({"_id": {"$in": activity_ids}})
+            self.update_rollups([activity for activity in activities if activity.get("rolled_up", True)], sign=-1)
+            self.bump_write_versions(["trackpoint", BUCKET_COLLECTION, COMPACT_COLLECTION, "activity"] + partitions)
+
+
+    def delete_manifest_entries(self, activity_ids):
+        """
+        Forget the files of activities, so the next load reads them again
+        """
+        if (len(activity_ids) > 0):
+            self.db[self.MANIFEST_COLLECTION].delete_many({"activity_id": {"$in": activity_ids}})
+
+
+    def get_max_activity_id(self):
+        """
+        Return
+        ------
+        int: the highest activity id in the database, or -1 if there are no activities
+        """
+        for activity in self.db.activity.find({}, {"_id": 1}).sort("_id", -1).limit(1):
+            return activity["_id"]
+        return -1
+
+
     def fetch_documents(self, collection_name):
         collection = self.db[collection_name]
         documents = collection.find({})
@@ -42,4 +378,7 @@ class dbService:
 
     def drop_collection(self, collection_name):
         collection = self.db[collection_name]
-        collection.drop()
\ No newline at end of file
+        collection.drop()
+        if self.known_partitions != None:
+            self.known_partitions.discard(collection_name)
+        self.bump_write_versions([collection_name])
\ No newline at end of file
@@ -0,0 +1,61 @@
+import numpy as np
+
+from utils.chunks import DEFAULT_CHUNK_SIZE, chunk_fields
+
+
+# same mean earth radius as the haversine package
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(latitudes1, longitudes1, latitudes2, longitudes2):
+    """
+    Vectorized haversine distance in km between pairs of coordinates given in degrees
+    Return
+    ------
+    numpy.ndarray: the distance of every pair
+    """
+    latitudes1, longitudes1, latitudes2, longitudes2 = map(
+        np.radians, (latitudes1, longitudes1, latitudes2, longitudes2))
+    a = (np.sin((latitudes2 - latitudes1) / 2) ** 2
+         + np.cos(latitudes1) * np.cos(latitudes2) * np.sin((longitudes2 - longitudes1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def chunk_points(points, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Arrays of activity ids, latitudes and longitudes of trackpoints, see utils.chunks.chunk_fields
+    """
+    return chunk_fields(points, ["activity_id", "latitude", "longitude"], chunk_size=chunk_size)
+
+
+def activity_distances(chunks):
+    """
+    Sum the distance between consecutive trackpoints of every activity, one chunk at a time.
+    Each chunk is handled with array operations, only pairs within the same activity count,
+    and the last point of a chunk is carried over to the next one.
+    Parameters
+    ----------
+    chunks: iterable of (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        activity ids, latitudes and longitudes, sorted on activity and then time
+    Return
+    ------
+    dict of int: float: distance in km per activity with at least two trackpoints
+    """
+    distances = {}
+    last = None
+    for activity_ids, latitudes, longitudes in chunks:
+        if last != None:
+            activity_ids = np.concatenate(([last[0]], activity_ids))
+            latitudes = np.concatenate(([last[1]], latitudes))
+            longitudes = np.concatenate(([last[2]], longitudes))
+        if len(activity_ids) == 0:
+            continue
+        last = (activity_ids[-1], latitudes[-1], longitudes[-1])
+
+        same_activity = activity_ids[:-1] == activity_ids[1:]
+        steps = haversine_km(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])[same_activity]
+        activities, inverse = np.unique(activity_ids[1:][same_activity], return_inverse=True)
+        sums = np.bincount(inverse, weights=steps, minlength=len(activities))
+        for activity_id, distance in zip(activities.tolist(), sums.tolist()):
+            distances[activity_id] = distances.get(activity_id, 0.0) + distance
+    return distances
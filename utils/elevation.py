@@ -0,0 +1,58 @@
+import heapq
+
+import numpy as np
+
+from utils.chunks import DEFAULT_CHUNK_SIZE, chunk_fields
+from utils.summary import MISSING_ALTITUDE
+
+
+def chunk_altitudes(points, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Arrays of activity ids, user ids and altitudes of trackpoints, see utils.chunks.chunk_fields
+    """
+    return chunk_fields(points, ["activity_id", "user_id", "altitude"], [None, None, np.int64], chunk_size=chunk_size)
+
+
+def user_altitude_gains(chunks):
+    """
+    Sum the climbs between consecutive recorded altitudes within every activity, per user,
+    one chunk at a time. Missing altitudes are skipped, only climbs within the same activity
+    count, and the last recorded point of a chunk is carried over to the next one.
+    Parameters
+    ----------
+    chunks: iterable of (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        activity ids, user ids and altitudes, sorted on activity and then time
+    Return
+    ------
+    dict of str: int: altitude gain in feet per user with at least one recorded climb
+    """
+    gains = {}
+    last = None
+    for activity_ids, user_ids, altitudes in chunks:
+        recorded = altitudes != MISSING_ALTITUDE
+        activity_ids, user_ids, altitudes = activity_ids[recorded], user_ids[recorded], altitudes[recorded]
+        if last != None:
+            activity_ids = np.concatenate(([last[0]], activity_ids))
+            user_ids = np.concatenate(([last[1]], user_ids))
+            altitudes = np.concatenate(([last[2]], altitudes))
+        if len(activity_ids) == 0:
+            continue
+        last = (activity_ids[-1], user_ids[-1], altitudes[-1])
+
+        climbs = np.diff(altitudes)
+        climbing = (activity_ids[:-1] == activity_ids[1:]) & (climbs > 0)
+        users, inverse = np.unique(user_ids[1:][climbing], return_inverse=True)
+        sums = np.bincount(inverse, weights=climbs[climbing], minlength=len(users))
+        for user_id, gain in zip(users.tolist(), sums.tolist()):
+            gains[user_id] = gains.get(user_id, 0) + int(gain)
+    return gains
+
+
+def top_n(totals, n):
+    """
+    The n largest totals, without sorting all of them. Equal totals are ordered on their key
+    Return
+    ------
+    list of [key, value]: largest first
+    """
+    return [[key, value] for key, value in heapq.nsmallest(n, totals.items(), key=lambda item: (-item[1], item[0]))]
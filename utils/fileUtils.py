@@ -1,13 +1,23 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import os
+import re
 from sqlite3 import DateFromTicks
 from time import strptime, time
 
+from utils.datasetCache import default_cache_dir, open_fresh_cache, write_cache
+from utils.geoQueries import geo_point, valid_coordinates
+from utils.labelIndex import NO_LABEL, LabelIndex
+from utils.summary import summarize_documents
+
 
-START_TIME_INDEX = 0
-STOP_TIME_INDEX = 1
 LAST_INDEX = -1
 DATE_FORMAT_STRING = "%Y-%m-%d %H:%M:%S"
+# the exact shape of DATE_FORMAT_STRING in the PLT files, the only input the fast path takes
+TIMESTAMP_SHAPE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2}")
+# how trajectories are matched against labels, see LabelIndex.POLICIES
+DEFAULT_LABEL_POLICY = "max_overlap"
 
 
 def read_users(userFilepath, labeledFilepath):
@@ -46,6 +56,13 @@ def read_users(userFilepath, labeledFilepath):
     return users
 
 
+def _labeled_filepath(filepath):
+    """
+    labeled_ids.txt next to the Data dir at filepath
+    """
+    return os.path.join(os.path.dirname(os.path.normpath(filepath)), "labeled_ids.txt")
+
+
 def _read_labeled(filepath):
     """
     method to read which users are labeled
@@ -66,76 +83,56 @@ def _read_labeled(filepath):
     return labeled_ids
 
 
-def _get_start_end_times(filepath):
+def _decode_timestamps(dates, times):
     """
-    Get start and end time for trajectory
+    Decode the date and time columns of a trajectory file into datetimes.
+    The PLT fields are fixed width, which datetime.fromisoformat parses far faster
+    than datetime.strptime does per line. fromisoformat also takes forms strptime
+    rejects, e.g. fractions or offsets, so it is only used when every row has the shape
+    of TIMESTAMP_SHAPE. Other files are parsed with DATE_FORMAT_STRING, so the result
+    and the errors are always those of strptime.
     Parameters
     ----------
-    filepath: str
-        filepath to activity file containing trackpoints
+    dates: [str]
+        date column, formatted as 2008-10-23
+    times: [str]
+        time column, formatted as 02:53:04
     Return
     ------
-    [datetime]: list containing start and end time
+    [datetime]: one datetime per row
     """
-    f = open(filepath, "r")
-    times = []
-    line_no = 0
-    unusable_lines = 0
-    for line in f:
-        # get rid of first six lines
-        if unusable_lines < 6:
-            unusable_lines += 1
-            continue
-
-        line_no += 1
-        # get the start time if first iteration
-        # get last time if else
-        if line_no == 1:
-            entries = line.strip().split(",")
-            timedate = datetime.strptime(
-                entries[-2] + " " + entries[-1], DATE_FORMAT_STRING)
-            times.append(timedate)
-            # dummy line
-            times.append("")
-        else:
-            entries = line.strip().split(",")
-            timedate = datetime.strptime(
-                entries[-2] + " " + entries[-1], DATE_FORMAT_STRING)
-            times[STOP_TIME_INDEX] = timedate
+    timestamps = [date + " " + time for date, time in zip(dates, times)]
+    fullmatch = TIMESTAMP_SHAPE.fullmatch
+    if all(fullmatch(timestamp) for timestamp in timestamps):
+        fromisoformat = datetime.fromisoformat
+        try:
+            return [fromisoformat(timestamp) for timestamp in timestamps]
+        except ValueError:
+            # in shape but out of range, e.g. month 13, raise the error strptime raises
+            pass
+    return [datetime.strptime(timestamp, DATE_FORMAT_STRING) for timestamp in timestamps]
 
-        if line_no > 2500:
-            return None
-    return times
 
-
-def _read_labels(filepath):
+def _read_label_index(filepath, has_labels):
     """
-    Read labels of user, and return dict with
+    Load the label index of a user once, so it can be matched against all the user's trajectories
     Parameters
     ----------
     filepath: str
-        filepath to the file containing the labels
+        Filepath to dir containing a user's activities
+    has_labels: bool
+        Boolean value, telling if the user has labeled it's activities.
     Return
     ------
-    dict of datetime: datetime
-        dictionary with key = start time and value = end time for each acitivity, None if too big datatset
+    LabelIndex: the user's labels, or None if the user has no labels
     """
-    f = open(filepath, "r")
-    labels = {}
-    skip = True
-    for line in f:
-        if skip:
-            skip = False
-        else:
-            entries = line.strip().split("\t")
-            start_date = entries[0]
-            time_and_date = datetime.strptime(start_date, '%Y/%m/%d %H:%M:%S')
-            labels[time_and_date] = entries[LAST_INDEX]
-
-    return labels
+    if not has_labels:
+        return None
+    return LabelIndex.from_file(filepath + "/labels.txt")
 
 
-def read_activities(filepath, activity_id_map, activity_id=0, labeled_ids=None):
+def read_activities(filepath, activity_id_map, activity_id=0, labeled_ids=None, label_policy=DEFAULT_LABEL_POLICY,
+                    use_cache=True):
     """
     Read activities from filepath, and return a dict with user_id
     as key and a list of activities as value
@@ -143,6 +140,8 @@ def read_activities(filepath, activity_id_map, activity_id=0, labeled_ids=None):
     ----------
     filepath: str
         filepath to the directory containing the activities
+    use_cache: bool
+        read from the cache written by build_cache when it is newer than the dataset
     Return
     ------
     dict of {
@@ -156,8 +155,12 @@ def read_activities(filepath, activity_id_map, activity_id=0, labeled_ids=None):
     }
     """
     # TODO: remove iterations
+    if use_cache and labeled_ids == None:
+        cache = open_fresh_cache(filepath, _labeled_filepath(filepath), label_policy)
+        if cache != None:
+            return cache.read_activities(activity_id_map, activity_id=activity_id)
     if labeled_ids == None:
-        labeled_ids = _read_labeled("./dataset/labeled_ids.txt")
+        labeled_ids = _read_labeled(_labeled_filepath(filepath))
     activities = {}
     iterations = 0
     for userDir in os.scandir(filepath):
@@ -165,14 +168,15 @@ def read_activities(filepath, activity_id_map, activity_id=0, labeled_ids=None):
             user_id = userDir.name
             has_labels = userDir.name in labeled_ids
             [activities[user_id], activity_id_map, activity_id] = _read_user_activities(
-                userDir.path, user_id=user_id, has_labels=has_labels, activity_id_map=activity_id_map, activity_id=activity_id)
+                userDir.path, user_id=user_id, has_labels=has_labels, activity_id_map=activity_id_map, activity_id=activity_id,
+                label_policy=label_policy)
         if iterations == -1:
             break
         iterations += 1
     return activities, activity_id_map, activity_id
 
 
-def _read_user_activities(filepath, user_id, has_labels, activity_id_map, activity_id):
+def _read_user_activities(filepath, user_id, has_labels, activity_id_map, activity_id, label_policy=DEFAULT_LABEL_POLICY):
     """
     Loop through the activities located at filepath, and return a dict containing the activites.
     If has_labels is False, the returned transportation mode is '-' for each activity
@@ -182,6 +186,8 @@ def _read_user_activities(filepath, user_id, has_labels, activity_id_map, activi
         Filepath to dir containing a user's activities
     has_labels: bool
         Boolean value, telling if the user has labeled it's activities.
+    label_policy: str
+        how trajectories are matched against labels, see LabelIndex.POLICIES
     Returns
     -------
     dict of {
@@ -193,31 +199,76 @@ def _read_user_activities(filepath, user_id, has_labels, activity_id_map, activi
     }
     """
     activities = []
-    # loop through trajectories
-    for trajectory in os.scandir(filepath + "/Trajectory"):
-        startAndEndTime = _get_start_end_times(trajectory.path)
-        if has_labels:
-            labels = _read_labels(filepath + "/labels.txt")
-        if startAndEndTime != None:
-            trajectory_name = trajectory.name[:-4]
-            if has_labels and startAndEndTime[START_TIME_INDEX] in labels:
-                # TODO: Check if transportion mode is present in labels
-                transportation_mode = labels[startAndEndTime[START_TIME_INDEX]]
-            else:
-                transportation_mode = "-"
-            activities.append({
-                "_id": activity_id,
-                "user_id": user_id,
-                "transportation_mode": transportation_mode,
-                "start_date_time": startAndEndTime[START_TIME_INDEX],
-                "end_date_time": startAndEndTime[STOP_TIME_INDEX]
-            })
-            activity_id_map[trajectory_name] = activity_id
+    # a light scan, the trackpoints are read by read_trackpoints. The activities have no summary,
+    # see Crud.recompute_activity_summaries
+    for file_info, activity, _ in _read_user_trajectories(filepath, user_id, has_labels, label_policy,
+                                                          with_trackpoints=False):
+        if activity != None:
+            activity["_id"] = activity_id
+            activities.append(activity)
+            activity_id_map[_trajectory_name(file_info)] = activity_id
             activity_id += 1
     return activities, activity_id_map, activity_id
 
 
-def read_trackpoints(filepath, activity_id_map, labeled_ids=None, users=None):
+def iter_activities_parallel(filepath, activity_id_map, activity_id=0, labeled_ids=None, workers=None,
+                             label_policy=DEFAULT_LABEL_POLICY):
+    """
+    Read activities for every user in a process pool, and yield them one user at a time.
+    Users are yielded in the same order as read_activities visits them, and activity ids
+    are assigned in that order, so the documents are identical to the serial path.
+    Only a few users are read ahead of the consumer, see _map_in_order.
+    Parameters
+    ----------
+    filepath: str
+        filepath to the directory containing the user dirs
+    activity_id_map: dict of str: int
+        map from trajectory name to activity id, updated as users are yielded
+    activity_id: int
+        first activity id to assign
+    workers: int
+        number of worker processes, defaults to the number of cores
+    Return
+    ------
+    generator of (str, list of activity dicts, int):
+        user_id, the user's activities and the next free activity id
+    """
+    if labeled_ids == None:
+        labeled_ids = _read_labeled(_labeled_filepath(filepath))
+    tasks = []
+    for userDir in os.scandir(filepath):
+        if userDir.is_dir():
+            tasks.append((userDir.path, userDir.name, userDir.name in labeled_ids, label_policy))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for user_id, user_activities, user_id_map in _map_in_order(executor, _read_user_activities_task, tasks, workers):
+            # workers number activities from 0, shift them into the global id range
+            for activity in user_activities:
+                activity["_id"] += activity_id
+            for trajectory_name in user_id_map:
+                activity_id_map[trajectory_name] = user_id_map[trajectory_name] + activity_id
+            activity_id += len(user_activities)
+            yield user_id, user_activities, activity_id
+
+
+def _read_user_activities_task(task):
+    """
+    Process pool entry point for _read_user_activities
+    Parameters
+    ----------
+    task: (str, str, bool, str)
+        user dir path, user_id, has_labels and label_policy
+    Return
+    ------
+    (str, list of activity dicts, dict of str: int)
+    """
+    filepath, user_id, has_labels, label_policy = task
+    activities, activity_id_map, _ = _read_user_activities(
+        filepath, user_id=user_id, has_labels=has_labels, activity_id_map={}, activity_id=0, label_policy=label_policy)
+    return user_id, activities, activity_id_map
+
+
+def read_trackpoints(filepath, activity_id_map, labeled_ids=None, users=None, use_cache=True):
     """
     Read trackpoints from filepath, and return a dict with user_id
     as key and a list of trackpoints as value
@@ -225,6 +276,8 @@ def read_trackpoints(filepath, activity_id_map, labeled_ids=None, users=None):
     ----------
     filepath: str
         filepath to the directory containing the trackpoints
+    use_cache: bool
+        read from the cache written by build_cache when it is newer than the dataset
     Return
     ------
     dict of {
@@ -245,11 +298,16 @@ def read_trackpoints(filepath, activity_id_map, labeled_ids=None, users=None):
     }
     """
     # TODO: remove iterations
+    if use_cache:
+        # trackpoints do not depend on the label policy
+        cache = open_fresh_cache(filepath, _labeled_filepath(filepath), label_policy=None)
+        if cache != None:
+            return cache.read_trackpoints(activity_id_map)
     trackpoints = {}
     # if users == None:
     #     users = read_users("./dataset/Data", "./dataset/labeled_ids.txt")
     if labeled_ids == None:
-        labeled_ids = _read_labeled("./dataset/labeled_ids.txt")
+        labeled_ids = _read_labeled(_labeled_filepath(filepath))
     iterations = 0
     for userDir in os.scandir(filepath):
         user_id = userDir.name
@@ -268,6 +326,148 @@ def read_trackpoints(filepath, activity_id_map, labeled_ids=None, users=None):
     return trackpoints
 
 
+# activity id map of a trackpoint worker process, set once by _init_trackpoint_worker
+_WORKER_ACTIVITY_ID_MAP = None
+
+
+def iter_trackpoints_parallel(filepath, activity_id_map, workers=None):
+    """
+    Read trackpoints for every user in a process pool, and yield them one user at a time,
+    in the same order and with the same content as read_trackpoints.
+    Parameters
+    ----------
+    filepath: str
+        filepath to the directory containing the user dirs
+    activity_id_map: dict of str: int
+        map from trajectory name to activity id, as returned by read_activities
+    workers: int
+        number of worker processes, defaults to the number of cores
+    Return
+    ------
+    generator of (str, dict of str: list of trackpoint dicts):
+        user_id and the user's trackpoints keyed by trajectory name
+    """
+    tasks = []
+    for userDir in os.scandir(filepath):
+        if userDir.is_dir() and userDir.name.isdigit():
+            tasks.append((filepath + "/" + userDir.name, userDir.name))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_trackpoint_worker,
+                             initargs=(activity_id_map,)) as executor:
+        for user_id, user_trackpoints in _map_in_order(executor, _read_user_trackpoints_task, tasks, workers):
+            yield user_id, user_trackpoints
+
+
+def _map_in_order(executor, fn, tasks, workers=None):
+    """
+    Like executor.map, but only keeps a few tasks in flight, so results never
+    pile up in memory faster than they are consumed
+    Parameters
+    ----------
+    executor: concurrent.futures.Executor
+    fn: callable
+        function to run for each task
+    tasks: list
+        arguments to fn
+    workers: int
+        number of workers in the executor, defaults to the number of cores
+    Return
+    ------
+    generator of the results of fn, in the order of tasks
+    """
+    max_in_flight = 2 * (workers or os.cpu_count())
+    pending = deque()
+    for task in tasks:
+        pending.append(executor.submit(fn, task))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_trackpoints(filepath, activity_id_map, workers=1):
+    """
+    Yield the trackpoints of the dataset one at a time, in the same order as read_trackpoints.
+    At most one user (or a few users, when workers > 1) is held in memory at once.
+    Parameters
+    ----------
+    filepath: str
+        filepath to the directory containing the user dirs
+    activity_id_map: dict of str: int
+        map from trajectory name to activity id, as returned by read_activities
+    workers: int
+        number of worker processes, 1 reads the users in this process
+    Return
+    ------
+    generator of trackpoint dicts
+    """
+    if workers > 1:
+        users = iter_trackpoints_parallel(filepath, activity_id_map, workers=workers)
+    else:
+        users = ((userDir.name, _read_user_trackpoints(filepath + "/" + userDir.name, user_id=userDir.name, activity_id_map=activity_id_map))
+                 for userDir in os.scandir(filepath) if userDir.is_dir() and userDir.name.isdigit())
+    for user_id, user_trackpoints in users:
+        for activity in user_trackpoints:
+            for trackpoint in user_trackpoints[activity]:
+                yield trackpoint
+
+
+def batch_documents(documents, batch_size=10000, batch_bytes=None):
+    """
+    Group a stream of documents into lists of fixed size
+    Parameters
+    ----------
+    documents: iterable of dict
+        documents to group
+    batch_size: int
+        max number of documents in a batch
+    batch_bytes: int
+        max BSON size of a batch in bytes, or None to only limit on batch_size
+    Return
+    ------
+    generator of list of dict
+    """
+    if batch_bytes != None:
+        from bson import encode
+    batch = []
+    size = 0
+    for document in documents:
+        if batch_bytes != None:
+            document_size = len(encode(document))
+            if batch and size + document_size > batch_bytes:
+                yield batch
+                batch = []
+                size = 0
+            size += document_size
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+            size = 0
+    if batch:
+        yield batch
+
+
+def _init_trackpoint_worker(activity_id_map):
+    global _WORKER_ACTIVITY_ID_MAP
+    _WORKER_ACTIVITY_ID_MAP = activity_id_map
+
+
+def _read_user_trackpoints_task(task):
+    """
+    Process pool entry point for _read_user_trackpoints
+    Parameters
+    ----------
+    task: (str, str)
+        user dir path and user_id
+    Return
+    ------
+    (str, dict of str: list of trackpoint dicts)
+    """
+    filepath, user_id = task
+    return user_id, _read_user_trackpoints(filepath, user_id=user_id, activity_id_map=_WORKER_ACTIVITY_ID_MAP)
+
+
 def _read_user_trackpoints(filepath, user_id, activity_id_map):
     """
     Read trackpoints for all activities for one user.
@@ -291,72 +491,302 @@ def _read_user_trackpoints(filepath, user_id, activity_id_map):
     }: a dict with key = activity id and value = list of trackpoints
     """
     activities = {}
-    for activityDir in os.scandir(filepath):
-        if activityDir.is_dir():
-            activity_dir_filepath = filepath + "/" + activityDir.name
-            for activity_file in os.scandir(activity_dir_filepath):
-                if activity_file.is_file():
-                    activity_filepath = activity_dir_filepath + "/" + activity_file.name
-                    activity_filename = activity_file.name[:-4]
-                    try:
-                        trackpoints = _read_activity_trackpoints(activity_filepath, user_id=user_id, activity_id=activity_id_map[activity_filename])
-                        if trackpoints is not None:
-                            activities[activity_filename] = trackpoints
-                    except Exception as e:
-                        # This happens when activity_filename is not present in activity_id_map
-                        continue
+    for file_info, activity, trackpoints in _read_user_trajectories(filepath, user_id, has_labels=False):
+        activity_filename = _trajectory_name(file_info)
+        # trajectories that are not in activity_id_map were rejected by read_activities
+        if activity != None and activity_filename in activity_id_map:
+            set_activity_id(activity, trackpoints, activity_id_map[activity_filename])
+            activities[activity_filename] = trackpoints
     return activities
 
 
-def _read_activity_trackpoints(filepath, user_id, activity_id):
+def _build_trackpoints(rows, user_id, activity_id):
     """
-    Read trackpoints for one activity.
-    If an activity has more than 2500 trackpoints it is discarded.
+    Build trackpoint documents from the split data lines of one trajectory file
     Parameters
     ----------
-    filepath: str
-        filepath to activity file containing trackpoints
+    rows: list of [str]
+        the comma separated fields of each data line
     Return
     ------
-    list of [dict of {
-        activity_id: integer
-        user_id: string
-        latitude: float
-        longitude: float
-        altitude: integer
-        date_days: float
-        date_time: Date
-        }
-    ]: a list of the trackpoints
+    list of trackpoint dicts
     """
+    date_times = _decode_timestamps([entries[5] for entries in rows], [entries[6] for entries in rows])
     trackpoints = []
-    f = open(filepath, "r")
-    line_no = 0
-    for line in f:
-        # get rid of first six lines
-        if line_no < 6:
-            line_no += 1
-            continue
-        line_no += 1
-        entries = line.strip().split(",")
+    out_of_range = 0
+    for entries, date_time in zip(rows, date_times):
         lat = float(entries[0])
         lon = float(entries[1])
-        altitude = int(float(entries[3]))
-        date_days = float(entries[4])
-        date_time = datetime.strptime(
-            entries[5] + " " + entries[6], DATE_FORMAT_STRING)
-        trackpoints.append({
+        trackpoint = {
             "activity_id": activity_id,
             "user_id": user_id,
             "latitude": lat,
             "longitude": lon,
-            "altitude": altitude,
-            "date_days": date_days,
+            "altitude": int(float(entries[3])),
+            "date_days": float(entries[4]),
             "date_time": date_time
-        })
-        if line_no > 2506:
-            f.close()
-            return None
-    f.close()
+        }
+        # points out of range have no location, see geoQueries.valid_coordinates
+        if valid_coordinates(lat, lon):
+            trackpoint["location"] = geo_point(lat, lon)
+        else:
+            out_of_range += 1
+        trackpoints.append(trackpoint)
+    if out_of_range > 0:
+        print("WARNING: %d trackpoints of user %s starting %s have coordinates out of range, they have no location"
+              % (out_of_range, user_id, date_times[0]))
     return trackpoints
 
+
+def iter_trajectories(filepath, activity_id=0, labeled_ids=None, workers=1, label_policy=DEFAULT_LABEL_POLICY):
+    """
+    Read the whole dataset in a single pass over the trajectory files, and yield
+    each accepted trajectory as an activity together with its trackpoints.
+    Users and activity ids come in the same order as read_activities.
+    Parameters
+    ----------
+    filepath: str
+        filepath to the directory containing the user dirs
+    activity_id: int
+        first activity id to assign
+    workers: int
+        number of worker processes, 1 reads the users in this process
+    label_policy: str
+        how trajectories are matched against labels, see LabelIndex.POLICIES
+    Return
+    ------
+    generator of (dict, list of dict):
+        the activity document and its trackpoint documents
+    """
+    for user_id, trajectories in iter_user_trajectory_files(
+            filepath, labeled_ids=labeled_ids, workers=workers, label_policy=label_policy):
+        for file_info, activity, trackpoints in trajectories:
+            if activity == None:
+                continue
+            set_activity_id(activity, trackpoints, activity_id)
+            activity_id += 1
+            yield activity, trackpoints
+
+
+def iter_user_trajectory_files(filepath, labeled_ids=None, workers=1, label_policy=DEFAULT_LABEL_POLICY, skip=None,
+                               use_cache=False):
+    """
+    Read the trajectory files of the dataset one user at a time, in the same order as read_activities.
+    Every file is reported, also the rejected ones, together with its size and mtime,
+    so the caller can keep track of what has been ingested. Activities have no id yet,
+    assign one with set_activity_id.
+    Parameters
+    ----------
+    filepath: str
+        filepath to the directory containing the user dirs
+    workers: int
+        number of worker processes, 1 reads the users in this process
+    label_policy: str
+        how trajectories are matched against labels, see LabelIndex.POLICIES
+    skip: dict of str: (int, float)
+        files to leave out when their size and mtime are unchanged, keyed on their file id
+    use_cache: bool
+        read from the cache written by build_cache when it is newer than the dataset
+    Return
+    ------
+    generator of (str, list of (dict, dict, list of dict)):
+        user_id and, per file read, the file info {_id, user_id, size, mtime},
+        the activity and its trackpoints (both None when the trajectory is rejected)
+    """
+    if use_cache and labeled_ids == None:
+        cache = open_fresh_cache(filepath, _labeled_filepath(filepath), label_policy)
+        if cache != None:
+            print("Reading the dataset from the cache in %s" % cache.cache_dir)
+            yield from cache.iter_user_trajectory_files(skip=skip)
+            return
+    if labeled_ids == None:
+        labeled_ids = _read_labeled(_labeled_filepath(filepath))
+    if skip == None:
+        skip = {}
+    user_skips = {}
+    for file_id in skip:
+        user_skips.setdefault(file_id.split("/")[0], {})[file_id] = skip[file_id]
+    tasks = []
+    for userDir in os.scandir(filepath):
+        if userDir.is_dir():
+            tasks.append((userDir.path, userDir.name, userDir.name in labeled_ids, label_policy,
+                          user_skips.get(userDir.name, {})))
+
+    if workers > 1:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        users = _map_in_order(executor, _read_user_trajectories_task, tasks, workers)
+    else:
+        executor = None
+        users = map(_read_user_trajectories_task, tasks)
+    try:
+        yield from users
+    finally:
+        if executor != None:
+            executor.shutdown(cancel_futures=True)
+
+
+def set_activity_id(activity, trackpoints, activity_id):
+    """
+    Give an activity read by iter_user_trajectory_files its id
+    """
+    activity["_id"] = activity_id
+    for trackpoint in trackpoints:
+        trackpoint["activity_id"] = activity_id
+
+
+def _read_user_trajectories_task(task):
+    """
+    Read all trajectories of one user that are not skipped
+    Parameters
+    ----------
+    task: (str, str, bool, str, dict of str: (int, float))
+        user dir path, user_id, has_labels, label_policy and the files to skip if unchanged
+    Return
+    ------
+    (str, list of (dict, dict, list of dict)): user_id and file info, activity and trackpoints per file
+    """
+    filepath, user_id, has_labels, label_policy, skip = task
+    return user_id, _read_user_trajectories(filepath, user_id, has_labels, label_policy, skip=skip)
+
+
+def _read_user_trajectories(filepath, user_id, has_labels, label_policy=DEFAULT_LABEL_POLICY, skip=None,
+                            with_trackpoints=True):
+    """
+    Read the trajectory files of one user, each in a single pass with _read_trajectory
+    Parameters
+    ----------
+    filepath: str
+        Filepath to dir containing a user's activities
+    has_labels: bool
+        Boolean value, telling if the user has labeled it's activities.
+    skip: dict of str: (int, float)
+        files to leave out when their size and mtime are unchanged, keyed on their file id
+    with_trackpoints: bool
+        parse the trackpoints, otherwise only the times of the activities are read
+    Return
+    ------
+    list of (dict, dict, list of dict): file info, activity and trackpoints per file read,
+    the activity and trackpoints are None when the trajectory is rejected
+    """
+    labels = _read_label_index(filepath, has_labels)
+    trajectories = []
+    for trajectory in os.scandir(filepath + "/Trajectory"):
+        file_info = _file_info(user_id, trajectory)
+        if skip != None and skip.get(file_info["_id"]) == (file_info["size"], file_info["mtime"]):
+            continue
+        result = _read_trajectory(trajectory.path, user_id=user_id, activity_id=None, labels=labels,
+                                  label_policy=label_policy, with_trackpoints=with_trackpoints)
+        activity, trackpoints = result if result != None else (None, None)
+        trajectories.append((file_info, activity, trackpoints))
+    return trajectories
+
+
+def iter_trajectory_file_infos(filepath):
+    """
+    The file info of every trajectory file in the dataset, as iter_user_trajectory_files
+    reports it, without reading the files
+    Parameters
+    ----------
+    filepath: str
+        filepath to the directory containing the user dirs
+    Return
+    ------
+    generator of dict: {_id, user_id, size, mtime}
+    """
+    for userDir in os.scandir(filepath):
+        if userDir.is_dir():
+            for trajectory in os.scandir(userDir.path + "/Trajectory"):
+                yield _file_info(userDir.name, trajectory)
+
+
+def _file_info(user_id, trajectory):
+    stat = trajectory.stat()
+    return {
+        "_id": user_id + "/Trajectory/" + trajectory.name,
+        "user_id": user_id,
+        "size": stat.st_size,
+        "mtime": stat.st_mtime
+    }
+
+
+def _trajectory_name(file_info):
+    """
+    Name of a trajectory file without its extension, the key of activity_id_map
+    """
+    return file_info["_id"].split("/")[LAST_INDEX][:-4]
+
+
+def _read_trajectory(filepath, user_id, activity_id, labels=None, label_policy=DEFAULT_LABEL_POLICY,
+                     with_trackpoints=True):
+    """
+    Parse one trajectory file in a single pass.
+    If the trajectory has more than 2500 trackpoints it is rejected.
+    Parameters
+    ----------
+    filepath: str
+        filepath to activity file containing trackpoints
+    labels: LabelIndex
+        the user's labels, or None if the user has no labels
+    label_policy: str
+        how the trajectory is matched against labels, see LabelIndex.POLICIES
+    with_trackpoints: bool
+        build the trackpoints and the summary of the activity, otherwise only the
+        first and last timestamps are decoded and the trackpoints are None
+    Return
+    ------
+    (dict, list of dict):
+        the activity document and its trackpoint documents, or None if rejected
+    """
+    rows = []
+    with open(filepath, "r") as f:
+        for line_no, line in enumerate(f):
+            # get rid of first six lines
+            if line_no < 6:
+                continue
+            if line_no > 2505:
+                return None
+            rows.append(line.strip().split(","))
+    if not rows:
+        return None
+    if with_trackpoints:
+        trackpoints = _build_trackpoints(rows, user_id=user_id, activity_id=activity_id)
+        start_date_time = trackpoints[0]["date_time"]
+        end_date_time = trackpoints[LAST_INDEX]["date_time"]
+    else:
+        trackpoints = None
+        start_date_time, end_date_time = _decode_timestamps([rows[0][5], rows[LAST_INDEX][5]],
+                                                            [rows[0][6], rows[LAST_INDEX][6]])
+    if labels != None:
+        transportation_mode = labels.match(start_date_time, end_date_time, policy=label_policy)
+    else:
+        transportation_mode = NO_LABEL
+    activity = {
+        "_id": activity_id,
+        "user_id": user_id,
+        "transportation_mode": transportation_mode,
+        "start_date_time": start_date_time,
+        "end_date_time": end_date_time
+    }
+    if trackpoints != None:
+        activity["summary"] = summarize_documents(trackpoints)
+    return activity, trackpoints
+
+
+def build_cache(filepath, workers=1, label_policy=DEFAULT_LABEL_POLICY):
+    """
+    Parse the dataset once and write it to the binary cache next to it,
+    see utils.datasetCache. Crud.insert_dataset, read_activities and read_trackpoints
+    use the cache for as long as it is newer than the dataset.
+    Parameters
+    ----------
+    filepath: str
+        filepath to the directory containing the user dirs
+    workers: int
+        number of worker processes, 1 reads the users in this process
+    Return
+    ------
+    DatasetCache: the written cache
+    """
+    return write_cache(default_cache_dir(filepath),
+                       iter_user_trajectory_files(filepath, workers=workers, label_policy=label_policy),
+                       label_policy=label_policy)
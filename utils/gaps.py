@@ -0,0 +1,68 @@
+import numpy as np
+
+from utils.chunks import DEFAULT_CHUNK_SIZE, chunk_fields
+
+
+# an activity is invalid when two consecutive trackpoints are at least this far apart
+DEFAULT_MAX_GAP_MINUTES = 5
+
+
+def chunk_times(points, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Arrays of activity ids, user ids and times of trackpoints, see utils.chunks.chunk_fields
+    """
+    return chunk_fields(points, ["activity_id", "user_id", "date_time"], [None, None, "datetime64[ms]"],
+                        chunk_size=chunk_size)
+
+
+def activity_gaps(chunks, max_gap_minutes=DEFAULT_MAX_GAP_MINUTES):
+    """
+    Find the gaps of at least max_gap_minutes between consecutive trackpoints of every
+    activity, one chunk at a time. Only gaps within the same activity count, and the
+    last point of a chunk is carried over to the next one.
+    Parameters
+    ----------
+    chunks: iterable of (numpy.ndarray, numpy.ndarray, numpy.ndarray)
+        activity ids, user ids and date times, sorted on activity and then time
+    max_gap_minutes: float
+    Return
+    ------
+    dict of int: dict of {
+        user_id: string
+        gaps: [[datetime, float]]: start and length in seconds of every gap
+    }: only the activities with gaps
+    """
+    threshold = np.timedelta64(int(max_gap_minutes * 60 * 1000), "ms")
+    invalid = {}
+    last = None
+    for activity_ids, user_ids, date_times in chunks:
+        if last != None:
+            activity_ids = np.concatenate(([last[0]], activity_ids))
+            user_ids = np.concatenate(([last[1]], user_ids))
+            date_times = np.concatenate(([last[2]], date_times))
+        if len(activity_ids) == 0:
+            continue
+        last = (activity_ids[-1], user_ids[-1], date_times[-1])
+
+        steps = np.diff(date_times)
+        for i in np.flatnonzero((activity_ids[:-1] == activity_ids[1:]) & (steps >= threshold)).tolist():
+            activity = invalid.setdefault(int(activity_ids[i]), {"user_id": str(user_ids[i]), "gaps": []})
+            activity["gaps"].append([date_times[i].astype(object), float(steps[i] / np.timedelta64(1, "s"))])
+    return invalid
+
+
+def count_per_user(activities):
+    """
+    Number of activities per user
+    Parameters
+    ----------
+    activities: dict of int: dict
+        activities with a user_id, e.g. from activity_gaps
+    Return
+    ------
+    list of [str, int]: sorted on user id
+    """
+    counts = {}
+    for activity in activities.values():
+        counts[activity["user_id"]] = counts.get(activity["user_id"], 0) + 1
+    return sorted([user_id, count] for user_id, count in counts.items())
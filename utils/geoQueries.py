@@ -0,0 +1,77 @@
+EARTH_RADIUS_M = 6371008.8
+LOCATION_FIELD = "location"
+
+
+def valid_coordinates(latitude, longitude):
+    """
+    Whether a 2dsphere index takes the coordinate. A single point out of range makes
+    the index build, or the insert once the index exists, fail, so such points are
+    stored without a location.
+    """
+    return -90 <= latitude <= 90 and -180 <= longitude <= 180
+
+
+def location_field(latitude, longitude):
+    """
+    The location field of a trackpoint, to unpack into its document
+    Return
+    ------
+    dict: {location: GeoJSON point}, empty for coordinates out of range
+    """
+    if valid_coordinates(latitude, longitude):
+        return {LOCATION_FIELD: geo_point(latitude, longitude)}
+    return {}
+
+
+def geo_point(latitude, longitude):
+    """
+    GeoJSON point stored in the location field of a trackpoint.
+    GeoJSON puts longitude before latitude.
+    """
+    return {"type": "Point", "coordinates": [longitude, latitude]}
+
+
+def radius_filter(latitude, longitude, radius_m):
+    """
+    Filter on trackpoints within radius_m meters of a coordinate.
+    Unlike $near, $geoWithin can be used in distinct, count and aggregate.
+    """
+    return {LOCATION_FIELD: {'$geoWithin': {
+        '$centerSphere': [[longitude, latitude], radius_m / EARTH_RADIUS_M]
+    }}}
+
+
+def near_filter(latitude, longitude, radius_m):
+    """
+    Filter on trackpoints within radius_m meters of a coordinate, nearest first
+    """
+    return {LOCATION_FIELD: {'$near': {
+        '$geometry': geo_point(latitude, longitude),
+        '$maxDistance': radius_m
+    }}}
+
+
+def box_filter(min_latitude, min_longitude, max_latitude, max_longitude):
+    """
+    Filter on trackpoints in a latitude/longitude bounding box
+    """
+    return polygon_filter([
+        (min_latitude, min_longitude),
+        (min_latitude, max_longitude),
+        (max_latitude, max_longitude),
+        (max_latitude, min_longitude),
+    ])
+
+
+def polygon_filter(coordinates):
+    """
+    Filter on trackpoints in a polygon
+    Parameters
+    ----------
+    coordinates: list of (float, float)
+        the (latitude, longitude) corners of the polygon, it is closed automatically
+    """
+    ring = [[longitude, latitude] for latitude, longitude in coordinates]
+    if ring[0] != ring[-1]:
+        ring.append(ring[0])
+    return {LOCATION_FIELD: {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': [ring]}}}}
@@ -0,0 +1,191 @@
+from threading import Event, Thread
+from time import time
+
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE
+
+from utils.buckets import BUCKET_COLLECTION
+from utils.rollups import ROLLUP_COLLECTION
+from utils.trackpointCodec import COMPACT_COLLECTION
+
+
+# seconds between progress reports while an index is building
+PROGRESS_INTERVAL = 5
+
+# Index specifications per collection. Every spec has a name and keys, and may have
+# any other option of create_index, e.g. partialFilterExpression. Key directions can be
+# ASCENDING/DESCENDING or an index type such as GEOSPHERE ('2dsphere').
+ACTIVITY_INDEXES = [
+    # activities of a user, optionally in a time range (query 7 and the filtered distances).
+    # Query 11 groups every activity without a filter, so no index serves it
+    {"name": "user_id_start_date_time", "keys": [("user_id", ASCENDING), ("start_date_time", ASCENDING)]},
+    # activities in a time range (distances per year)
+    {"name": "start_date_time", "keys": [("start_date_time", ASCENDING)]},
+    # labeled activities only, which are a small part of the collection, for filters on a
+    # transportation mode (queries 4 and 7).
+    # '-' sorts before every transportation mode, and $ne is not allowed in a partial filter
+    {"name": "transportation_mode_user_id", "keys": [("transportation_mode", ASCENDING), ("user_id", ASCENDING)],
+     "partialFilterExpression": {"transportation_mode": {"$gt": "-"}}},
+]
+TRACKPOINT_INDEXES = [
+    # the trackpoints of an activity in time order (queries 7, 8 and 9)
+    {"name": "activity_id_date_time", "keys": [("activity_id", ASCENDING), ("date_time", ASCENDING)]},
+    # radius, bounding box and polygon queries on the GeoJSON location (query 10)
+    {"name": "location_2dsphere", "keys": [("location", GEOSPHERE)]},
+]
+BUCKET_INDEXES = [
+    # the buckets of an activity in order
+    {"name": "activity_id_seq", "keys": [("activity_id", ASCENDING), ("seq", ASCENDING)]},
+    # the buckets with a point matching a geospatial filter, over their arrays of GeoJSON points
+    {"name": "location_2dsphere", "keys": [("location", GEOSPHERE)]},
+]
+COMPACT_INDEXES = [
+    # the trackpoints of an activity in time order, on the short keys of utils.trackpointCodec
+    {"name": "a_t", "keys": [("a", ASCENDING), ("t", ASCENDING)]},
+    # geospatial queries on the [longitude, latitude] pair
+    {"name": "l_2dsphere", "keys": [("l", GEOSPHERE)]},
+]
+ROLLUP_INDEXES = [
+    # the rollups of a grain, largest first (queries 3, 5 and 6)
+    {"name": "grain_count", "keys": [("grain", ASCENDING), ("count", DESCENDING)]},
+]
+
+INDEX_SPECS = {
+    "activity": ACTIVITY_INDEXES,
+    "trackpoint": TRACKPOINT_INDEXES,
+    ROLLUP_COLLECTION: ROLLUP_INDEXES,
+}
+BUCKETED_INDEX_SPECS = {
+    "activity": ACTIVITY_INDEXES,
+    BUCKET_COLLECTION: BUCKET_INDEXES,
+    ROLLUP_COLLECTION: ROLLUP_INDEXES,
+}
+COMPACT_INDEX_SPECS = {
+    "activity": ACTIVITY_INDEXES,
+    COMPACT_COLLECTION: COMPACT_INDEXES,
+    ROLLUP_COLLECTION: ROLLUP_INDEXES,
+}
+# the indexes dbService.delete_activities finds the documents of activities with, which an
+# incremental load keeps, as it replaces the activities of changed and pending files
+ACTIVITY_LOOKUP_INDEXES = ("activity_id_date_time", "activity_id_seq", "a_t")
+
+
+def partitioned_index_specs(partitions):
+    """
+    Index specifications of the partitioned layout, where every partition is indexed like trackpoint
+    Parameters
+    ----------
+    partitions: [str]
+        the trackpoint partitions, see utils.partitions
+    """
+    return dict({"activity": ACTIVITY_INDEXES, ROLLUP_COLLECTION: ROLLUP_INDEXES},
+                **{partition: TRACKPOINT_INDEXES for partition in partitions})
+
+
+def create_indexes(db, specs=INDEX_SPECS, rebuild_mismatched=True):
+    """
+    Create the indexes in specs that do not exist yet. Building indexes after a bulk
+    load is much faster than maintaining them during it, so call this after loading.
+    An index with the name of a spec but other keys or options would make create_index
+    fail, so it is dropped and built again, or with rebuild_mismatched=False, reported
+    with a ValueError before anything is built.
+    Parameters
+    ----------
+    db: pymongo.database.Database
+    specs: dict of str: list of dict
+        index specifications per collection
+    rebuild_mismatched: bool
+        drop and rebuild indexes that differ from their spec
+    Return
+    ------
+    [str]: names of the created indexes
+    """
+    created = []
+    missing = verify_indexes(db, specs)
+    mismatched = mismatched_indexes(db, specs)
+    if mismatched and not rebuild_mismatched:
+        raise ValueError("Indexes differ from their specification, drop them or rebuild them: " + ", ".join(
+            "%s.%s" % (collection_name, name) for collection_name in mismatched for name in mismatched[collection_name]))
+    total = sum(len(names) for names in missing.values()) + sum(len(names) for names in mismatched.values())
+    for collection_name in set(missing) | set(mismatched):
+        for spec in specs[collection_name]:
+            if spec["name"] in mismatched.get(collection_name, []):
+                print(f"Dropping index {collection_name}.{spec['name']}, which differs from its specification")
+                db[collection_name].drop_index(spec["name"])
+            elif spec["name"] not in missing.get(collection_name, []):
+                continue
+            print(f"Building index {collection_name}.{spec['name']} ({len(created) + 1}/{total})...")
+            start = time()
+            stop = Event()
+            reporter = Thread(target=_report_build_progress, args=(db, collection_name, stop), daemon=True)
+            reporter.start()
+            try:
+                options = {option: value for option, value in spec.items() if option != "keys"}
+                db[collection_name].create_index(spec["keys"], **options)
+            finally:
+                stop.set()
+                reporter.join()
+            print(f"Built index {collection_name}.{spec['name']} in {round(time() - start, 1)}s")
+            created.append(spec["name"])
+    return created
+
+
+def verify_indexes(db, specs=INDEX_SPECS):
+    """
+    Find the indexes in specs that do not exist, see mismatched_indexes for those
+    that exist with other keys
+    Return
+    ------
+    dict of str: [str]: names of the missing indexes per collection, only collections missing some
+    """
+    missing = {}
+    for collection_name, collection_specs in specs.items():
+        existing = db[collection_name].index_information()
+        for spec in collection_specs:
+            if spec["name"] not in existing:
+                missing.setdefault(collection_name, []).append(spec["name"])
+    return missing
+
+
+def mismatched_indexes(db, specs=INDEX_SPECS):
+    """
+    Find the indexes that have the name of a spec, but other keys or another partial filter
+    Return
+    ------
+    dict of str: [str]: names of the mismatched indexes per collection, only collections with some
+    """
+    mismatched = {}
+    for collection_name, collection_specs in specs.items():
+        existing = db[collection_name].index_information()
+        for spec in collection_specs:
+            index = existing.get(spec["name"])
+            if index != None and not _matches(index, spec):
+                mismatched.setdefault(collection_name, []).append(spec["name"])
+    return mismatched
+
+
+def _matches(index, spec):
+    """
+    Whether an index as described by index_information has the keys and partial filter of spec
+    """
+    if [tuple(key) for key in index["key"]] != [tuple(key) for key in spec["keys"]]:
+        return False
+    return index.get("partialFilterExpression") == spec.get("partialFilterExpression")
+
+
+def _report_build_progress(db, collection_name, stop):
+    """
+    Print the progress the server reports for index builds on collection_name until stop is set
+    """
+    while not stop.wait(PROGRESS_INTERVAL):
+        try:
+            operations = db.client.admin.aggregate([
+                {'$currentOp': {}},
+                {'$match': {'ns': db.name + "." + collection_name, 'command.createIndexes': {'$exists': True}}}
+            ])
+            for operation in operations:
+                progress = operation.get("progress")
+                if progress != None and progress.get("total"):
+                    print(f"  {operation.get('msg', 'building')}: {round(100 * progress['done'] / progress['total'], 1)}%")
+        except Exception:
+            # the user may not be allowed to run $currentOp, the build itself is unaffected
+            return
@@ -0,0 +1,259 @@
+import json
+import logging
+import threading
+from collections import deque
+from functools import wraps
+from time import perf_counter
+
+from bson.son import SON
+from pymongo import monitoring
+
+
+# structured query logs, one JSON object per query
+logger = logging.getLogger("very_large3.queries")
+
+# commands that can be explained, and fields of their documents explain does not accept
+EXPLAINABLE_COMMANDS = ("find", "aggregate", "distinct", "count")
+SESSION_FIELDS = ("$db", "lsid", "$clusterTime", "$readPreference", "txnNumber", "$readConcern")
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """
+    Records the commands a query sends to the server, for the query running on the
+    current thread. Commands sent while no query is recorded are ignored.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def start(self):
+        self.local.commands = {}
+        self.local.order = []
+
+    def stop(self):
+        commands = [self.local.commands[request_id] for request_id in self.local.order]
+        self.local.commands = None
+        return commands
+
+    def recording(self):
+        return getattr(self.local, "commands", None) != None
+
+    def started(self, event):
+        if self.recording():
+            self.local.commands[event.request_id] = {
+                "name": event.command_name,
+                "command": event.command,
+                "duration_s": 0.0,
+                "returned": 0,
+                "failed": False
+            }
+            self.local.order.append(event.request_id)
+
+    def succeeded(self, event):
+        command = self.recording() and self.local.commands.get(event.request_id)
+        if command:
+            command["duration_s"] = event.duration_micros / 1e6
+            command["returned"] = _returned(event.reply)
+
+    def failed(self, event):
+        command = self.recording() and self.local.commands.get(event.request_id)
+        if command:
+            command["duration_s"] = event.duration_micros / 1e6
+            command["failed"] = True
+
+
+# registered before any client is made, it only records while a query is profiled
+COMMAND_RECORDER = CommandRecorder()
+monitoring.register(COMMAND_RECORDER)
+
+
+class MetricsRegistry:
+    """
+    In-process metrics of the profiled queries: the last run of every query and totals per query.
+    The max_recent latest runs are kept until they are drained, older ones are dropped.
+    """
+
+    HEADERS = ["Query", "Calls", "Wall s", "Server s", "Client s", "Returned", "Examined", "Keys", "Scans"]
+
+    def __init__(self, max_recent=1000):
+        self.lock = threading.Lock()
+        self.last = {}
+        self.totals = {}
+        self.recent = deque(maxlen=max_recent)
+
+    def record(self, metrics):
+        with self.lock:
+            self.last[metrics["query"]] = metrics
+            self.recent.append(metrics)
+            totals = self.totals.setdefault(metrics["query"], {
+                "calls": 0, "wall_s": 0.0, "server_s": 0.0, "client_s": 0.0,
+                "docs_returned": 0, "docs_examined": 0, "keys_examined": 0, "collection_scans": 0
+            })
+            totals["calls"] += 1
+            for field in ("wall_s", "server_s", "client_s", "docs_returned"):
+                totals[field] += metrics[field]
+            for field in ("docs_examined", "keys_examined"):
+                totals[field] += metrics[field] or 0
+            totals["collection_scans"] += metrics["stages"].count("COLLSCAN")
+
+    def rows(self):
+        """
+        Return
+        ------
+        list of list: one row per query with its totals, see HEADERS
+        """
+        with self.lock:
+            return [[query, totals["calls"], round(totals["wall_s"], 3), round(totals["server_s"], 3),
+                     round(totals["client_s"], 3), totals["docs_returned"], totals["docs_examined"],
+                     totals["keys_examined"], totals["collection_scans"]]
+                    for query, totals in sorted(self.totals.items())]
+
+    def drain(self):
+        """
+        Return
+        ------
+        list of dict: the metrics recorded since the last call
+        """
+        with self.lock:
+            recent = list(self.recent)
+            self.recent.clear()
+        return recent
+
+
+class QueryProfiler:
+    """
+    Measures every query run through profiled_query: wall time, time spent waiting on
+    the server, time spent in Python on the client, and the documents returned. With
+    explain, every find, aggregate, distinct and count the query sent is explained
+    afterwards with executionStats, for the documents and index keys examined, the plan
+    stages and indexes used, and whether a stage spilled to disk. Explaining runs the
+    commands again, so it doubles the server time of a query and is off by default.
+    """
+
+    def __init__(self, registry=None, explain=False):
+        self.registry = registry if registry != None else MetricsRegistry()
+        self.explain = explain
+
+    def run(self, db, name, function):
+        if COMMAND_RECORDER.recording():
+            # a query called by another profiled query is part of the outer one
+            return function()
+        COMMAND_RECORDER.start()
+        start = perf_counter()
+        try:
+            result = function()
+        finally:
+            wall_s = perf_counter() - start
+            commands = COMMAND_RECORDER.stop()
+
+        server_s = sum(command["duration_s"] for command in commands)
+        metrics = {
+            "query": name,
+            "wall_s": wall_s,
+            "server_s": server_s,
+            "client_s": max(0.0, wall_s - server_s),
+            "commands": len(commands),
+            "docs_returned": sum(command["returned"] for command in commands),
+            "docs_examined": None,
+            "keys_examined": None,
+            "stages": [],
+            "indexes": [],
+            "used_disk": None
+        }
+        if self.explain:
+            metrics.update(self._explain(db, commands))
+        self.registry.record(metrics)
+        logger.info(json.dumps(metrics))
+        return result
+
+    def _explain(self, db, commands):
+        stats = {"docs_examined": 0, "keys_examined": 0, "stages": [], "indexes": [], "used_disk": False}
+        for command in commands:
+            if command["name"] not in EXPLAINABLE_COMMANDS or command["failed"]:
+                continue
+            explained = SON((key, value) for key, value in command["command"].items() if key not in SESSION_FIELDS)
+            try:
+                plan = db.command(SON([("explain", explained), ("verbosity", "executionStats")]))
+            except Exception as e:
+                logger.warning("Could not explain %s: %s" % (command["name"], e))
+                continue
+            _collect_plan_stats(plan, stats)
+        return stats
+
+    def report(self):
+        """
+        Return
+        ------
+        str: the metrics of the queries run since the last report
+        """
+        return "\n".join(format_metrics(metrics) for metrics in self.registry.drain())
+
+
+def format_metrics(metrics):
+    """
+    Return
+    ------
+    str: the metrics of one query run, readable
+    """
+    lines = ["%s: %.3fs wall, %.3fs server, %.3fs client, %d commands" % (
+        metrics["query"], metrics["wall_s"], metrics["server_s"], metrics["client_s"], metrics["commands"])]
+    lines.append("  documents returned: %d" % metrics["docs_returned"])
+    if metrics["docs_examined"] != None:
+        lines.append("  documents examined: %d, index keys examined: %d" % (
+            metrics["docs_examined"], metrics["keys_examined"]))
+        lines.append("  plan: %s, indexes: %s%s" % (
+            " > ".join(metrics["stages"]) or "-", ", ".join(metrics["indexes"]) or "none",
+            ", spilled to disk" if metrics["used_disk"] else ""))
+    return "\n".join(lines)
+
+
+def profiled_query(method):
+    """
+    Decorator for Crud query methods, measured by the profiler of the Crud object if it has one
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.profiler == None:
+            return method(self, *args, **kwargs)
+        return self.profiler.run(self.db, method.__name__, lambda: method(self, *args, **kwargs))
+    return wrapper
+
+
+def _returned(reply):
+    """
+    Number of documents or values in a command reply
+    """
+    cursor = reply.get("cursor")
+    if cursor != None:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    if "values" in reply:
+        return len(reply["values"])
+    if "n" in reply:
+        return 1
+    return 0
+
+
+def _collect_plan_stats(plan, stats):
+    """
+    Add up the execution stats of an explain output, which nests them differently
+    for find, aggregate and sharded collections
+    """
+    if isinstance(plan, list):
+        for value in plan:
+            _collect_plan_stats(value, stats)
+        return
+    if not isinstance(plan, dict):
+        return
+    if "totalDocsExamined" in plan:
+        stats["docs_examined"] += plan["totalDocsExamined"]
+        stats["keys_examined"] += plan.get("totalKeysExamined", 0)
+    if "stage" in plan:
+        stats["stages"].append(plan["stage"])
+        if "indexName" in plan and plan["indexName"] not in stats["indexes"]:
+            stats["indexes"].append(plan["indexName"])
+    if plan.get("usedDisk"):
+        stats["used_disk"] = True
+    for key, value in plan.items():
+        # the rejected plans were not run, and queryPlanner repeats the winning plan of executionStats
+        if key not in ("rejectedPlans", "queryPlanner"):
+            _collect_plan_stats(value, stats)
@@ -0,0 +1,111 @@
+from bisect import bisect_left
+from datetime import datetime, timedelta
+
+
+LABEL_DATE_FORMAT_STRING = "%Y/%m/%d %H:%M:%S"
+NO_LABEL = "-"
+
+
+class LabelIndex:
+    """
+    Sorted interval index over the labels of one user.
+    Labels are sorted on start time, so the labels overlapping a trajectory are
+    found with two bisects instead of a scan over every label.
+
+    Overlap policies:
+        exact       - a label starting at the same time as the trajectory (the original matching)
+        contained   - a label the whole trajectory lies within
+        max_overlap - the transportation mode overlapping the trajectory for the longest time
+    """
+    POLICIES = ("exact", "contained", "max_overlap")
+
+    def __init__(self, labels):
+        """
+        Parameters
+        ----------
+        labels: list of (datetime, datetime, str)
+            start time, end time and transportation mode of each label
+        """
+        self.labels = sorted(labels, key=lambda label: (label[0], label[1]))
+        self.starts = [label[0] for label in self.labels]
+        self.max_duration = max((end - start for start, end, _ in self.labels), default=timedelta(0))
+
+    @classmethod
+    def from_file(cls, filepath):
+        """
+        Read the labels.txt file of a user
+        Parameters
+        ----------
+        filepath: str
+            filepath to the file containing the labels
+        Return
+        ------
+        LabelIndex
+        """
+        labels = []
+        with open(filepath, "r") as f:
+            # skip header
+            next(f, None)
+            for line in f:
+                entries = line.strip().split("\t")
+                if len(entries) < 3:
+                    continue
+                labels.append((datetime.strptime(entries[0], LABEL_DATE_FORMAT_STRING),
+                               datetime.strptime(entries[1], LABEL_DATE_FORMAT_STRING),
+                               entries[-1]))
+        return cls(labels)
+
+    def overlapping(self, start, end):
+        """
+        Find the labels overlapping the interval [start, end]. Labels that only touch it,
+        ending at start or starting at end, do not overlap it.
+        Return
+        ------
+        list of (datetime, datetime, str): the overlapping labels, sorted on start time
+        """
+        # a label starting before start - max_duration has ended before start
+        low = bisect_left(self.starts, start - self.max_duration)
+        high = bisect_left(self.starts, end)
+        return [label for label in self.labels[low:high] if label[1] > start]
+
+    def match(self, start, end, policy="max_overlap"):
+        """
+        Find the transportation mode of a trajectory
+        Parameters
+        ----------
+        start: datetime
+            start time of the trajectory
+        end: datetime
+            end time of the trajectory
+        policy: str
+            one of LabelIndex.POLICIES
+        Return
+        ------
+        str: the transportation mode, or '-' if no label matches
+        """
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown label policy '%s', expected one of %s" % (policy, self.POLICIES))
+
+        if policy == "exact":
+            i = bisect_left(self.starts, start)
+            if i < len(self.starts) and self.starts[i] == start:
+                return self.labels[i][2]
+            return NO_LABEL
+
+        labels = self.overlapping(start, end)
+        if policy == "contained":
+            for label_start, label_end, mode in labels:
+                if label_start <= start and end <= label_end:
+                    return mode
+            return NO_LABEL
+
+        overlap_per_mode = {}
+        for label_start, label_end, mode in labels:
+            overlap = min(end, label_end) - max(start, label_start)
+            if overlap <= timedelta(0):
+                continue
+            overlap_per_mode[mode] = overlap_per_mode.get(mode, timedelta(0)) + overlap
+        if not overlap_per_mode:
+            return NO_LABEL
+        # dicts keep insertion order, so ties go to the earliest label
+        return max(overlap_per_mode, key=overlap_per_mode.get)
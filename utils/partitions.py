@@ -0,0 +1,64 @@
+import re
+from datetime import datetime
+
+
+# logical name of the partitioned trackpoints, whose write version is bumped with every partition
+PARTITIONED_COLLECTION = "trackpoint_partitioned"
+PARTITION_PREFIX = "trackpoint_"
+PERIODS = ("year", "month")
+PARTITION_PATTERN = re.compile(r"^trackpoint_(\d{4})(?:_(\d{2}))?$")
+
+
+def partition_name(date_time, period="year"):
+    """
+    Collection of the trackpoints of the activities starting at date_time,
+    e.g. trackpoint_2008 by year or trackpoint_2008_10 by month
+    """
+    if period == "year":
+        return "%s%04d" % (PARTITION_PREFIX, date_time.year)
+    if period == "month":
+        return "%s%04d_%02d" % (PARTITION_PREFIX, date_time.year, date_time.month)
+    raise ValueError("period must be one of %s, not '%s'" % (", ".join(PERIODS), period))
+
+
+def is_partition(collection_name):
+    return PARTITION_PATTERN.match(collection_name) != None
+
+
+def partition_range(collection_name):
+    """
+    Return
+    ------
+    (datetime, datetime): start of the period of a partition and start of the next period
+    """
+    year, month = PARTITION_PATTERN.match(collection_name).groups()
+    if month == None:
+        return datetime(int(year), 1, 1), datetime(int(year) + 1, 1, 1)
+    start = datetime(int(year), int(month), 1)
+    return start, datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def sorted_partitions(collection_names):
+    """
+    The partitions among collection_names, in time order
+    """
+    return sorted(collection_name for collection_name in collection_names if is_partition(collection_name))
+
+
+def route(activity_trackpoints, period="year"):
+    """
+    Split the trackpoints of some activities into their partitions. All trackpoints of an
+    activity go to the partition of its start, so every activity is read from one collection.
+    Parameters
+    ----------
+    activity_trackpoints: iterable of list of trackpoint dicts
+        the trackpoints of each activity, in time order
+    Return
+    ------
+    dict of str: list of trackpoint dicts: the trackpoints per partition
+    """
+    partitions = {}
+    for trackpoints in activity_trackpoints:
+        if trackpoints:
+            partitions.setdefault(partition_name(trackpoints[0]["date_time"], period), []).extend(trackpoints)
+    return partitions
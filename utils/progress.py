@@ -0,0 +1,30 @@
+from time import time
+
+
+class InsertProgress:
+    """
+    Counts inserted documents per collection and prints the throughput every report_interval seconds
+    """
+
+    def __init__(self, report_interval):
+        self.report_interval = report_interval
+        self.counts = {}
+        self.start = time()
+        self.last_report = self.start
+
+    def add(self, collection_name, n):
+        self.counts[collection_name] = self.counts.get(collection_name, 0) + n
+        now = time()
+        if now - self.last_report >= self.report_interval:
+            self.report(now)
+            self.last_report = now
+
+    def report(self, now, prefix=""):
+        elapsed = max(now - self.start, 1e-9)
+        print(prefix + ", ".join(f"{collection_name}: {n} inserted ({round(n / elapsed)}/s)"
+                                 for collection_name, n in self.counts.items()))
+
+    def done(self):
+        now = time()
+        self.report(now, prefix=f"Done in {round(now - self.start, 1)}s: ")
+        return self.counts
@@ -0,0 +1,114 @@
+import inspect
+import shelve
+from collections import OrderedDict
+from copy import deepcopy
+from functools import wraps
+from threading import Lock
+from time import time
+
+
+# holds a version per collection, replaced on every write, see dbService.bump_write_versions
+VERSION_COLLECTION = "write_version"
+
+
+class QueryCache:
+    """
+    Cache of query results keyed on the query and its arguments.
+    Every entry remembers the write versions of the collections the query read, and is
+    only used while those versions are unchanged, so results are dropped as soon as
+    dbService writes to or drops one of the collections.
+    The max_entries most recently used entries are kept in memory, entries older than
+    ttl seconds are dropped, and with a path the entries are also kept in a shelve file,
+    so they survive restarts.
+    """
+
+    def __init__(self, max_entries=128, ttl=None, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, versions):
+        """
+        Return
+        ------
+        (bool, object): whether a valid entry was found, and its result
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None and self.path != None:
+                with shelve.open(self.path) as store:
+                    entry = store.get(key)
+            if entry != None and entry["versions"] == versions and not self._expired(entry):
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                self._evict()
+                self.hits += 1
+                return True, deepcopy(entry["result"])
+            self._remove(key)
+            self.misses += 1
+            return False, None
+
+    def put(self, key, versions, result):
+        entry = {"versions": versions, "created": time(), "result": deepcopy(result)}
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._evict()
+            if self.path != None:
+                with shelve.open(self.path) as store:
+                    store[key] = entry
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.path != None:
+                with shelve.open(self.path, flag="n"):
+                    pass
+
+    def _expired(self, entry):
+        return self.ttl != None and time() - entry["created"] > self.ttl
+
+    def _evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        if self.path != None:
+            with shelve.open(self.path) as store:
+                if key in store:
+                    del store[key]
+
+
+def cached_query(*collection_names):
+    """
+    Decorator for Crud query methods that read collection_names. Results are cached in
+    the query_cache of the Crud object, if it has one. "trackpoint" stands for the
+    trackpoint collection of the layout in use, see Crud.TRACKPOINT_COLLECTION.
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.query_cache == None:
+                return method(self, *args, **kwargs)
+            collections = [self.TRACKPOINT_COLLECTION if name == "trackpoint" else name
+                           for name in collection_names]
+            # bind the arguments, so positional, keyword and default arguments share an entry
+            arguments = signature.bind(self, *args, **kwargs)
+            arguments.apply_defaults()
+            key = repr((self.db.name, type(self).__name__, method.__name__, list(arguments.arguments.items())[1:]))
+            versions = self.dbService.get_write_versions(collections)
+            found, result = self.query_cache.get(key, versions)
+            if found:
+                return result
+            result = method(self, *args, **kwargs)
+            self.query_cache.put(key, versions, result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,76 @@
+"""
+The eleven queries of main.Program.QUERIES_STRING, with the arguments the assignment asks
+for, so the batch CLI and the benchmark run the same queries as the interactive program.
+"""
+
+
+class Query:
+    """
+    One numbered query
+    Parameters
+    ----------
+    number: int
+    name: str
+    run: callable
+        takes a Crud and returns the result of the query
+    headers: [str]
+        column names of the rows of the result
+    to_rows: callable
+        turns the result into a list of rows, by default it already is one
+    """
+
+    def __init__(self, number, name, run, headers, to_rows=None):
+        self.number = number
+        self.name = name
+        self.run = run
+        self.headers = headers
+        self.to_rows = to_rows if to_rows != None else (lambda result: result)
+
+    def rows(self, result):
+        return [] if result == None else self.to_rows(result)
+
+
+QUERIES = {query.number: query for query in [
+    Query(1, "get_number_of_rows", lambda crud: crud.get_number_of_rows(),
+          ["Users", "Activities", "Trackpoints"]),
+    Query(2, "get_average_no_of_activities", lambda crud: crud.get_average_no_of_activities(),
+          ["Activities per user", "Activities per user with activities"], lambda result: [result]),
+    Query(3, "most_active_users_limit_n", lambda crud: crud.most_active_users_limit_n(20),
+          ["User ID", "Number of activities"]),
+    Query(4, "find_users_on_transportation_mode", lambda crud: crud.find_users_on_transportation_mode("taxi"),
+          ["User ID"]),
+    Query(5, "get_all_transportation_modes_and_their_count",
+          lambda crud: crud.get_all_transportation_modes_and_their_count(),
+          ["Transportation mode", "Number of activities"]),
+    Query(6, "get_year_with_most_activities_and_hours",
+          lambda crud: [crud.get_year_with_most_activities(), crud.get_year_with_most_hours()],
+          ["Measure", "Year", "Value"],
+          lambda result: [[measure] + row for measure, row in zip(["activities", "hours"], result) if row != None]),
+    Query(7, "get_distance_walked_in_year_by_user",
+          lambda crud: crud.get_distance_walked_in_year_by_user(year=2008, user="112"),
+          ["Distance walked in km"], lambda result: [[result]]),
+    Query(8, "get_n_users_with_most_elevation_gained", lambda crud: crud.get_n_users_with_most_elevation_gained(20),
+          ["User ID", "Altitude gain"]),
+    Query(9, "get_users_with_invalid_activities", lambda crud: crud.get_users_with_invalid_activities(),
+          ["User ID", "Number of invalid activities"]),
+    Query(10, "get_users_with_activities_in_forbidden_city",
+          lambda crud: crud.get_users_with_activities_in_forbidden_city(), ["User ID"]),
+    Query(11, "get_most_frequent_transportation_mode_per_user",
+          lambda crud: crud.get_most_frequent_transportation_mode_per_user(), ["User ID", "Transportation mode"]),
+]}
+
+
+def find_query(key):
+    """
+    Find a query by its number or name
+    Return
+    ------
+    Query
+    """
+    if str(key).isdigit() and int(key) in QUERIES:
+        return QUERIES[int(key)]
+    for query in QUERIES.values():
+        if query.name == key:
+            return query
+    raise ValueError("No query '%s', use a number from 1 to %d or one of: %s" % (
+        key, len(QUERIES), ", ".join(query.name for query in QUERIES.values())))
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+from pymongo import UpdateOne
+
+
+ROLLUP_COLLECTION = "activity_rollup"
+# grains of the rollup documents, each with the activity fields it is keyed on
+GRAINS = {
+    "user": ("user_id",),
+    "mode": ("transportation_mode",),
+    "year": ("year",),
+    "day": ("user_id", "transportation_mode", "day"),
+}
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+
+def hour_boundaries(start, end):
+    """
+    Number of hour boundaries between start and end, as $dateDiff with unit 'hour' counts them in UTC
+    """
+    return (end - UNIX_EPOCH) // timedelta(hours=1) - (start - UNIX_EPOCH) // timedelta(hours=1)
+
+
+def rollup_keys(activity):
+    """
+    The rollup documents an activity is counted in, one per grain
+    Return
+    ------
+    list of (str, dict): _id and key fields of each rollup document
+    """
+    fields = {
+        "user_id": activity["user_id"],
+        "transportation_mode": activity["transportation_mode"],
+        "year": activity["start_date_time"].year,
+        "day": activity["start_date_time"].strftime("%Y-%m-%d"),
+    }
+    keys = []
+    for grain, grain_fields in GRAINS.items():
+        key = dict({"grain": grain}, **{field: fields[field] for field in grain_fields})
+        keys.append(("|".join([grain] + [str(fields[field]) for field in grain_fields]), key))
+    return keys
+
+
+def rollup_updates(activities, sign=1):
+    """
+    Updates adding activities to the rollups, or removing them with sign=-1.
+    Every rollup document has a count, the hours as $dateDiff counts them, and the duration in seconds.
+    Parameters
+    ----------
+    activities: iterable of activity dicts
+        with user_id, transportation_mode, start_date_time and end_date_time
+    Return
+    ------
+    list of pymongo.UpdateOne: one per rollup document
+    """
+    increments = {}
+    key_fields = {}
+    for activity in activities:
+        hours = hour_boundaries(activity["start_date_time"], activity["end_date_time"])
+        duration_s = (activity["end_date_time"] - activity["start_date_time"]).total_seconds()
+        for _id, key in rollup_keys(activity):
+            increment = increments.setdefault(_id, {"count": 0, "hours": 0, "duration_s": 0.0})
+            increment["count"] += sign
+            increment["hours"] += sign * hours
+            increment["duration_s"] += sign * duration_s
+            key_fields[_id] = key
+    return [UpdateOne({"_id": _id}, {"$inc": increment, "$setOnInsert": key_fields[_id]}, upsert=True)
+            for _id, increment in increments.items()]
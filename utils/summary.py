@@ -0,0 +1,66 @@
+import numpy as np
+
+from utils.distance import haversine_km
+
+
+# altitude of trackpoints without a recorded altitude
+MISSING_ALTITUDE = -777
+
+
+def summarize_trackpoints(latitudes, longitudes, altitudes, date_times):
+    """
+    Summary block stored on each activity, computed from its trackpoints in time order
+    Parameters
+    ----------
+    latitudes, longitudes: [float]
+    altitudes: [int]
+        in feet, -777 where missing
+    date_times: [datetime]
+    Return
+    ------
+    dict of {
+        n_trackpoints: integer
+        distance_km: float
+        altitude_gain: integer
+        altitude_loss: integer
+        duration_s: integer
+        max_gap_s: integer
+        bbox: {min_latitude, min_longitude, max_latitude, max_longitude}
+    }
+    """
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    altitudes = np.asarray(altitudes, dtype=np.int64)
+    n = len(latitudes)
+    if n == 0:
+        return {"n_trackpoints": 0, "distance_km": 0.0, "altitude_gain": 0, "altitude_loss": 0,
+                "duration_s": 0, "max_gap_s": 0, "bbox": None}
+
+    distance = haversine_km(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:]).sum()
+    # changes between consecutive recorded altitudes, skipping the missing ones
+    climbs = np.diff(altitudes[altitudes != MISSING_ALTITUDE])
+    gaps = [(date_times[i + 1] - date_times[i]).total_seconds() for i in range(n - 1)]
+    return {
+        "n_trackpoints": n,
+        "distance_km": float(distance),
+        "altitude_gain": int(climbs[climbs > 0].sum()),
+        "altitude_loss": int(-climbs[climbs < 0].sum()),
+        "duration_s": int((date_times[-1] - date_times[0]).total_seconds()),
+        "max_gap_s": int(max(gaps, default=0)),
+        "bbox": {
+            "min_latitude": float(latitudes.min()),
+            "min_longitude": float(longitudes.min()),
+            "max_latitude": float(latitudes.max()),
+            "max_longitude": float(longitudes.max())
+        }
+    }
+
+
+def summarize_documents(trackpoints):
+    """
+    summarize_trackpoints for a list of trackpoint documents
+    """
+    return summarize_trackpoints([trackpoint["latitude"] for trackpoint in trackpoints],
+                                 [trackpoint["longitude"] for trackpoint in trackpoints],
+                                 [trackpoint["altitude"] for trackpoint in trackpoints],
+                                 [trackpoint["date_time"] for trackpoint in trackpoints])
@@ -0,0 +1,104 @@
+from datetime import datetime, timedelta
+
+from utils.buckets import DATE_DAYS_EPOCH
+from utils.geoQueries import LOCATION_FIELD, location_field, valid_coordinates
+from utils.rollups import UNIX_EPOCH
+
+
+COMPACT_COLLECTION = "trackpoint_compact"
+# compact key of every logical trackpoint field that is stored. user_id is found through
+# the activity, date_days is derived from the time, and latitude and longitude are read
+# from the [longitude, latitude] pair, which a 2dsphere index takes as a legacy point
+COMPACT_FIELDS = {
+    "activity_id": "a",
+    "date_time": "t",
+    "altitude": "z",
+    LOCATION_FIELD: "l",
+    "longitude": "l.0",
+    "latitude": "l.1",
+}
+
+
+def encode(trackpoint):
+    """
+    Compact document of a trackpoint as described in objects.py
+    Return
+    ------
+    dict of {
+        a: integer  <-- activity_id
+        t: integer  <-- date_time in seconds since 1970
+        z: integer  <-- altitude, int32
+        l: [float, float]  <-- [longitude, latitude]
+    }
+    Coordinates out of range are stored in p instead of l, as the 2dsphere index on l
+    does not take them, see geoQueries.valid_coordinates
+    """
+    pair_key = "l" if valid_coordinates(trackpoint["latitude"], trackpoint["longitude"]) else "p"
+    return {
+        "a": trackpoint["activity_id"],
+        "t": epoch_seconds(trackpoint["date_time"]),
+        "z": int(trackpoint["altitude"]),
+        pair_key: [trackpoint["longitude"], trackpoint["latitude"]],
+    }
+
+
+def decode(document, user_ids=None):
+    """
+    Trackpoint as described in objects.py of a compact document, with the fields of
+    a projected document only
+    Parameters
+    ----------
+    document: dict
+        compact document
+    user_ids: dict of int: str
+        user id of every activity, None to leave out user_id
+    """
+    trackpoint = {"activity_id": document["a"]}
+    if user_ids != None:
+        trackpoint["user_id"] = user_ids.get(document["a"])
+    if "l" in document or "p" in document:
+        longitude, latitude = document["l"] if "l" in document else document["p"]
+        trackpoint["latitude"] = latitude
+        trackpoint["longitude"] = longitude
+        trackpoint.update(location_field(latitude, longitude))
+    if "z" in document:
+        trackpoint["altitude"] = document["z"]
+    if "t" in document:
+        date_time = from_epoch_seconds(document["t"])
+        trackpoint["date_days"] = (date_time - DATE_DAYS_EPOCH) / timedelta(days=1)
+        trackpoint["date_time"] = date_time
+    return trackpoint
+
+
+def epoch_seconds(date_time):
+    return (date_time - UNIX_EPOCH) // timedelta(seconds=1)
+
+
+def from_epoch_seconds(seconds):
+    return UNIX_EPOCH + timedelta(seconds=seconds)
+
+
+def encode_filter(query):
+    """
+    Filter on compact documents for a filter on logical trackpoint fields. Dates are
+    compared as epoch seconds, and GeoJSON points in geo operators work on the legacy pair.
+    """
+    if isinstance(query, list):
+        return [encode_filter(value) for value in query]
+    if not isinstance(query, dict):
+        return _encode_value(query)
+    encoded = {}
+    for key, value in query.items():
+        if key in COMPACT_FIELDS:
+            encoded[COMPACT_FIELDS[key]] = encode_filter(value)
+        elif key == "user_id":
+            raise ValueError("Compact trackpoints have no user_id, filter on the activities of the user")
+        else:
+            encoded[key] = encode_filter(value)
+    return encoded
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return epoch_seconds(value)
+    return value